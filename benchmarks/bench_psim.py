@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк конвертации PSIM -> ACCE на синтетических файлах шаблона и выгрузки Sheet2.
+Сравнивает convert_psim_to_asse целиком (чтение, заполнение, сохранение):
+  - исходный путь: load_workbook обеих книг и построчная запись add_pipes;
+  - пакетная запись по описанию колонок без кэша шаблонов;
+  - путь по умолчанию: пакетная запись и кэш разобранных шаблонов.
+Варианты запускаются поочерёдно в каждом повторе, сообщается медиана времени.
+Проверяет, что все варианты дают одинаковый лист BPIPPIPE, и что путь по умолчанию
+не медленнее исходного (с допуском --tolerance); иначе завершается с кодом 1.
+
+Запуск:
+    python benchmarks/bench_psim.py --rows 50000 --repeat 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from openpyxl import Workbook, load_workbook
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from converter import PIPE_SHEET, convert_psim_to_asse  # noqa: E402
+
+VARIANTS = (
+    ("add_pipes", dict(bulk=False, use_cache=False)),
+    ("bulk", dict(bulk=True, use_cache=False)),
+    ("bulk, template cache", dict(bulk=True, use_cache=True)),
+)
+
+
+def make_template(path):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = PIPE_SHEET
+    for row in range(1, 11):
+        for col in range(1, 17):
+            ws.cell(row=row, column=col, value=f"H{row}.{col}")
+    wb.save(path)
+
+
+def make_source(path, rows):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Sheet2'
+    ws.append(["Tag", "Description", "Spec", "Length", "Diameter"])
+    for i in range(rows):
+        ws.append([f"TAG-{i}", f"/PIPE-{i:06d}-LONG-DESCRIPTION-FOR-TRUNCATION", "A1", i * 0.01, 0.1 + i % 7])
+    wb.save(path)
+
+
+def sheet_values(path):
+    wb = load_workbook(path, read_only=True)
+    try:
+        return list(wb[PIPE_SHEET].iter_rows(values_only=True))
+    finally:
+        wb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help="допустимое замедление пути по умолчанию, доля (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        template = os.path.join(folder, "template.xlsx")
+        source = os.path.join(folder, "source.xlsx")
+        make_template(template)
+        make_source(source, args.rows)
+
+        # Первый вызов заполняет кэш шаблонов; в замеры попадают повторные конвертации
+        convert_psim_to_asse(template, source, os.path.join(folder, "warmup.xlsx"))
+
+        times = {name: [] for name, _ in VARIANTS}
+        outputs = {}
+        for rep in range(args.repeat):
+            # Порядок вариантов сдвигается в каждом повторе, чтобы фоновая нагрузка
+            # и прогрев не доставались одному и тому же варианту
+            shift = rep % len(VARIANTS)
+            for name, options in VARIANTS[shift:] + VARIANTS[:shift]:
+                output = os.path.join(folder, f"out_{len(outputs)}.xlsx")
+                start = time.perf_counter()
+                convert_psim_to_asse(template, source, output, **options)
+                times[name].append(time.perf_counter() - start)
+                outputs.setdefault(name, output)
+
+        expected = sheet_values(outputs["add_pipes"])
+        for name, output in outputs.items():
+            if sheet_values(output) != expected:
+                print(f"ОШИБКА: лист {PIPE_SHEET} варианта '{name}' отличается от add_pipes")
+                sys.exit(1)
+
+    medians = {name: statistics.median(values) for name, values in times.items()}
+    baseline = medians["add_pipes"]
+    print(f"rows={args.rows} repeat={args.repeat} (медиана convert_psim_to_asse)")
+    for name, _ in VARIANTS:
+        spread = f"{min(times[name]):.3f}..{max(times[name]):.3f}"
+        print(f"{name:<22}: {medians[name]:.3f} s  [{spread}]  (x{baseline / medians[name]:.2f})")
+
+    default = medians[VARIANTS[-1][0]]
+    if default > baseline * (1 + args.tolerance):
+        print(f"ОШИБКА: путь по умолчанию медленнее add_pipes: {default:.3f} s против {baseline:.3f} s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,11 +10,12 @@ if platform.system() == 'Darwin':
 import sys
 import os
 import logging
+import multiprocessing
 from threading import Thread
 import json
 import webview
 from flask import Flask
-from routes import bp as main_bp
+from routes import LOCAL_PATHS_CONFIG, bp as main_bp
 from utils import get_app_folder
 
 if hasattr(sys, '_MEIPASS'):
@@ -26,6 +27,8 @@ template_folder = os.path.join(base_path, 'assets')
 static_folder = os.path.join(base_path, 'static')
 
 app = Flask(__name__, template_folder=template_folder, static_folder=static_folder)
+# Окно приложения работает с локальными файлами пользователя по путям
+app.config[LOCAL_PATHS_CONFIG] = True
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
@@ -141,6 +144,9 @@ def run_flask():
 
 
 if __name__ == "__main__":
+    # Нужен для пула процессов пакетной конвертации в собранном приложении
+    multiprocessing.freeze_support()
+
     thread = Thread(target=run_flask, daemon=True)
     thread.start()
 
@@ -0,0 +1,282 @@
+"""
+Консольный запуск конвертаций без окна и без Flask – для серверов сборки.
+
+    python src/cli.py psim TEMPLATE SHEET2... -o OUT [--jobs N]
+    python src/cli.py ifc-update MODEL... -a ATTRIBUTES.xlsx -o FOLDER [--patch] [--compress] [--jobs N]
+    python src/cli.py transfer OLD NEW -o OUT [--compress]
+    python src/cli.py batch MANIFEST.json [--jobs N]
+    python src/cli.py serve [--host HOST] [--port PORT] [--token TOKEN]
+
+Манифест пакета – JSON со списком задач (относительные пути – от папки манифеста):
+    {"tasks": [
+        {"type": "psim", "template": "...", "sources": ["..."], "output": "папка или файл"},
+        {"type": "ifc_update", "models": ["..."], "attributes": "...", "output": "папка",
+         "mode": "patch", "compress": false},
+        {"type": "transfer", "old": "...", "new": "...", "output": "...", "compress": false}
+    ]}
+Задачи psim и ifc_update с несколькими файлами раскладываются по одному файлу;
+--jobs N выполняет до N файлов одновременно в отдельных процессах.
+
+Для каждого файла в stdout выводится строка JSON с результатом, временем
+(seconds) и временем по этапам конвертера (stages), в конце – строка со сводкой.
+Сообщения конвертеров и лог идут в stderr. Код возврата 1, если хотя бы одна
+задача завершилась с ошибкой. pywebview не импортируется.
+
+serve запускает HTTP API (те же маршруты, что у приложения, включая загрузку
+файлов и скачивание результатов) без окна – для удалённых конвертаций. Входные
+файлы принимаются только ссылками upload:<id>, результаты пишутся в папки для
+скачивания. С токеном (--token или переменная PSIM_ACCE_API_TOKEN) каждый запрос
+должен передать его в заголовке Authorization: Bearer <токен> (или ?token=<токен>
+для EventSource). Адрес не из loopback без токена не принимается.
+"""
+import argparse
+import hmac
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+
+from converter import batch_output_path, convert_psim_cached
+from ifc_converter import convert_excel_to_ifc_batch
+from ifc_io import as_ifczip_path
+from ifc_to_ifc_converter import process_ifc_files
+from progress import ProgressReporter
+from utils import get_base_path
+
+logger = logging.getLogger(__name__)
+
+TASK_TYPES = ("psim", "ifc_update", "transfer")
+API_TOKEN_ENV = "PSIM_ACCE_API_TOKEN"
+
+
+def _resolve(path, base_dir):
+    return path if os.path.isabs(path) else os.path.normpath(os.path.join(base_dir, path))
+
+
+def expand_tasks(specs, base_dir="."):
+    """Разворачивает задачи манифеста в задачи по одному файлу; проверяет обязательные поля."""
+    tasks = []
+    for number, spec in enumerate(specs, 1):
+        task_type = spec.get("type")
+        if task_type not in TASK_TYPES:
+            raise ValueError(f"Задача {number}: неизвестный тип {task_type!r}, ожидается один из {TASK_TYPES}")
+        try:
+            output = _resolve(spec["output"], base_dir)
+            if task_type == "psim":
+                template = _resolve(spec["template"], base_dir)
+                sources = [_resolve(p, base_dir) for p in spec["sources"]]
+                to_folder = os.path.isdir(output) or len(sources) > 1
+                for source in sources:
+                    tasks.append({"type": task_type, "template": template, "source": source,
+                                  "output": batch_output_path(source, output) if to_folder else output})
+            elif task_type == "ifc_update":
+                attributes = _resolve(spec["attributes"], base_dir)
+                for model in spec["models"]:
+                    tasks.append({"type": task_type, "source": _resolve(model, base_dir), "attributes": attributes,
+                                  "output": output, "patch": spec.get("mode") == "patch",
+                                  "compress": bool(spec.get("compress"))})
+            else:
+                tasks.append({"type": task_type, "old": _resolve(spec["old"], base_dir),
+                              "source": _resolve(spec["new"], base_dir),
+                              "output": as_ifczip_path(output) if spec.get("compress") else output})
+        except KeyError as e:
+            raise ValueError(f"Задача {number} ({task_type}): не указано поле {e}") from None
+    return tasks
+
+
+def run_task(task):
+    """Выполняет одну задачу и возвращает результат с временем всего и по этапам."""
+    stages = {}
+
+    def collect(event):
+        if event["state"] == "end":
+            stages[event["stage"]] = round(stages.get(event["stage"], 0) + event["elapsed"], 3)
+
+    progress = ProgressReporter(collect)
+    result = {"type": task["type"], "source": task["source"], "output": task["output"],
+              "status": "success", "error": None, "cached": None}
+    start = time.perf_counter()
+    try:
+        # Конвертеры печатают отчёты через print – в stdout должны попадать только строки JSON
+        with redirect_stdout(sys.stderr):
+            if task["type"] == "psim":
+                result["cached"] = convert_psim_cached(task["template"], task["source"], task["output"])
+            elif task["type"] == "ifc_update":
+                item = convert_excel_to_ifc_batch([task["source"]], task["attributes"], task["output"],
+                                                  max_workers=1, patch=task["patch"], compress=task["compress"],
+                                                  progress=progress, refill=False)[0]
+                result.update(status=item["status"], error=item["error"], output=item["output"],
+                              cached=item.get("cached"))
+                if item.get("match"):
+                    result["match"] = {k: v for k, v in item["match"].items() if not k.endswith("_sample")}
+            else:
+                summary = process_ifc_files(task["old"], task["source"], task["output"], progress=progress,
+                                            refill=False)
+                result["cached"] = summary.pop("cached")
+                result["summary"] = summary
+    except Exception as e:
+        logger.exception(f"Ошибка задачи {task['type']} для {task['source']}")
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    result["stages"] = stages
+    if result["status"] == "success" and os.path.isfile(result["output"]):
+        result["bytes"] = os.path.getsize(result["output"])
+    return result
+
+
+def run_tasks(tasks, jobs=1):
+    """Выдаёт результаты задач по мере готовности; при jobs > 1 – из пула процессов."""
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield run_task(task)
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+        futures = [pool.submit(run_task, task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _emit(data):
+    sys.stdout.write(json.dumps(data, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def load_manifest(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    specs = data.get("tasks") if isinstance(data, dict) else data
+    if not isinstance(specs, list):
+        raise ValueError("Манифест должен содержать список задач tasks")
+    return expand_tasks(specs, os.path.dirname(os.path.abspath(path)))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Конвертации PSIM/ACCE/IFC без графического интерфейса.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог в stderr")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_jobs(command):
+        command.add_argument("-j", "--jobs", type=int, default=1, help="число файлов, обрабатываемых одновременно")
+
+    psim = commands.add_parser("psim", help="PSIM -> ACCE")
+    psim.add_argument("template", help="шаблон ACCE (.xlsx)")
+    psim.add_argument("sources", nargs="+", help="выгрузки PSIM (Sheet2)")
+    psim.add_argument("-o", "--output", required=True, help="файл результата или папка для нескольких выгрузок")
+    add_jobs(psim)
+
+    ifc_update = commands.add_parser("ifc-update", help="Excel -> IFC")
+    ifc_update.add_argument("models", nargs="+", help="IFC-модели (.ifc, .ifczip, .ifc.gz)")
+    ifc_update.add_argument("-a", "--attributes", required=True, help="файл атрибутов (.xlsx)")
+    ifc_update.add_argument("-o", "--output", required=True, help="папка для результатов")
+    ifc_update.add_argument("--patch", action="store_true", help="потоковая запись без разбора модели")
+    ifc_update.add_argument("--compress", action="store_true", help="сохранять результаты в ifcZIP")
+    add_jobs(ifc_update)
+
+    transfer = commands.add_parser("transfer", help="IFC -> IFC (перенос GUID)")
+    transfer.add_argument("old", help="старая ревизия модели")
+    transfer.add_argument("new", help="новая ревизия модели")
+    transfer.add_argument("-o", "--output", required=True, help="файл результата")
+    transfer.add_argument("--compress", action="store_true", help="сохранить результат в ifcZIP")
+
+    batch = commands.add_parser("batch", help="задачи из манифеста JSON")
+    batch.add_argument("manifest", help="файл манифеста")
+    add_jobs(batch)
+
+    serve = commands.add_parser("serve", help="HTTP API для удалённых конвертаций")
+    serve.add_argument("--host", default="127.0.0.1", help="адрес (0.0.0.0 – все интерфейсы)")
+    serve.add_argument("--port", type=int, default=5000, help="порт")
+    serve.add_argument("--token", default=os.environ.get(API_TOKEN_ENV),
+                       help=f"токен доступа (по умолчанию из {API_TOKEN_ENV}); обязателен для адреса не из loopback")
+    return parser
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def create_api_app(token=None):
+    """Flask-приложение HTTP API: только ссылки upload:<id>, при token – с проверкой токена."""
+    from flask import Flask, jsonify, request
+    from routes import bp
+
+    base_path = get_base_path()
+    app = Flask(__name__, template_folder=os.path.join(base_path, 'assets'),
+                static_folder=os.path.join(base_path, 'static'))
+    app.register_blueprint(bp)
+
+    if token:
+        @app.before_request
+        def check_token():
+            auth = request.headers.get("Authorization", "")
+            given = auth[len("Bearer "):] if auth.startswith("Bearer ") else request.args.get("token", "")
+            if not hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+                return jsonify({"status": "error", "message": "Неверный или отсутствующий токен доступа."}), 401
+    return app
+
+
+def serve(host, port, token=None):
+    """HTTP API приложения без окна pywebview."""
+    if not token and not is_loopback(host):
+        print(f"Ошибка: адрес {host} доступен из сети – задайте токен (--token или {API_TOKEN_ENV}).",
+              file=sys.stderr)
+        return 2
+    app = create_api_app(token)
+    logger.info(f"HTTP API: http://{host}:{port}")
+    app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
+    return 0
+
+
+def tasks_from_args(args):
+    if args.command == "batch":
+        return load_manifest(args.manifest)
+    if args.command == "psim":
+        spec = {"type": "psim", "template": args.template, "sources": args.sources, "output": args.output}
+    elif args.command == "ifc-update":
+        if not os.path.isdir(args.output):
+            raise ValueError(f"Путь вывода '{args.output}' должен быть папкой.")
+        spec = {"type": "ifc_update", "models": args.models, "attributes": args.attributes, "output": args.output,
+                "mode": "patch" if args.patch else "full", "compress": args.compress}
+    else:
+        spec = {"type": "transfer", "old": args.old, "new": args.new, "output": args.output,
+                "compress": args.compress}
+    return expand_tasks([spec], os.getcwd())
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.command == "serve":
+        return serve(args.host, args.port, args.token)
+    try:
+        tasks = tasks_from_args(args)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    counts = {"success": 0, "error": 0, "cached": 0}
+    for result in run_tasks(tasks, getattr(args, "jobs", 1)):
+        counts["success" if result["status"] == "success" else "error"] += 1
+        if result["cached"]:
+            counts["cached"] += 1
+        _emit(result)
+    _emit({"summary": dict(counts, tasks=len(tasks), seconds=round(time.perf_counter() - start, 3))})
+    return 1 if counts["error"] else 0
+
+
+if __name__ == "__main__":
+    # Нужен для пула процессов в собранном приложении
+    multiprocessing.freeze_support()
+    sys.exit(main())
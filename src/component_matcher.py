@@ -0,0 +1,90 @@
+class ComponentIndex:
+    """
+    Индекс компонентов PIPE-элементов IFC-модели, построенный за один обход
+    отношений IsDecomposedBy:
+      by_key  – (Name, GlobalId) -> компонент;
+      by_guid – GlobalId -> компонент;
+      by_name – Name -> число компонентов с таким именем;
+      pipe_of – GlobalId компонента -> GlobalId PIPE-элемента.
+    """
+
+    def __init__(self):
+        self.by_key = {}
+        self.by_guid = {}
+        self.by_name = {}
+        self.pipe_of = {}
+
+    @classmethod
+    def from_pipes(cls, pipe_elements):
+        index = cls()
+        for pipe in pipe_elements:
+            for rel in getattr(pipe, "IsDecomposedBy", []):
+                for comp in getattr(rel, "RelatedObjects", []):
+                    if comp.is_a("IfcElementAssembly"):
+                        index.add(comp, pipe.GlobalId)
+        return index
+
+    def add(self, component, pipe_guid=None):
+        name = component.Name
+        guid = component.GlobalId
+        self.by_key[(name, guid)] = component
+        self.by_guid[guid] = component
+        self.by_name[name] = self.by_name.get(name, 0) + 1
+        self.pipe_of[guid] = pipe_guid
+
+    def __len__(self):
+        return len(self.by_guid)
+
+
+class MatchReport:
+    """
+    Результат сопоставления записей XLSX с компонентами IFC:
+      matched   – список (запись, компонент): совпали и имя, и GlobalId;
+      name_only – записи, имя которых есть в модели, но с другим GlobalId;
+      guid_only – записи, GlobalId которых есть в модели, но с другим именем;
+      unmatched – записи, не найденные ни по имени, ни по GlobalId.
+    """
+
+    def __init__(self):
+        self.matched = []
+        self.name_only = []
+        self.guid_only = []
+        self.unmatched = []
+
+    def summary(self, sample_size=20):
+        """Сводка для ответа API и истории: количества и первые записи каждой группы."""
+        def sample(records):
+            return [{"item_desc": r.item_desc, "user_tag": r.user_tag} for r in records[:sample_size]]
+
+        return {
+            "matched": len(self.matched),
+            "name_only": len(self.name_only),
+            "guid_only": len(self.guid_only),
+            "unmatched": len(self.unmatched),
+            "name_only_sample": sample(self.name_only),
+            "guid_only_sample": sample(self.guid_only),
+            "unmatched_sample": sample(self.unmatched),
+        }
+
+
+def match_records(index, records):
+    """
+    Хэш-соединение записей XLSX (AttributeRecord) с индексом компонентов за O(n).
+    Компоненты из matched передаются записи свойств напрямую, без by_guid.
+    """
+    report = MatchReport()
+    by_key = index.by_key
+    by_guid = index.by_guid
+    by_name = index.by_name
+    for record in records:
+        user_tag = str(record.user_tag)  # Ожидается GUID как строка
+        component = by_key.get((record.item_desc, user_tag))
+        if component is not None:
+            report.matched.append((record, component))
+        elif record.item_desc in by_name:
+            report.name_only.append(record)
+        elif user_tag in by_guid:
+            report.guid_only.append(record)
+        else:
+            report.unmatched.append(record)
+    return report
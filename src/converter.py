@@ -1,5 +1,24 @@
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from openpyxl import load_workbook
 
+from mapping import build_routers, get_compiled_mappings, get_mapping_path
+from result_cache import result_cache
+from template_cache import template_cache
+from utils import collect_results, skipped_result
+from xlsx_reader import iter_records
+
+# Версия результата для кэша результатов: увеличивается при изменениях,
+# после которых конвертация тех же входных файлов даёт другой файл
+RESULT_VERSION = 1
+
+# Лист ACCE для труб; его колонки описаны в assets/acce_mapping.json
+PIPE_SHEET = 'BPIPPIPE'
+
+
 def add_pipes(destination_sheet, source_sheet):
     row = 2
 
@@ -21,13 +40,130 @@ def add_pipes(destination_sheet, source_sheet):
 
     return 0
 
-def convert_psim_to_asse(psim_file, second_file, output_file):
-    workbook_dest = load_workbook(filename=psim_file)
-    workbook_src = load_workbook(filename=second_file)
 
-    destination_sheet = workbook_dest['BPIPPIPE']
-    source_sheet = workbook_src['Sheet2']
+def write_rows(sheet, first_row, columns, rows):
+    """
+    Записывает подготовленные строки в лист одним проходом, обращаясь к ячейкам
+    по числовым индексам (без разбора A1-адресов). None записывается явно,
+    чтобы результат совпадал с присваиванием sheet["X1"] = None.
+    """
+    cell = sheet.cell
+    for offset, values in enumerate(rows):
+        row = first_row + offset
+        for column, value in zip(columns, values):
+            cell(row=row, column=column).value = value
+    return len(rows)
+
+
+def fill_acce_sheets(workbook_dest, second_file, mappings=None):
+    """
+    Заполняет все листы ACCE из описания колонок за один проход по каждому
+    листу-источнику: строки распределяются по листам классификатором (SheetRouter),
+    после чего каждый лист записывается одной пачкой. Возвращает {лист ACCE: число строк}.
+    """
+    mappings = mappings or get_compiled_mappings()
+    counts = {}
+    for source_sheet, router in build_routers(mappings, workbook_dest.sheetnames).items():
+        # Выгрузка PSIM заканчивается первой строкой с пустой ключевой колонкой
+        source_rows = iter_records(second_file, router.source_columns, key=router.key_index,
+                                   sheet_name=source_sheet, min_row=router.source_first_row, blank_limit=0)
+        for sheet_name, rows in router.route(source_rows).items():
+            counts[sheet_name] = len(rows)
+            if not rows:
+                continue
+            if sheet_name not in workbook_dest.sheetnames:
+                raise KeyError(f"В шаблоне ACCE нет листа '{sheet_name}' для {len(rows)} строк")
+            mapping = mappings[sheet_name]
+            write_rows(workbook_dest[sheet_name], mapping.target_first_row, mapping.target_columns,
+                       mapping.transform(rows))
+    return counts
 
-    add_pipes(destination_sheet, source_sheet)
+
+def convert_psim_to_asse(psim_file, second_file, output_file, bulk=True, use_cache=True):
+    if use_cache:
+        workbook_dest = template_cache.get_workbook(psim_file)
+    else:
+        workbook_dest = load_workbook(filename=psim_file)
+
+    if bulk:
+        fill_acce_sheets(workbook_dest, second_file)
+    else:
+        workbook_src = load_workbook(filename=second_file)
+        add_pipes(workbook_dest[PIPE_SHEET], workbook_src['Sheet2'])
 
     workbook_dest.save(filename=output_file)
+
+
+def psim_result_key(psim_file, second_file):
+    """Ключ кэша результатов: шаблон, выгрузка и действующее описание колонок ACCE."""
+    return result_cache.safe_key("PSIM_TO_ACCE", RESULT_VERSION, [psim_file, second_file, get_mapping_path()])
+
+
+def convert_psim_cached(psim_file, second_file, output_file):
+    """
+    convert_psim_to_asse через кэш результатов: для уже конвертированных входных
+    файлов результат выдаётся из кэша. Возвращает способ выдачи из кэша или None.
+    """
+    def convert():
+        convert_psim_to_asse(psim_file, second_file, output_file)
+        return {}
+
+    return result_cache.run(psim_result_key(psim_file, second_file), output_file, convert)[1]
+
+
+# Снимок шаблона, переданный в процесс-обработчик пакетной конвертации
+_worker_template = None
+
+
+def _init_batch_worker(template_snapshot):
+    global _worker_template
+    _worker_template = template_snapshot
+
+
+def _convert_batch_item(second_file, output_file, template_snapshot=None):
+    """Конвертирует один файл пакета и возвращает результат с замером времени."""
+    start = time.perf_counter()
+    result = {"source": second_file, "output": output_file, "status": "success", "error": None}
+    try:
+        workbook_dest = pickle.loads(template_snapshot or _worker_template)
+        result["rows"] = fill_acce_sheets(workbook_dest, second_file)
+        workbook_dest.save(filename=output_file)
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def batch_output_path(second_file, output_folder):
+    name, _ = os.path.splitext(os.path.basename(second_file))
+    return os.path.join(output_folder, f"{name}_acce.xlsx")
+
+
+def convert_psim_batch(psim_file, second_files, output_folder, max_workers=None, cancelled=None):
+    """
+    Пакетная конвертация PSIM -> ACCE: один шаблон и N выгрузок Sheet2.
+    Шаблон разбирается один раз и передаётся в процессы пула в виде снимка,
+    файлы распределяются по ядрам процессора. Возвращает список результатов
+    по каждому файлу (source, output, status, error, seconds) в порядке second_files.
+    cancelled – функция без аргументов; когда она возвращает True, оставшиеся
+    файлы пропускаются со статусом cancelled.
+    Уже конвертированные файлы выдаются из кэша результатов (поле cached).
+    """
+    items = [(f, batch_output_path(f, output_folder)) for f in second_files]
+    keys = [psim_result_key(psim_file, f) for f in second_files]
+
+    def convert_items(jobs):
+        template_snapshot = template_cache.get_snapshot(psim_file)
+        workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+        if workers <= 1:
+            return [skipped_result(f, out) if cancelled and cancelled()
+                    else _convert_batch_item(f, out, template_snapshot)
+                    for f, out in jobs]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                 initargs=(template_snapshot,)) as pool:
+            futures = [pool.submit(_convert_batch_item, f, out) for f, out in jobs]
+            return collect_results(futures, jobs, cancelled)
+
+    return result_cache.run_batch(items, keys, convert_items)
@@ -0,0 +1,124 @@
+"""
+Локальное хранилище соответствий (тип, имя) -> GlobalId для переноса GUID между ревизиями IFC.
+
+Для каждого проекта хранится соответствие последней записанной ревизии (head) –
+результата process_ifc_files – и положения её элементов для сопоставления
+по положению. Если следующая ревизия переносится с этого же файла, старую модель
+не нужно открывать: соответствие и положения читаются из базы.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from utils import get_app_folder
+
+logger = logging.getLogger(__name__)
+
+STORE_FILE_NAME = "guid_store.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    project TEXT PRIMARY KEY,
+    head TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revisions (
+    sha256 TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    elements INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS guids (
+    project TEXT NOT NULL,
+    ifc_type TEXT NOT NULL,
+    named INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    global_id TEXT NOT NULL,
+    PRIMARY KEY (project, ifc_type, named, name)
+);
+CREATE TABLE IF NOT EXISTS positions (
+    project TEXT NOT NULL,
+    ifc_type TEXT NOT NULL,
+    global_id TEXT NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    z REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS positions_project ON positions (project);
+"""
+
+
+class GuidStore:
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        path = self.path or os.path.join(get_app_folder(), STORE_FILE_NAME)
+        conn = sqlite3.connect(path)
+        if not self._initialized:
+            with self._lock:
+                conn.executescript(_SCHEMA)
+                self._initialized = True
+        return conn
+
+    def project_for_head(self, sha256):
+        """Проект, последняя ревизия которого имеет содержимое sha256, или None."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT project FROM projects WHERE head = ?", (sha256,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def load_mapping(self, project):
+        """{(тип, имя или None): GlobalId} последней ревизии проекта."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT ifc_type, named, name, global_id FROM guids WHERE project = ?", (project,))
+            return {(ifc_type, name if named else None): global_id for ifc_type, named, name, global_id in rows}
+        finally:
+            conn.close()
+
+    def load_positions(self, project):
+        """[(тип, GlobalId, (x, y, z))] элементов последней ревизии проекта."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT ifc_type, global_id, x, y, z FROM positions WHERE project = ? ORDER BY rowid", (project,))
+            return [(ifc_type, global_id, (x, y, z)) for ifc_type, global_id, x, y, z in rows]
+        finally:
+            conn.close()
+
+    def save_revision(self, project, sha256, mapping, positions=()):
+        """
+        Делает ревизию sha256 последней для проекта и заменяет его соответствие
+        на mapping, а положения элементов – на positions. Элементы без GlobalId
+        (встречаются в некорректных выгрузках) пропускаются.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM guids WHERE project = ?", (project,))
+                conn.execute("DELETE FROM positions WHERE project = ?", (project,))
+                conn.executemany(
+                    "INSERT INTO positions (project, ifc_type, global_id, x, y, z) VALUES (?, ?, ?, ?, ?, ?)",
+                    ((project, ifc_type, global_id, x, y, z) for ifc_type, global_id, (x, y, z) in positions
+                     if global_id))
+                conn.executemany(
+                    "INSERT INTO guids (project, ifc_type, named, name, global_id) VALUES (?, ?, ?, ?, ?)",
+                    ((project, ifc_type, name is not None, name or "", global_id)
+                     for (ifc_type, name), global_id in mapping.items() if global_id))
+                conn.execute("INSERT OR REPLACE INTO projects (project, head) VALUES (?, ?)", (project, sha256))
+                conn.execute(
+                    "INSERT OR REPLACE INTO revisions (sha256, project, created_at, elements) VALUES (?, ?, ?, ?)",
+                    (sha256, project, datetime.now().isoformat(), len(mapping)))
+        finally:
+            conn.close()
+        logger.info(f"Сохранено соответствие GUID проекта {project}: {len(mapping)} элементов")
+
+
+guid_store = GuidStore()
@@ -1,6 +1,28 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import chain
+
 import ifcopenshell
 import ifcopenshell.guid
-import openpyxl
+
+from component_matcher import ComponentIndex, match_records
+from ifc_io import ifc_base_name, output_format, write_model
+from model_cache import model_cache
+from model_index import get_model_scan, resolve_matches, resolve_psets
+from progress import NULL_PROGRESS, ProgressReporter, forward_events
+from result_cache import result_cache
+from step_patch import StepPatch
+from utils import collect_results, skipped_result
+from xlsx_reader import iter_attribute_records
+
+# Версия результата для кэша результатов: увеличивается при изменениях,
+# после которых обновление тех же входных файлов даёт другой файл
+RESULT_VERSION = 3
+
+logger = logging.getLogger(__name__)
 
 def load_ifc_model(ifc_file_path):
     """Загружает IFC-модель из файла."""
@@ -10,26 +32,23 @@ def load_ifc_model(ifc_file_path):
     except Exception as e:
         return None
 
-def read_xlsx(file_path):
+def iter_xlsx(file_path):
     """
-    Читает Excel-файл и возвращает список словарей.
-    Ожидаемые колонки: Item Description, User Tag number, Pipe length, Pipe diameter.
+    Лениво читает Excel-файл атрибутов и выдаёт записи AttributeRecord
+    (item_desc, user_tag, length, diameter) по одной, не загружая книгу целиком.
+    Ошибка чтения завершает обход, как и в read_xlsx.
     """
     try:
-        wb = openpyxl.load_workbook(file_path)
-        ws = wb.active
-        data = []
-        for row in ws.iter_rows(min_row=11, values_only=True):  # Пропускаем заголовок
-            record = {
-                "item_desc": row[2],  # Название компонента
-                "user_tag": row[3],   # Ожидаемый GUID компонента
-                "length": row[14],    # Длина трубы в метрах
-                "diameter": row[15]   # Диаметр трубы в метрах
-            }
-            data.append(record)
-        return data
+        yield from iter_attribute_records(file_path)
     except Exception as e:
-        return []
+        return
+
+def read_xlsx(file_path):
+    """
+    Читает Excel-файл и возвращает список записей AttributeRecord.
+    Ожидаемые колонки: Item Description, User Tag number, Pipe length, Pipe diameter.
+    """
+    return list(iter_xlsx(file_path))
 
 def find_pipe_elements(ifc_file):
     """
@@ -42,50 +61,21 @@ def find_pipe_elements(ifc_file):
     except Exception as e:
         return []
 
-def extract_component_elements(pipe_elements):
-    """
-    Для каждого PIPE-элемента находит его компонентные элементы (IfcElementAssembly)
-    и возвращает словарь вида:
-        {Item Description: GUID}
-    где ключ – имя компонента, а значение – его GlobalId.
-    """
-    comp_map = {}
-    for pipe in pipe_elements:
-        for rel in getattr(pipe, "IsDecomposedBy", []):
-            for comp in getattr(rel, "RelatedObjects", []):
-                if comp.is_a("IfcElementAssembly"):
-                    comp_name = comp.Name
-                    comp_map[comp_name] = comp.GlobalId
-    return comp_map
-
-def update_ifc_properties(ifc_file, comp_map, xlsx_data):
-    """
-    Для каждой записи из XLSX ищет компонент, у которого:
-      - Имя совпадает с Item Description
-      - GlobalId совпадает с User Tag number
-    Если такой компонент найден, к нему добавляются/обновляются свойства:
-      - PipeLength (значение из столбца Pipe length * 1000, перевод в мм)
-      - PipeDiameter (значение из столбца Pipe diameter * 1000, перевод в мм)
-    """
-    for record in xlsx_data:
-        item_desc = record["item_desc"]
-        user_tag = str(record["user_tag"])  # Ожидается GUID как строка
-        length = record["length"]
-        diameter = record["diameter"]
-
-        if item_desc in comp_map:
-            actual_guid = comp_map[item_desc]
-            if str(actual_guid) == user_tag:
-                component = ifc_file.by_guid(actual_guid)
-                if component:
-                    converted_length = length * 1000 if length is not None else None
-                    converted_diameter = diameter if diameter is not None else None
-                    update_or_create_property(ifc_file, component, "PipeLength", converted_length)
-                    update_or_create_property(ifc_file, component, "PipeDiameter", converted_diameter)
-            else:
-                pass
-        else:
-            pass
+def convert_pipe_values(length, diameter):
+    """Переводит длину трубы из метров в мм; диаметр переносится как есть."""
+    converted_length = length * 1000 if length is not None else None
+    converted_diameter = diameter if diameter is not None else None
+    return converted_length, converted_diameter
+
+def apply_matches(report, session):
+    """
+    Записывает PipeLength и PipeDiameter для сопоставленных компонентов MatchReport.
+    Компоненты уже получены из индекса, повторный поиск by_guid не нужен.
+    """
+    for record, component in report.matched:
+        converted_length, converted_diameter = convert_pipe_values(record.length, record.diameter)
+        session.set_property(component, "PipeLength", converted_length)
+        session.set_property(component, "PipeDiameter", converted_diameter)
 
 def wrap_ifc_value(ifc_file, val):
     """
@@ -116,53 +106,89 @@ def get_length_unit(ifc_file):
             continue
     return ifc_file.create_entity("IfcSIUnit", UnitType="LENGTHUNIT", Name="METRE", Prefix=None)
 
-def update_or_create_property(ifc_file, element, prop_name, prop_value):
-    """
-    Добавляет или обновляет свойство в PropertySet для элемента.
-    Если PropertySet 'Pset_PipeProperties' отсутствует, создаётся новый.
-    Значение свойства оборачивается с помощью wrap_ifc_value.
-    Для Unit используется экземпляр IfcSIUnit, полученный через get_length_unit.
-    При добавлении нового свойства, HasProperties обновляется через преобразование кортежа в список.
-    """
-    pset_name = "Pset_PipeProperties"
-    existing_pset = None
-    for rel in getattr(element, "IsDefinedBy", []):
-        if (rel.is_a("IfcRelDefinesByProperties") and 
-            rel.RelatingPropertyDefinition.is_a("IfcPropertySet") and 
-            rel.RelatingPropertyDefinition.Name == pset_name):
-            existing_pset = rel.RelatingPropertyDefinition
-            break
-
-    if not existing_pset:
-        existing_pset = ifc_file.create_entity("IfcPropertySet",
-                                               Name=pset_name,
-                                               Description=None,
-                                               HasProperties=())
-        ifc_file.create_entity("IfcRelDefinesByProperties",
-                               Name=None,
-                               Description=None,
-                               RelatedObjects=[element],
-                               RelatingPropertyDefinition=existing_pset)
-
-    existing_property = None
-    for prop in existing_pset.HasProperties:
-        if prop.Name == prop_name:
-            existing_property = prop
-            break
-
-    wrapped_value = wrap_ifc_value(ifc_file, prop_value)
-    length_unit = get_length_unit(ifc_file)
-    if existing_property:
-        existing_property.NominalValue = wrapped_value
-    else:
-        new_property = ifc_file.create_entity("IfcPropertySingleValue",
+class PropertyWriterSession:
+    """
+    Сессия записи свойств в одну IFC-модель.
+
+    Единица длины определяется один раз, существующие PropertySet 'Pset_PipeProperties'
+    и их свойства индексируются по элементам одним проходом по IfcRelDefinesByProperties.
+    Вызовы set_property только накапливают изменения; flush применяет их разом,
+    пересобирая HasProperties каждого набора свойств один раз.
+    """
+
+    def __init__(self, ifc_file, pset_name="Pset_PipeProperties", psets=None):
+        self.ifc_file = ifc_file
+        self.pset_name = pset_name
+        self._length_unit = None
+        self._psets = psets  # id элемента -> IfcPropertySet (None – проиндексировать при flush)
+        self._pending = {}  # id элемента -> (элемент, {имя свойства: значение})
+
+    @property
+    def length_unit(self):
+        if self._length_unit is None:
+            self._length_unit = get_length_unit(self.ifc_file)
+        return self._length_unit
+
+    def _index_psets(self):
+        psets = {}
+        for rel in self.ifc_file.by_type("IfcRelDefinesByProperties"):
+            definition = rel.RelatingPropertyDefinition
+            if not (definition and definition.is_a("IfcPropertySet") and definition.Name == self.pset_name):
+                continue
+            for obj in rel.RelatedObjects or ():
+                psets.setdefault(obj.id(), definition)
+        return psets
+
+    def set_property(self, element, prop_name, prop_value):
+        """Запоминает значение свойства; в модель оно попадёт при flush."""
+        _, props = self._pending.setdefault(element.id(), (element, {}))
+        props[prop_name] = prop_value
+
+    def flush(self):
+        """Применяет накопленные изменения. Возвращает число обновлённых элементов."""
+        if not self._pending:
+            return 0
+        if self._psets is None:
+            self._psets = self._index_psets()
+
+        ifc_file = self.ifc_file
+        for element_id, (element, props) in self._pending.items():
+            pset = self._psets.get(element_id)
+            if pset is None:
+                pset = ifc_file.create_entity("IfcPropertySet",
+                                              Name=self.pset_name,
+                                              Description=None,
+                                              HasProperties=())
+                ifc_file.create_entity("IfcRelDefinesByProperties",
+                                       Name=None,
+                                       Description=None,
+                                       RelatedObjects=[element],
+                                       RelatingPropertyDefinition=pset)
+                self._psets[element_id] = pset
+
+            existing = list(pset.HasProperties) if pset.HasProperties else []
+            by_name = {prop.Name: prop for prop in existing}
+            added = False
+            for prop_name, prop_value in props.items():
+                wrapped_value = wrap_ifc_value(ifc_file, prop_value)
+                prop = by_name.get(prop_name)
+                if prop is not None:
+                    prop.NominalValue = wrapped_value
+                    continue
+                prop = ifc_file.create_entity("IfcPropertySingleValue",
                                               Name=prop_name,
                                               Description=None,
                                               NominalValue=wrapped_value,
-                                              Unit=length_unit)
-        props_list = list(existing_pset.HasProperties) if existing_pset.HasProperties else []
-        props_list.append(new_property)
-        existing_pset.HasProperties = tuple(props_list)
+                                              Unit=self.length_unit)
+                existing.append(prop)
+                by_name[prop_name] = prop
+                added = True
+            if added:
+                pset.HasProperties = tuple(existing)
+
+        updated = len(self._pending)
+        self._pending = {}
+        return updated
 
 def fix_cyrillic_header(ifc_file):
     """
@@ -200,19 +226,223 @@ def fix_cyrillic_header(ifc_file):
     except Exception as e:
         pass
 
-def convert_excel_to_ifc(ifc_model, exceltab, output):
-    ifc_file = load_ifc_model(ifc_model)
-    if ifc_file is None:
-        return
+def _records_or_none(xlsx_data, exceltab):
+    """Итератор по записям атрибутов или None, если записей нет."""
+    if xlsx_data is None:
+        xlsx_data = iter_xlsx(exceltab)
+    else:
+        xlsx_data = iter(xlsx_data)
+    first_record = next(xlsx_data, None)
+    if first_record is None:
+        return None
+    return chain([first_record], xlsx_data)
 
-    xlsx_data = read_xlsx(exceltab)
-    if not xlsx_data:
-        return
+def _update_match_stage(stage, report):
+    stage.update(processed=len(report.matched),
+                 total=len(report.matched) + len(report.name_only) + len(report.guid_only) + len(report.unmatched),
+                 force=True)
+
+def _update_write_stage(stage, output):
+    try:
+        stage.update(bytes_written=os.path.getsize(output), force=True)
+    except OSError:
+        pass
+
+def scan_matches_model(scan, ifc_file):
+    """
+    Проверяет, что индекс модели (StepScan) описывает ту же модель, что разобрал
+    ifcopenshell: совпадает число IfcElementAssembly, и каждый компонент индекса
+    под своим номером – IfcElementAssembly с тем же GlobalId и именем.
+    Пустой индекс не считается подтверждённым.
+    """
+    components = scan.component_index().by_guid.values()
+    if not components or scan.assembly_count != len(ifc_file.by_type("IfcElementAssembly")):
+        return False
+    by_id = ifc_file.by_id
+    for component in components:
+        try:
+            entity = by_id(component.id)
+        except RuntimeError:
+            return False
+        if (not entity.is_a("IfcElementAssembly") or entity.GlobalId != component.GlobalId
+                or entity.Name != component.Name):
+            return False
+    return True
+
+def convert_excel_to_ifc_patch(ifc_model, exceltab, output, xlsx_data=None, progress=None):
+    """
+    Вариант convert_excel_to_ifc без загрузки модели в ifcopenshell: исходный STEP-файл
+    сканируется потоково, затем копируется побайтно с переписанными изменёнными строками
+    и дописанными в конец новыми IfcPropertySet, IfcPropertySingleValue и
+    IfcRelDefinesByProperties (номера выше максимального номера файла).
+    Возвращает MatchReport или None, как convert_excel_to_ifc.
+    """
+    progress = progress or NULL_PROGRESS
+    with progress.stage("scan") as stage:
+        try:
+            scan = get_model_scan(ifc_model)
+        except Exception:
+            logger.exception(f"Не удалось просканировать IFC-модель {ifc_model}")
+            return None
+        stage.update(processed=len(scan.assemblies), force=True)
+
+    xlsx_data = _records_or_none(xlsx_data, exceltab)
+    if xlsx_data is None:
+        return None
+
+    with progress.stage("match") as stage:
+        report = match_records(scan.component_index(), xlsx_data)
+        _update_match_stage(stage, report)
+    with progress.stage("apply") as stage:
+        patch = StepPatch(scan)
+        for record, component in report.matched:
+            converted_length, converted_diameter = convert_pipe_values(record.length, record.diameter)
+            patch.set_properties(component.id, {"PipeLength": converted_length, "PipeDiameter": converted_diameter})
+        stage.update(processed=len(report.matched), force=True)
+
+    with progress.stage("write") as stage:
+        patch.write(ifc_model, output)
+        _update_write_stage(stage, output)
+    return report
+
+def convert_excel_to_ifc(ifc_model, exceltab, output, xlsx_data=None, patch=False, progress=None, refill=True):
+    """
+    Обновляет свойства компонентов IFC-модели по файлу атрибутов и сохраняет результат.
+    xlsx_data – уже прочитанные записи атрибутов (тогда exceltab не читается);
+    patch – записать изменения потоково, не разбирая модель (convert_excel_to_ifc_patch).
+    progress – ProgressReporter для событий по этапам (load, scan, match, apply, write).
+    refill – вернуть в кэш моделей свежую копию модели (см. ModelCache.lease).
+    Возвращает MatchReport сопоставления записей с компонентами, если файл записан,
+    и None, если модель не загрузилась или нет данных.
+    """
+    progress = progress or NULL_PROGRESS
+    if patch:
+        return convert_excel_to_ifc_patch(ifc_model, exceltab, output, xlsx_data, progress)
+
+    xlsx_data = _records_or_none(xlsx_data, exceltab)
+    if xlsx_data is None:
+        return None
+
+    # Модель берётся из кэша разобранных моделей в собственность и после записи
+    # отбрасывается; в кэш при refill возвращается заново разобранная копия
+    with ExitStack() as stack:
+        with progress.stage("load"):
+            try:
+                ifc_file = stack.enter_context(model_cache.lease(ifc_model, refill=refill))
+            except Exception:
+                logger.exception(f"Не удалось загрузить IFC-модель {ifc_model}")
+                return None
+
+        # Компоненты и их наборы свойств берутся из индекса модели, без обхода связей;
+        # если индекс не сходится с разобранной моделью, компоненты ищутся обходом связей
+        with progress.stage("scan") as stage:
+            try:
+                scan = get_model_scan(ifc_model)
+                stage.update(processed=len(scan.assemblies), force=True)
+            except Exception:
+                logger.exception(f"Не удалось построить индекс модели {ifc_model}")
+                scan = None
+            if scan is not None and not scan_matches_model(scan, ifc_file):
+                logger.warning(f"Индекс модели {ifc_model} не совпадает с моделью, компоненты ищутся обходом связей")
+                scan = None
+        with progress.stage("match") as stage:
+            if scan is not None:
+                report = resolve_matches(match_records(scan.component_index(), xlsx_data), ifc_file)
+                session = PropertyWriterSession(ifc_file, psets=resolve_psets(scan, ifc_file))
+            else:
+                report = match_records(ComponentIndex.from_pipes(find_pipe_elements(ifc_file)), xlsx_data)
+                session = PropertyWriterSession(ifc_file)
+            _update_match_stage(stage, report)
+        with progress.stage("apply") as stage:
+            apply_matches(report, session)
+            stage.update(processed=session.flush(), force=True)
+
+        with progress.stage("write") as stage:
+            fix_cyrillic_header(ifc_file)
+            write_model(ifc_file, output)
+            _update_write_stage(stage, output)
+    return report
+
+
+def ifc_output_path(ifc_file, output_folder, compress=False):
+    """{имя}_updated.ifc или, при compress, {имя}_updated.ifczip – независимо от сжатия входного файла."""
+    ext = ".ifczip" if compress else ".ifc"
+    return os.path.join(output_folder, f"{ifc_base_name(ifc_file)}_updated{ext}")
+
+
+# Записи атрибутов и очередь событий хода, переданные в процесс-обработчик пакетного обновления IFC
+_worker_records = None
+_worker_events = None
+
+
+def _init_ifc_worker(records, events=None):
+    global _worker_records, _worker_events
+    _worker_records = records
+    _worker_events = events
+
+
+def _convert_ifc_item(ifc_file, output_file, records=None, patch=False, progress=None, refill=True):
+    """Обрабатывает одну IFC-модель пакета и возвращает результат с замером времени."""
+    start = time.perf_counter()
+    result = {"source": ifc_file, "output": output_file, "status": "success", "error": None}
+    if progress is None:
+        progress = ProgressReporter(_worker_events.put if _worker_events is not None else None)
+    progress = progress.for_source(ifc_file)
+    try:
+        with progress.stage("file") as stage:
+            report = convert_excel_to_ifc(ifc_file, None, output_file,
+                                          xlsx_data=records if records is not None else _worker_records,
+                                          patch=patch, progress=progress, refill=refill)
+            if report is not None:
+                _update_write_stage(stage, output_file)
+        if report is None:
+            result["status"] = "error"
+            result["error"] = "Не удалось загрузить IFC-модель или файл атрибутов пуст"
+        else:
+            result["match"] = report.summary()
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def convert_excel_to_ifc_batch(ifc_files, exceltab, output_folder, max_workers=None, patch=False, compress=False,
+                               cancelled=None, progress=None, refill=True):
+    """
+    Обновляет несколько IFC-моделей по одному файлу атрибутов.
+    Файл атрибутов читается один раз и передаётся в процессы пула, каждая модель
+    обрабатывается в отдельном процессе. Возвращает список результатов по файлам
+    (source, output, status, error, seconds, match) в порядке ifc_files.
+    compress – сохранять результаты в ifcZIP.
+    cancelled – функция без аргументов; когда она возвращает True, оставшиеся
+    модели пропускаются со статусом cancelled.
+    progress – ProgressReporter; события этапов каждой модели (в том числе
+    из процессов пула) приходят с source – путём к модели.
+    Модели, уже обновлённые по тем же атрибутам, выдаются из кэша результатов (поле cached).
+    refill – возвращать модели в кэш моделей этого процесса; процессы пула его не
+    заполняют, они завершаются вместе с пулом.
+    """
+    progress = progress or NULL_PROGRESS
+    items = [(f, ifc_output_path(f, output_folder, compress)) for f in ifc_files]
+    keys = [result_cache.safe_key("IFC_UPDATE", RESULT_VERSION, [f, exceltab], dict(output_format(out), patch=patch))
+            for f, out in items]
+
+    def convert_items(jobs):
+        with progress.stage("read_attributes") as stage:
+            records = read_xlsx(exceltab)
+            stage.update(processed=len(records), force=True)
+
+        workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+        if workers <= 1:
+            return [skipped_result(f, out) if cancelled and cancelled()
+                    else _convert_ifc_item(f, out, records, patch, progress, refill)
+                    for f, out in jobs]
+
+        with forward_events(progress) as events, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_ifc_worker,
+                                    initargs=(records, events)) as pool:
+            futures = [pool.submit(_convert_ifc_item, f, out, None, patch, None, False) for f, out in jobs]
+            return collect_results(futures, jobs, cancelled)
 
-    pipe_elements = find_pipe_elements(ifc_file)
-    comp_map = extract_component_elements(pipe_elements)
-    update_ifc_properties(ifc_file, comp_map, xlsx_data)
-    
-    fix_cyrillic_header(ifc_file)
-    
-    ifc_file.write(output)
+    return result_cache.run_batch(items, keys, convert_items)
@@ -0,0 +1,135 @@
+"""
+Чтение и запись IFC (STEP) в сжатом виде: ifcZIP (zip с одним .ifc внутри) и gzip (.ifc.gz).
+
+Потоки open_ifc_stream и open_ifc_output сжимают и распаковывают блоками. open_model
+и write_model не пишут временный несжатый .ifc на диск: на время разбора или записи
+сжатой модели её несжатый текст держится в памяти рядом с самой моделью.
+Формат определяется по расширению, а для входных файлов – ещё и по сигнатуре,
+поэтому сжатый файл с расширением .ifc тоже открывается.
+"""
+import gzip
+import os
+import zipfile
+from contextlib import contextmanager
+
+import ifcopenshell
+
+IFCZIP_SUFFIXES = (".ifczip", ".zip")
+GZIP_SUFFIXES = (".gz",)
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_ZIP_MAGIC = b"PK\x03\x04"
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def compression_of(path, sniff=True):
+    """'zip', 'gzip' или None – по расширению, а для существующего файла и по сигнатуре."""
+    lower = path.lower()
+    if lower.endswith(IFCZIP_SUFFIXES):
+        return "zip"
+    if lower.endswith(GZIP_SUFFIXES):
+        return "gzip"
+    if sniff and os.path.isfile(path):
+        with open(path, "rb") as f:
+            magic = f.read(4)
+        if magic.startswith(_ZIP_MAGIC):
+            return "zip"
+        if magic.startswith(_GZIP_MAGIC):
+            return "gzip"
+    return None
+
+
+def ifc_base_name(path):
+    """Имя файла без расширений IFC и сжатия: model.ifc.gz -> model."""
+    name = os.path.basename(path)
+    lower = name.lower()
+    for suffix in IFCZIP_SUFFIXES + GZIP_SUFFIXES + (".ifc",):
+        if lower.endswith(suffix):
+            name = name[:-len(suffix)]
+            lower = name.lower()
+    return name
+
+
+def as_ifczip_path(path):
+    """Путь с расширением .ifczip вместо .ifc/.ifc.gz; уже сжатый ifcZIP не меняется."""
+    if compression_of(path, sniff=False) == "zip":
+        return path
+    return os.path.join(os.path.dirname(path), ifc_base_name(path) + ".ifczip")
+
+
+def output_format(path):
+    """Формат выходного файла для ключа кэша результатов: сжатие и, для ifcZIP, имя файла в архиве."""
+    compression = compression_of(path, sniff=False)
+    return {"compression": compression, "member": ifc_base_name(path) if compression == "zip" else None}
+
+
+def _zip_member(archive, path):
+    for info in archive.infolist():
+        if info.filename.lower().endswith(".ifc"):
+            return info
+    raise LookupError(f"В архиве {path} нет файла .ifc")
+
+
+@contextmanager
+def open_ifc_stream(path):
+    """Бинарный поток STEP-текста модели, сжатой или нет."""
+    compression = compression_of(path)
+    if compression == "zip":
+        with zipfile.ZipFile(path) as archive:
+            with archive.open(_zip_member(archive, path)) as f:
+                yield f
+    elif compression == "gzip":
+        with gzip.open(path, "rb") as f:
+            yield f
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+
+@contextmanager
+def open_ifc_output(path, like=None):
+    """
+    Бинарный поток для записи STEP-текста; сжатие выбирается по расширению path
+    (или like – например, для временного файла рядом с результатом).
+    """
+    like = like or path
+    compression = compression_of(like, sniff=False)
+    if compression == "zip":
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(ifc_base_name(like) + ".ifc", "w", force_zip64=True) as f:
+                yield f
+    elif compression == "gzip":
+        with gzip.open(path, "wb", compresslevel=6) as f:
+            yield f
+    else:
+        with open(path, "wb") as f:
+            yield f
+
+
+def open_model(path):
+    """
+    Открывает IFC-модель через ifcopenshell. Сжатый файл распаковывается потоково
+    в память и разбирается из строки (ifcopenshell.file.from_string), без временного
+    .ifc на диске: на время разбора к памяти модели добавляется несжатый текст.
+    STEP-текст – ASCII, поэтому latin-1 переводит байты в символы один к одному.
+    """
+    if compression_of(path) is None:
+        return ifcopenshell.open(path)
+    with open_ifc_stream(path) as src:
+        text = src.read().decode("latin-1")
+    return ifcopenshell.file.from_string(text)
+
+
+def write_model(model, path):
+    """
+    Записывает модель; для .ifczip/.gz текст модели (model.to_string) сжимается
+    потоково, блоками, без временного несжатого файла на диске. Пока идёт запись,
+    в памяти дополнительно держится текст модели.
+    """
+    if compression_of(path, sniff=False) is None:
+        model.write(path)
+        return
+    text = model.to_string()
+    with open_ifc_output(path) as dst:
+        for start in range(0, len(text), COPY_CHUNK_SIZE):
+            dst.write(text[start:start + COPY_CHUNK_SIZE].encode("latin-1"))
@@ -1,61 +1,244 @@
 #!/usr/bin/env python3
-import sys
-import tempfile
+import os
+from contextlib import ExitStack
+
 import ifcopenshell
 import ifcopenshell.geom
 
+from guid_store import guid_store
+from ifc_io import output_format, write_model
+from model_cache import model_cache
+from progress import NULL_PROGRESS
+from result_cache import result_cache
+from spatial_matcher import DEFAULT_MATCH_TOLERANCE_M, PlacementResolver, collect_positions, match_by_position
+from utils import file_content_key, get_setting
+
+# Версия результата для кэша результатов: увеличивается при изменениях,
+# после которых перенос между теми же файлами даёт другой файл
+RESULT_VERSION = 1
+
 # Типы, учитываемые при переносе GUID
 EXCEPTION_TYPES = {"IfcProject", "IfcSite", "IfcBuilding"}
 
 # -------------------
-# Сбор старых элементов для замены GUID
+# Сбор элементов для замены GUID
 # -------------------
-def collect_old_elements(old_ifc):
-    old_elements = {}
+def iter_rooted_elements(ifc_file):
+    """
+    Выдаёт (ключ (тип, имя), элемент) для всех сущностей IfcRoot. Ключ есть у элементов
+    с именем и у первого безымянного элемента каждого из EXCEPTION_TYPES; у остальных
+    безымянных он None – их можно сопоставить только по положению.
+    by_type перебирает сущности по типам в порядке номеров, поэтому первый элемент
+    с данным ключом – первый в файле.
+    """
     seen_exceptions = set()
-    for element in old_ifc:
-        if not hasattr(element, "GlobalId"): continue
+    for element in ifc_file.by_type("IfcRoot"):
         etype = element.is_a()
-        name = getattr(element, "Name", None)
-        if name is None and etype not in EXCEPTION_TYPES:
-            continue
-        if name is None and etype in EXCEPTION_TYPES:
-            if etype in seen_exceptions: continue
+        name = element.Name
+        if name is None:
+            if etype not in EXCEPTION_TYPES or etype in seen_exceptions:
+                yield None, element
+                continue
             seen_exceptions.add(etype)
-        key = (etype, name)
-        old_elements.setdefault(key, element)
-    return old_elements
+        yield (etype, name), element
+
+def collect_guid_mapping(ifc_file):
+    """{(тип, имя): GlobalId} первого элемента с каждым ключом."""
+    mapping = {}
+    for key, element in iter_rooted_elements(ifc_file):
+        if key is not None:
+            mapping.setdefault(key, element.GlobalId)
+    return mapping
+
+def project_guid(ifc_file):
+    projects = ifc_file.by_type("IfcProject")
+    return projects[0].GlobalId if projects else None
 
 # -------------------
 # Обновление GUID элементов нового файла (in-memory)
 # -------------------
-def update_all_guids(old_ifc, new_ifc):
-    old_elements = collect_old_elements(old_ifc)
-    seen_exceptions_new = set()
-    to_update = []
-    for el in new_ifc:
-        if not hasattr(el, "GlobalId"): continue
-        etype = el.is_a()
-        name = getattr(el, "Name", None)
-        if name is None and etype not in EXCEPTION_TYPES:
-            continue
-        if name is None and etype in EXCEPTION_TYPES:
-            if etype in seen_exceptions_new: continue
-            seen_exceptions_new.add(etype)
-        to_update.append(el)
-
-    updated = 0
-    for el in to_update:
-        key = (el.is_a(), getattr(el, "Name", None))
-        if key in old_elements:
-            el.GlobalId = old_elements[key].GlobalId
-            updated += 1
-    print(f"GUIDs updated: {updated}/{len(to_update)}")
+def apply_guid_mapping(mapping, new_ifc, old_positions=(), tolerance=None, resolver=None):
+    """
+    Присваивает элементам new_ifc GlobalId старой ревизии в два этапа:
+      1. по ключу (тип, имя) из mapping – если ключ в новом файле единственный;
+      2. оставшимся размещённым IfcProduct (безымянным, переименованным, с повторяющимся
+         ключом) – по положению среди old_positions, чьи GlobalId ещё не выданы.
+    Возвращает (элементы с ключом, {"by_name": n1, "by_position": n2, "elements": всего IfcRoot}).
+    """
+    if tolerance is None:
+        tolerance = float(get_setting("guid_match_tolerance_m", DEFAULT_MATCH_TOLERANCE_M))
+    keyed = []
+    unkeyed = []
+    counts = {}
+    for key, el in iter_rooted_elements(new_ifc):
+        if key is None:
+            unkeyed.append(el)
+        else:
+            keyed.append((key, el))
+            counts[key] = counts.get(key, 0) + 1
+
+    used = set()
+    leftovers = []
+    by_name = 0
+    for key, el in keyed:
+        global_id = mapping.get(key) if counts[key] == 1 else None
+        if global_id is not None:
+            el.GlobalId = global_id
+            used.add(global_id)
+            by_name += 1
+        else:
+            leftovers.append(el)
+    leftovers.extend(unkeyed)
+
+    by_position = 0
+    candidates = [item for item in old_positions if item[1] not in used]
+    if candidates:
+        resolver = resolver or PlacementResolver(new_ifc)
+        new_items = []
+        for el in leftovers:
+            if el.is_a("IfcProduct"):
+                position = resolver.position(el)
+                if position is not None:
+                    new_items.append((el.is_a(), el, position))
+        for el, global_id in match_by_position(new_items, candidates, tolerance):
+            el.GlobalId = global_id
+            by_position += 1
+
+    total = len(keyed) + len(unkeyed)
+    print(f"GUIDs updated: {by_name + by_position}/{total} (by name: {by_name}, by position: {by_position})")
+    return [el for _, el in keyed], {"by_name": by_name, "by_position": by_position, "elements": total}
+
+# -------------------
+# Прозрачность элемента по графу стилей (без построения геометрии)
+# -------------------
+_UNRESOLVED = object()  # стиль не найден – прозрачность определяется по геометрии
+
+
+class TransparencyResolver:
+    """
+    Определяет прозрачность первого материала формы элемента так же, как
+    ifcopenshell.geom.create_shape, но без триангуляции: по IfcStyledItem
+    элементов представления (в том числе внутри IfcRepresentationMap),
+    затем по стилю материала элемента или его типа.
+    Результаты запоминаются для стилей, материалов и IfcRepresentationMap,
+    поэтому однотипные фитинги разрешаются один раз. Геометрия строится только
+    для элементов, стиль которых по графу найти не удалось.
+    Возвращает прозрачность (0..1) или None, если материал непрозрачный.
+    """
+
+    def __init__(self):
+        self._styles = {}  # id стиля -> прозрачность или None
+        self._maps = {}  # id IfcRepresentationMap -> результат
+        self._materials = {}  # id материала -> результат
+        self._settings = None
+
+    def __call__(self, element):
+        try:
+            result = self._from_representation(element)
+            if result is _UNRESOLVED:
+                result = self._from_material(element)
+        except Exception:
+            result = _UNRESOLVED
+        if result is _UNRESOLVED:
+            result = self._from_geometry(element)
+        return result
+
+    def _from_representation(self, element):
+        representations = element.Representation.Representations or ()
+        body = [r for r in representations if r.RepresentationIdentifier == "Body"]
+        for representation in body or representations[:1]:
+            for item in representation.Items or ():
+                return self._item(item)
+        return _UNRESOLVED
+
+    def _item(self, item):
+        for styled_item in getattr(item, "StyledByItem", None) or ():
+            result = self._styled_item(styled_item)
+            if result is not _UNRESOLVED:
+                return result
+        if item.is_a("IfcMappedItem"):
+            return self._map(item.MappingSource)
+        if item.is_a("IfcBooleanResult"):
+            return self._item(item.FirstOperand)
+        return _UNRESOLVED
+
+    def _map(self, representation_map):
+        map_id = representation_map.id()
+        if map_id not in self._maps:
+            result = _UNRESOLVED
+            for item in representation_map.MappedRepresentation.Items or ():
+                result = self._item(item)
+                break
+            self._maps[map_id] = result
+        return self._maps[map_id]
+
+    def _styled_item(self, styled_item):
+        for style in styled_item.Styles or ():
+            # IFC2X3: стили обёрнуты в IfcPresentationStyleAssignment
+            nested = style.Styles if style.is_a("IfcPresentationStyleAssignment") else (style,)
+            for surface_style in nested:
+                if surface_style.is_a("IfcSurfaceStyle"):
+                    return self._surface_style(surface_style)
+        return _UNRESOLVED
+
+    def _surface_style(self, surface_style):
+        style_id = surface_style.id()
+        if style_id not in self._styles:
+            transparency = None
+            for element in surface_style.Styles or ():
+                if element.is_a("IfcSurfaceStyleShading"):
+                    transparency = getattr(element, "Transparency", None)
+                    break
+            self._styles[style_id] = transparency
+        return self._styles[style_id]
+
+    def _from_material(self, element):
+        relating = []
+        for holder in [element] + [rel.RelatingType for rel in getattr(element, "IsTypedBy", None) or ()]:
+            for rel in getattr(holder, "HasAssociations", None) or ():
+                if rel.is_a("IfcRelAssociatesMaterial"):
+                    relating.append(rel.RelatingMaterial)
+        for material in relating:
+            if not material.is_a("IfcMaterial"):
+                continue
+            material_id = material.id()
+            if material_id not in self._materials:
+                result = _UNRESOLVED
+                for definition in getattr(material, "HasRepresentation", None) or ():
+                    for representation in definition.Representations or ():
+                        for styled_item in representation.Items or ():
+                            if styled_item.is_a("IfcStyledItem"):
+                                result = self._styled_item(styled_item)
+                                if result is not _UNRESOLVED:
+                                    break
+                        if result is not _UNRESOLVED:
+                            break
+                    if result is not _UNRESOLVED:
+                        break
+                self._materials[material_id] = result
+            if self._materials[material_id] is not _UNRESOLVED:
+                return self._materials[material_id]
+        return _UNRESOLVED
+
+    def _from_geometry(self, element):
+        if self._settings is None:
+            self._settings = ifcopenshell.geom.settings()
+        try:
+            shape = ifcopenshell.geom.create_shape(self._settings, element)
+        except Exception:
+            return None
+        mats = getattr(shape.geometry, 'materials', [])
+        if not mats:
+            return None
+        has_transparency = mats[0].has_transparency
+        if callable(has_transparency):
+            has_transparency = has_transparency()
+        return mats[0].transparency if has_transparency else None
 
 # -------------------
 # Модификация PropertySet и PipeFitting (in-memory)
 # -------------------
-def modify_property_set_names(ifc_file):
+def modify_property_set_names(ifc_file, stage=None):
     partial_pset = "AVEVA_Pset"
     modified = False
     # Обрезаем имена PropertySet
@@ -67,43 +250,124 @@ def modify_property_set_names(ifc_file):
     counts = {}
     for elem in ifc_file.by_type('IfcPipeFitting'):
         counts[elem.Name] = counts.get(elem.Name, 0) + 1
-    # Переименование PipeFitting
-    for elem in ifc_file.by_type('IfcPipeFitting'):
+    # Переименование PipeFitting: изоляция – полупрозрачный материал
+    transparency_of = TransparencyResolver()
+    fittings = ifc_file.by_type('IfcPipeFitting')
+    for index, elem in enumerate(fittings, 1):
+        if stage is not None:
+            stage.update(processed=index, total=len(fittings))
         # Пропускаем элементы без представления
         if not getattr(elem, 'Representation', None):
             continue
         # Только многократные имена
         if counts.get(elem.Name, 0) <= 1:
             continue
-        try:
-            settings = ifcopenshell.geom.settings()
-            shape = ifcopenshell.geom.create_shape(settings, elem)
-            mats = getattr(shape.geometry, 'materials', [])
-            if mats and mats[0].has_transparency:
-                t = mats[0].transparency
-                if 0 < t < 1 and not elem.Name.startswith("Insulation of"):
-                    elem.Name = f"Insulation of {elem.Name}"
-                    modified = True
-        except Exception:
-            # Если не удалось создать форму, пропускаем
+        if not elem.Name or elem.Name.startswith("Insulation of"):
             continue
+        t = transparency_of(elem)
+        if t is not None and 0 < t < 1:
+            elem.Name = f"Insulation of {elem.Name}"
+            modified = True
     print("PropertySet and PipeFitting modifications applied" if modified else "No modifications applied.")
 
 # -------------------
 # Функция объединенной обработки
 # -------------------
-def process_ifc_files(old_path: str, new_path: str, output_path: str) -> None:
+def process_ifc_files(old_path: str, new_path: str, output_path: str, store=None, progress=None,
+                      refill=True) -> dict:
     """
     Выполняет два шага подряд:
       1. Обновление GUID из old_path в new_ifc
       2. Модификация имен PropertySet и PipeFitting
     Сохраняет результат в output_path.
+
+    Соответствие (тип, имя) -> GlobalId результата сохраняется в GuidStore. Если old_path –
+    последняя записанная ревизия проекта (совпадает SHA-256), старая модель не открывается.
+    Возвращает сводку: число обновлённых GUID (всего и по этапам), число элементов,
+    проект, источник соответствия и cached – способ выдачи из кэша результатов
+    (None, если перенос выполнялся). Результат из кэша тоже записывается ревизией
+    проекта, чтобы следующий перенос с него читал соответствие из GuidStore.
+    progress – ProgressReporter для событий по этапам (old_mapping, load, match_guids,
+    modify, write, save_revision).
+    refill – вернуть в кэш моделей свежую копию новой модели (см. ModelCache.lease).
     """
-    old_ifc = ifcopenshell.open(old_path)
-    new_ifc = ifcopenshell.open(new_path)
+    progress = progress or NULL_PROGRESS
+    tolerance = float(get_setting("guid_match_tolerance_m", DEFAULT_MATCH_TOLERANCE_M))
+    key = result_cache.safe_key("IFC_TRANSFER", RESULT_VERSION, [old_path, new_path],
+                                dict(output_format(output_path), tolerance=tolerance))
+    summary, cached = result_cache.run(
+        key, output_path,
+        lambda: _process_ifc_files(old_path, new_path, output_path, store, progress, tolerance, refill))
+    if cached:
+        print(f"Result served from cache ({cached}): {output_path}")
+        _save_cached_revision(store or guid_store, summary.get("project"), output_path, progress)
+    return dict(summary, cached=cached)
 
-    update_all_guids(old_ifc, new_ifc)
-    modify_property_set_names(new_ifc)
+def _save_cached_revision(store, project, output_path, progress):
+    """Записывает результат из кэша ревизией проекта, если она ещё не последняя."""
+    if project is None:
+        return
+    with progress.stage("save_revision") as stage:
+        try:
+            sha256 = file_content_key(output_path)[3]
+            if store.project_for_head(sha256) == project:
+                return
+            with model_cache.read_only(output_path) as output_ifc:
+                mapping = collect_guid_mapping(output_ifc)
+                positions = collect_positions(output_ifc)
+            store.save_revision(project, sha256, mapping, positions)
+            stage.update(processed=len(mapping), force=True)
+        except Exception as e:
+            print(f"GUID mapping not saved: {e}")
+
+def _process_ifc_files(old_path, new_path, output_path, store, progress, tolerance, refill=True):
+    store = store or guid_store
+    with progress.stage("old_mapping") as stage:
+        old_hash = file_content_key(old_path)[3]
+        project = store.project_for_head(old_hash)
+        if project is not None:
+            mapping = store.load_mapping(project)
+            old_positions = store.load_positions(project)
+            source = "store"
+        else:
+            with model_cache.read_only(old_path) as old_ifc:
+                mapping = collect_guid_mapping(old_ifc)
+                old_positions = collect_positions(old_ifc)
+                project = project_guid(old_ifc) or old_hash
+            source = "file"
+        stage.update(processed=len(mapping), force=True)
+
+    with ExitStack() as stack:
+        with progress.stage("load"):
+            new_ifc = stack.enter_context(model_cache.lease(new_path, refill=refill))
+        with progress.stage("match_guids") as stage:
+            resolver = PlacementResolver(new_ifc)
+            elements, matched = apply_guid_mapping(mapping, new_ifc, old_positions, tolerance, resolver)
+            stage.update(processed=matched["by_name"] + matched["by_position"], total=matched["elements"], force=True)
+        with progress.stage("modify") as stage:
+            modify_property_set_names(new_ifc, stage)
 
-    new_ifc.write(output_path)
+        with progress.stage("write") as stage:
+            write_model(new_ifc, output_path)
+            stage.update(bytes_written=os.path.getsize(output_path), force=True)
+        # Соответствие результата – с именами после переименования PipeFitting
+        output_mapping = {}
+        for el in elements:
+            output_mapping.setdefault((el.is_a(), el.Name), el.GlobalId)
+        output_positions = collect_positions(new_ifc, resolver)
+
+    with progress.stage("save_revision") as stage:
+        try:
+            store.save_revision(project, file_content_key(output_path)[3], output_mapping, output_positions)
+            stage.update(processed=len(output_mapping), force=True)
+        except Exception as e:
+            print(f"GUID mapping not saved: {e}")
     print(f"Processing complete. Final file saved to: {output_path}")
+    return {
+        "updated": matched["by_name"] + matched["by_position"],
+        "matched_by_name": matched["by_name"],
+        "matched_by_position": matched["by_position"],
+        "elements": matched["elements"],
+        "project": project,
+        "mapping_source": source,
+    }
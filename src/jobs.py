@@ -0,0 +1,251 @@
+"""
+Фоновые задания конвертации.
+
+Обработчики Flask ставят задание в очередь и сразу возвращают его id, не держа
+HTTP-соединение на всё время конвертации. Задания выполняются пулами потоков –
+отдельным для каждого типа задания, с ограничением числа одновременно
+выполняемых заданий (настройка job_concurrency). Пакеты внутри задания
+по-прежнему распределяются по процессам пулами конвертеров.
+
+Отмена: задание в очереди снимается сразу; у выполняющегося задания взводится
+флаг cancel_event, который пакетные конвертеры проверяют между файлами.
+Задания, которые флаг не проверяют (cancellable=False, одиночные конвертации),
+после запуска не отменяются – иначе результат и запись истории остались бы
+успешными, а задание считалось бы отменённым.
+
+Каждое задание накапливает события хода: смену статуса (stage "job") и этапы
+конвертеров (см. progress). Они нумеруются по порядку (seq), и подписчик
+может дождаться новых через wait_events – на этом построен поток SSE.
+Хранятся только последние MAX_JOB_EVENTS событий; событие завершения всегда
+последнее и не вытесняется. Завершённые задания удаляются через
+FINISHED_JOB_TTL_SECONDS или при превышении MAX_FINISHED_JOBS.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCESS = "success"
+JOB_ERROR = "error"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATUSES = (JOB_SUCCESS, JOB_ERROR, JOB_CANCELLED)
+
+# Число одновременно выполняемых заданий каждого типа; переопределяется
+# настройкой job_concurrency, например {"IFC_UPDATE": 2}
+DEFAULT_CONCURRENCY = {
+    "PSIM_TO_ACCE": 2,
+    "PSIM_TO_ACCE_BATCH": 1,
+    "IFC_UPDATE": 1,
+    "IFC_TRANSFER": 1,
+}
+
+# Сколько завершённых заданий хранить для запросов статуса и результата
+MAX_FINISHED_JOBS = 200
+
+# Сколько секунд завершённое задание доступно для запросов статуса и результата
+FINISHED_JOB_TTL_SECONDS = 3600
+
+# Сколько последних событий хода хранит задание
+MAX_JOB_EVENTS = 500
+
+
+class Job:
+    def __init__(self, job_type, description="", cancellable=True):
+        self.id = uuid.uuid4().hex
+        self.job_type = job_type
+        self.description = description
+        self.cancellable = cancellable
+        self.status = JOB_QUEUED
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.events = deque(maxlen=MAX_JOB_EVENTS)
+        self._next_seq = 0
+        self._created = time.perf_counter()
+        self._finished = None
+        self._events_changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def finished_for(self, now=None):
+        """Сколько секунд прошло с завершения задания (None, если оно не завершено)."""
+        if self._finished is None:
+            return None
+        return (now if now is not None else time.perf_counter()) - self._finished
+
+    def _append_event(self, event):
+        event = dict(event, seq=self._next_seq, job_id=self.id,
+                     time=round(time.perf_counter() - self._created, 3))
+        self._next_seq += 1
+        self.events.append(event)
+        self._events_changed.notify_all()
+
+    def add_event(self, event):
+        """
+        Добавляет событие этапа конвертации (sink для ProgressReporter).
+        После завершения задания события не принимаются: последним остаётся событие статуса.
+        """
+        with self._events_changed:
+            if not self.finished:
+                self._append_event(event)
+
+    def set_status(self, status, error=None):
+        with self._events_changed:
+            self.status = status
+            now = datetime.now().isoformat()
+            if status == JOB_RUNNING:
+                self.started_at = now
+            elif status in FINISHED_STATUSES:
+                self.finished_at = now
+                self.error = error
+                self._finished = time.perf_counter()
+            self._append_event({"stage": "job", "state": status, "error": error})
+
+    def wait_events(self, since, timeout=None):
+        """
+        События с номера since; если их ещё нет и задание не завершено, ждёт до timeout.
+        Вытесненные события пропускаются – выдача начинается с самого раннего хранимого.
+        Возвращает (события, задание завершено).
+        """
+        with self._events_changed:
+            if self._next_seq <= since and not self.finished:
+                self._events_changed.wait(timeout)
+            first = self._next_seq - len(self.events)
+            return list(islice(self.events, max(0, since - first), None)), self.finished
+
+    def to_dict(self, with_result=False):
+        data = {
+            "id": self.id,
+            "job_type": self.job_type,
+            "description": self.description,
+            "status": self.status,
+            "cancellable": self.cancellable,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+        if with_result:
+            data["result"] = self.result
+        return data
+
+
+class JobManager:
+    """
+    Очередь заданий. func задания вызывается как func(job, *args, **kwargs) и
+    возвращает тело ответа {"status", "message", ...}; если в нём status == "error",
+    задание завершается с ошибкой. Исключение из func тоже завершает задание с ошибкой.
+    """
+
+    def __init__(self, concurrency=None):
+        self._concurrency = concurrency
+        self._pools = {}
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _limit(self, job_type):
+        limits = dict(DEFAULT_CONCURRENCY)
+        configured = self._concurrency if self._concurrency is not None else get_setting("job_concurrency")
+        if isinstance(configured, dict):
+            limits.update(configured)
+        try:
+            return max(1, int(limits.get(job_type, 1)))
+        except (TypeError, ValueError):
+            return 1
+
+    def _pool(self, job_type):
+        pool = self._pools.get(job_type)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=self._limit(job_type), thread_name_prefix=f"job-{job_type}")
+            self._pools[job_type] = pool
+        return pool
+
+    def _trim(self):
+        now = time.perf_counter()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_for(now) > FINISHED_JOB_TTL_SECONDS]
+        for job_id in expired:
+            del self._jobs[job_id]
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def submit(self, job_type, func, *args, description="", cancellable=True, **kwargs):
+        """cancellable – func проверяет job.is_cancelled() и может остановиться на ходу."""
+        job = Job(job_type, description, cancellable)
+        with self._lock:
+            self._trim()
+            self._jobs[job.id] = job
+            job.future = self._pool(job_type).submit(self._run, job, func, args, kwargs)
+        logger.info(f"Задание {job.id} ({job_type}) поставлено в очередь")
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        with self._lock:
+            if job.is_cancelled():
+                job.set_status(JOB_CANCELLED)
+                return
+            job.set_status(JOB_RUNNING)
+        logger.info(f"Задание {job.id} ({job.job_type}) запущено")
+        try:
+            result = func(job, *args, **kwargs)
+        except Exception as e:
+            logger.exception(f"Ошибка выполнения задания {job.id} ({job.job_type})")
+            job.set_status(JOB_ERROR, str(e))
+            return
+        job.result = result
+        if job.is_cancelled():
+            job.set_status(JOB_CANCELLED)
+        elif isinstance(result, dict) and result.get("status") == "error":
+            job.set_status(JOB_ERROR, result.get("message"))
+        else:
+            job.set_status(JOB_SUCCESS)
+        logger.info(f"Задание {job.id} ({job.job_type}) завершено: {job.status}")
+
+    def get(self, job_id):
+        with self._lock:
+            self._trim()
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            self._trim()
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Отменяет задание: из очереди оно снимается сразу, выполняющееся
+        останавливается при следующей проверке флага. Выполняющееся задание
+        с cancellable=False не отменяется. Возвращает задание или None.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished or (job.status == JOB_RUNNING and not job.cancellable):
+                return job
+            job.cancel_event.set()
+            if job.future is not None and job.future.cancel():
+                job.set_status(JOB_CANCELLED)
+        logger.info(f"Запрошена отмена задания {job_id}")
+        return job
+
+
+job_manager = JobManager()
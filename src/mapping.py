@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import re
+import threading
+
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+from utils import get_app_folder, get_base_path
+
+logger = logging.getLogger(__name__)
+
+MAPPING_FILE_NAME = "acce_mapping.json"
+
+# Преобразования значения колонки: шаблон выражения, {x} – текущее значение,
+# {arg} – имя константы с аргументом преобразования
+TRANSFORMS = {
+    "truncate": "{x}[:{arg}]",
+    "prefix": "{arg} + {x}",
+    "suffix": "{x} + {arg}",
+    "strip": "{x}.strip()",
+    "upper": "{x}.upper()",
+    "str": "str({x})",
+    "scale": "({x} * {arg} if {x} is not None else None)",
+    "default": "({x} if {x} is not None else {arg})",
+}
+
+# Условия классификатора строк: значение колонки (строка) и аргумент условия
+MATCHERS = {
+    "equals": lambda value, arg: value == arg,
+    "prefix": lambda value, arg: value.startswith(arg),
+    "contains": lambda value, arg: arg in value,
+    "in": lambda value, arg: value in arg,
+    "regex": lambda value, arg: arg.search(value) is not None,
+}
+
+
+def get_mapping_path():
+    """
+    Путь к файлу описания колонок ACCE. Файл в папке приложения имеет приоритет
+    над поставляемым в assets, чтобы листы можно было добавлять без пересборки.
+    """
+    user_path = os.path.join(get_app_folder(), MAPPING_FILE_NAME)
+    if os.path.exists(user_path):
+        return user_path
+    return os.path.join(get_base_path(), 'assets', MAPPING_FILE_NAME)
+
+
+def load_mapping_spec(path=None):
+    """Читает описание соответствия колонок: {лист ACCE: спецификация}."""
+    with open(path or get_mapping_path(), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class CompiledMapping:
+    """
+    Скомпилированное соответствие колонок для одного листа ACCE.
+
+    transform(rows) принимает пачку строк-источников (кортежи значений A..N)
+    и возвращает список строк назначения в порядке target_columns. Чтение
+    прекращается на первой строке с пустой ключевой колонкой.
+    """
+
+    def __init__(self, sheet_name, spec):
+        self.sheet_name = sheet_name
+        self.source_sheet = spec.get("source_sheet", "Sheet2")
+        self.source_first_row = spec.get("source_first_row", 2)
+        self.target_first_row = spec.get("target_first_row", 11)
+        self.key_index = column_index_from_string(spec["key"]) - 1
+        self.match = self._compile_match(spec.get("match"))
+
+        columns = spec["columns"]
+        self.target_columns = tuple(column_index_from_string(c["target"]) for c in columns)
+        source_indexes = [self.key_index] + [
+            column_index_from_string(c["source"]) - 1 for c in columns if "source" in c
+        ]
+        self.source_columns = tuple(range(max(source_indexes) + 1))
+
+        self.source_code, self.transform = self._compile(columns)
+
+    def _compile_match(self, match):
+        """
+        Условие попадания строки в лист: {"column": "B", "<условие>": аргумент}.
+        Без условия лист принимает все строки, не попавшие в другие листы.
+        """
+        if not match:
+            return None
+        ops = [op for op in MATCHERS if op in match]
+        if len(ops) != 1:
+            raise ValueError(f"В условии листа {self.sheet_name} должно быть ровно одно из: {', '.join(MATCHERS)}")
+        op = ops[0]
+        arg = match[op]
+        if op == "regex":
+            arg = re.compile(arg)
+        elif op == "in":
+            arg = frozenset(arg)
+        index = column_index_from_string(match["column"]) - 1
+        test = MATCHERS[op]
+        return index, lambda value: test(value, arg)
+
+    def _compile(self, columns):
+        namespace = {}
+
+        def const(value):
+            name = f"_c{len(namespace)}"
+            namespace[name] = value
+            return name
+
+        expressions = []
+        for column in columns:
+            if "const" in column:
+                expressions.append(const(column["const"]))
+                continue
+            expr = f"src[{column_index_from_string(column['source']) - 1}]"
+            for step in column.get("transforms", []):
+                name, args = step[0], step[1:]
+                if name not in TRANSFORMS:
+                    raise ValueError(f"Неизвестное преобразование '{name}' в листе {self.sheet_name}")
+                arg = const(args[0]) if args else None
+                expr = "(" + TRANSFORMS[name].format(x=expr, arg=arg) + ")"
+            expressions.append(expr)
+
+        source_code = (
+            "def transform(rows):\n"
+            "    out = []\n"
+            "    append = out.append\n"
+            "    for src in rows:\n"
+            f"        if not src[{self.key_index}]:\n"
+            "            break\n"
+            f"        append(({', '.join(expressions)},))\n"
+            "    return out\n"
+        )
+        exec(compile(source_code, f"<mapping {self.sheet_name}>", "exec"), namespace)
+        return source_code, namespace["transform"]
+
+
+class SheetRouter:
+    """
+    Распределяет строки одного листа-источника по нескольким листам ACCE за один проход.
+    Листы с условием match проверяются в порядке описания, первый подходящий
+    получает строку; остальные строки уходят в лист без условия (если он есть).
+    Все листы группы читают источник одинаково: первая строка данных и ключевая
+    колонка должны совпадать, иначе ValueError.
+    """
+
+    def __init__(self, mappings):
+        first = mappings[0]
+        for m in mappings[1:]:
+            if (m.source_first_row, m.key_index) != (first.source_first_row, first.key_index):
+                raise ValueError(
+                    f"Листы {first.sheet_name} и {m.sheet_name} читают лист-источник {first.source_sheet} "
+                    f"по-разному: source_first_row {first.source_first_row} и {m.source_first_row}, "
+                    f"key {get_column_letter(first.key_index + 1)} и {get_column_letter(m.key_index + 1)}")
+        self.mappings = mappings
+        self.source_sheet = first.source_sheet
+        self.source_first_row = first.source_first_row
+        self.key_index = first.key_index
+        width = max([len(m.source_columns) for m in mappings] + [m.match[0] + 1 for m in mappings if m.match])
+        self.source_columns = tuple(range(width))
+        self.rules = [(m.match[0], m.match[1], m.sheet_name) for m in mappings if m.match]
+        fallback = [m.sheet_name for m in mappings if not m.match]
+        self.default_sheet = fallback[0] if fallback else None
+
+    def classify(self, src):
+        for index, test, sheet_name in self.rules:
+            value = src[index]
+            if value is not None and test(str(value)):
+                return sheet_name
+        return self.default_sheet
+
+    def route(self, source_rows):
+        """Возвращает {лист ACCE: список строк-источников}; неклассифицированные строки отбрасываются."""
+        buckets = {m.sheet_name: [] for m in self.mappings}
+        classify = self.classify
+        if not self.rules:
+            buckets[self.default_sheet].extend(source_rows)
+            return buckets
+        for src in source_rows:
+            sheet_name = classify(src)
+            if sheet_name is not None:
+                buckets[sheet_name].append(src)
+        return buckets
+
+
+def build_routers(mappings, sheetnames=None):
+    """
+    Группирует листы ACCE по листу-источнику: {лист-источник: SheetRouter}.
+    sheetnames – листы шаблона: листы с условием match, которых в шаблоне нет,
+    не участвуют в распределении, и их строки уходят в лист без условия.
+    """
+    groups = {}
+    for mapping in mappings.values():
+        if mapping.match and sheetnames is not None and mapping.sheet_name not in sheetnames:
+            logger.debug(f"Лист {mapping.sheet_name} отсутствует в шаблоне и пропущен")
+            continue
+        groups.setdefault(mapping.source_sheet, []).append(mapping)
+    return {source_sheet: SheetRouter(group) for source_sheet, group in groups.items()}
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def get_compiled_mappings(path=None):
+    """
+    Возвращает {лист ACCE: CompiledMapping}. Компиляция выполняется один раз
+    на версию файла описания (путь + mtime).
+    """
+    path = path or get_mapping_path()
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    with _compiled_lock:
+        mappings = _compiled.get(key)
+        if mappings is None:
+            spec = load_mapping_spec(path)
+            mappings = {name: CompiledMapping(name, sheet_spec) for name, sheet_spec in spec.items()}
+            _compiled.clear()
+            _compiled[key] = mappings
+            logger.debug(f"Скомпилировано описание колонок ACCE: {path}")
+    return mappings
+
+
+def get_compiled_mapping(sheet_name, path=None):
+    return get_compiled_mappings(path)[sheet_name]
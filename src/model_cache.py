@@ -0,0 +1,193 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ifc_io import open_model
+from utils import file_content_key, get_setting
+
+logger = logging.getLogger(__name__)
+
+# Бюджет памяти кэша моделей по умолчанию (МБ) и оценка занимаемой памяти:
+# разобранная модель ≈ размер файла × коэффициент. Оба значения можно
+# переопределить в settings.json: model_cache_budget_mb, model_memory_factor.
+DEFAULT_BUDGET_MB = 2048
+DEFAULT_MEMORY_FACTOR = 6
+
+
+class _CachedModel:
+    __slots__ = ("key", "model", "cost", "lock", "readers")
+
+    def __init__(self, key, model, cost):
+        self.key = key
+        self.model = model
+        self.cost = cost
+        self.lock = threading.Lock()
+        self.readers = 0  # выдачи read_only; меняется только под блокировкой кэша
+
+
+class ModelCache:
+    """
+    LRU-кэш разобранных IFC-моделей с бюджетом памяти.
+
+    Ключ – (путь, mtime, размер, SHA-256). Модель выдаётся двумя способами:
+      read_only – общая закэшированная модель, изменять её нельзя;
+      lease     – модель в собственность вызывающего (copy-on-use): закэшированная
+                  модель изымается из кэша (или разбирается при промахе), а свежая
+                  копия разбирается в фоне, чтобы следующий запуск получил её из памяти.
+    Модель, выданная в read_only, не изымается для lease, пока её читают:
+    число читателей учитывается под блокировкой кэша в момент выдачи.
+    Выданные в lease модели учитываются в бюджете памяти, пока их не вернули:
+    кэш вытесняет модели, чтобы вместе с ними уложиться в бюджет.
+    Транзакции ifcopenshell для отката не используются: запись изменений
+    в транзакции в несколько раз медленнее самого обновления свойств.
+    """
+
+    def __init__(self, budget_bytes=None, memory_factor=None):
+        self.budget_bytes = budget_bytes
+        self.memory_factor = memory_factor
+        self._entries = OrderedDict()  # key -> _CachedModel
+        self._size = 0
+        self._leased = 0  # оценка памяти моделей, выданных в lease
+        self._lock = threading.Lock()
+        self._loading = set()  # пути, для которых идёт фоновая загрузка
+        self.hits = 0
+        self.misses = 0
+
+    def _budget(self):
+        if self.budget_bytes is not None:
+            return self.budget_bytes
+        return int(get_setting("model_cache_budget_mb", DEFAULT_BUDGET_MB)) * 1024 * 1024
+
+    def _factor(self):
+        if self.memory_factor is not None:
+            return self.memory_factor
+        return float(get_setting("model_memory_factor", DEFAULT_MEMORY_FACTOR))
+
+    def _load(self, path, key):
+        return _CachedModel(key, open_model(path), int(key[2] * self._factor()))
+
+    def _store(self, entry, reader=False):
+        """
+        Помещает модель в кэш, если она укладывается в бюджет. Возвращает запись из кэша;
+        reader – сразу зарегистрировать выдачу read_only.
+        """
+        budget = self._budget()
+        with self._lock:
+            existing = self._entries.get(entry.key)
+            if existing is not None:
+                entry = existing
+            elif entry.cost <= budget - self._leased:
+                self._entries[entry.key] = entry
+                self._size += entry.cost
+                self._evict(budget)
+            if reader:
+                entry.readers += 1
+        return entry
+
+    def _evict(self, budget):
+        while self._entries and self._size + self._leased > budget:
+            key, entry = self._entries.popitem(last=False)
+            self._size -= entry.cost
+            logger.info(f"IFC-модель вытеснена из кэша: {key[0]}")
+
+    def _lookup(self, key, take=False):
+        """
+        Запись кэша для key или None. take – изъять запись для lease; иначе выдача
+        регистрируется как читатель (вернуть – _release_reader).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            # Модель, которую сейчас кто-то читает, не изымается – вызывающий разбирает свою копию
+            if entry is None or (take and entry.readers):
+                self.misses += 1
+                return None
+            self.hits += 1
+            if take:
+                del self._entries[key]
+                self._size -= entry.cost
+            else:
+                entry.readers += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def _release_reader(self, entry):
+        with self._lock:
+            entry.readers -= 1
+
+    def _refill(self, path):
+        """Разбирает модель заново в фоновом потоке, чтобы вернуть её в кэш."""
+        with self._lock:
+            if path in self._loading:
+                return
+            self._loading.add(path)
+
+        def run():
+            try:
+                key = file_content_key(path)
+                with self._lock:
+                    cached = key in self._entries
+                    fits = int(key[2] * self._factor()) <= self._budget() - self._leased
+                if not cached and fits:
+                    self._store(self._load(path, key))
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить IFC-модель в кэш {path}: {e}")
+            finally:
+                with self._lock:
+                    self._loading.discard(path)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    @contextmanager
+    def read_only(self, path):
+        """Общая модель для чтения; изменять её нельзя – она остаётся в кэше как есть."""
+        key = file_content_key(path)
+        entry = self._lookup(key)
+        if entry is None:
+            entry = self._store(self._load(path, key), reader=True)
+        try:
+            with entry.lock:
+                yield entry.model
+        finally:
+            self._release_reader(entry)
+
+    @contextmanager
+    def lease(self, path, refill=True):
+        """
+        Модель в собственность вызывающего: её можно изменять, в кэш она не возвращается.
+        При refill в фоне разбирается копия для следующего запуска – и после попадания,
+        и после промаха; одноразовым процессам (CLI, процессы пула) передаётся refill=False.
+        """
+        key = file_content_key(path)
+        entry = self._lookup(key, take=True)
+        if entry is None:
+            entry = self._load(path, key)
+        with self._lock:
+            self._leased += entry.cost
+            self._evict(self._budget())
+        try:
+            if refill:
+                self._refill(path)
+            yield entry.model
+        finally:
+            with self._lock:
+                self._leased -= entry.cost
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "estimated_bytes": self._size,
+                "leased_bytes": self._leased,
+                "budget_bytes": self._budget(),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+model_cache = ModelCache()
@@ -0,0 +1,97 @@
+"""
+Индекс компонентов PIPE-элементов IFC-модели, сохраняемый на диск рядом с кэшем приложения.
+
+Индекс – компактный результат StepScan (компоненты, их PIPE-элементы, GlobalId, имена,
+существующие Pset_PipeProperties и их свойства, максимальный номер сущности).
+Файл индекса называется по SHA-256 содержимого модели, поэтому повторные запуски
+Excel → IFC для той же модели не обходят её заново, а изменённая модель
+получает новый индекс.
+"""
+import json
+import logging
+import os
+import threading
+
+from step_patch import StepScan
+from utils import file_content_key, get_app_folder
+
+logger = logging.getLogger(__name__)
+
+INDEX_FOLDER_NAME = "ifc_index"
+INDEX_VERSION = 3
+
+_memo = {}  # ключ содержимого -> StepScan последней загруженной модели
+_memo_lock = threading.Lock()
+
+
+def get_index_folder():
+    folder = os.path.join(get_app_folder(), INDEX_FOLDER_NAME)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def get_index_path(content_hash):
+    return os.path.join(get_index_folder(), f"{content_hash}.json")
+
+
+def _read_index(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != INDEX_VERSION:
+            return None
+        return StepScan.from_dict(data)
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Не удалось прочитать индекс модели {path}: {e}")
+        return None
+
+
+def _write_index(path, scan):
+    data = scan.to_dict()
+    data["version"] = INDEX_VERSION
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except IOError as e:
+        logger.warning(f"Не удалось сохранить индекс модели {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_model_scan(ifc_path):
+    """
+    Возвращает StepScan модели: из памяти, из файла индекса или после потокового
+    сканирования (тогда индекс сохраняется). Ошибки чтения модели пробрасываются.
+    """
+    key = file_content_key(ifc_path)
+    with _memo_lock:
+        scan = _memo.get(key)
+    if scan is not None:
+        return scan
+
+    index_path = get_index_path(key[3])
+    scan = _read_index(index_path) if os.path.exists(index_path) else None
+    if scan is None:
+        scan = StepScan.scan(ifc_path)
+        _write_index(index_path, scan)
+        logger.info(f"Сохранён индекс компонентов модели {ifc_path}")
+
+    with _memo_lock:
+        _memo.clear()
+        _memo[key] = scan
+    return scan
+
+
+def resolve_matches(report, ifc_file):
+    """Заменяет компоненты индекса в report.matched на сущности разобранной модели."""
+    by_id = ifc_file.by_id
+    report.matched = [(record, by_id(component.id)) for record, component in report.matched]
+    return report
+
+
+def resolve_psets(scan, ifc_file):
+    """{id компонента: его Pset_PipeProperties} в разобранной модели – для PropertyWriterSession."""
+    by_id = ifc_file.by_id
+    return {element_id: by_id(pset_id) for element_id, pset_id in scan.element_psets.items()}
@@ -0,0 +1,117 @@
+"""
+Структурированные события хода конвертации по этапам.
+
+Конвертер открывает этап через ProgressReporter.stage(...) и по ходу работы
+обновляет счётчики; отчёт выдаёт в sink события-словари:
+    {"stage", "state": "start" | "progress" | "end", "source",
+     "elapsed" (с от начала этапа), "processed", "total", "bytes_written"}
+Промежуточные события progress прореживаются по времени, поэтому обновлять
+счётчики можно в каждом шаге цикла. События из процессов пула пересылаются
+в sink родителя через очередь (forward_events). Без sink в лог пишется только
+окончание этапа с его длительностью.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Минимальный интервал между событиями progress одного этапа, с
+PROGRESS_MIN_INTERVAL = 0.25
+
+
+class StageProgress:
+    def __init__(self, reporter, name, total=None):
+        self.reporter = reporter
+        self.name = name
+        self.started = time.perf_counter()
+        self.processed = None
+        self.total = total
+        self.bytes_written = None
+        self._last_emit = self.started
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def update(self, processed=None, total=None, bytes_written=None, force=False):
+        if processed is not None:
+            self.processed = processed
+        if total is not None:
+            self.total = total
+        if bytes_written is not None:
+            self.bytes_written = bytes_written
+        now = time.perf_counter()
+        if force or now - self._last_emit >= PROGRESS_MIN_INTERVAL:
+            self._last_emit = now
+            self.reporter.emit(self, "progress")
+
+
+class ProgressReporter:
+    def __init__(self, sink=None, source=None):
+        self.sink = sink
+        self.source = source
+
+    def for_source(self, source):
+        """Отчёт с тем же sink для одного файла пакета."""
+        return ProgressReporter(self.sink, source)
+
+    def emit(self, stage, state):
+        if self.sink is None:
+            return
+        event = {
+            "stage": stage.name,
+            "state": state,
+            "source": self.source,
+            "elapsed": round(stage.elapsed, 3),
+            "processed": stage.processed,
+            "total": stage.total,
+            "bytes_written": stage.bytes_written,
+        }
+        try:
+            self.sink(event)
+        except Exception as e:
+            logger.debug(f"Событие этапа {stage.name} не передано: {e}")
+
+    @contextmanager
+    def stage(self, name, total=None):
+        stage = StageProgress(self, name, total)
+        self.emit(stage, "start")
+        try:
+            yield stage
+        finally:
+            self.emit(stage, "end")
+            logger.info(f"Этап {name}{f' ({self.source})' if self.source else ''}: {stage.elapsed:.3f} с")
+
+
+NULL_PROGRESS = ProgressReporter()
+
+
+def _forward(queue, sink):
+    for event in iter(queue.get, None):
+        try:
+            sink(event)
+        except Exception as e:
+            logger.debug(f"Событие из процесса пула не передано: {e}")
+
+
+@contextmanager
+def forward_events(progress):
+    """
+    Очередь для событий из процессов пула: всё, что в неё положено, передаётся
+    в sink progress отдельным потоком. Если у progress нет sink, выдаёт None.
+    """
+    if progress.sink is None:
+        yield None
+        return
+    queue = multiprocessing.Queue()
+    thread = threading.Thread(target=_forward, args=(queue, progress.sink), daemon=True)
+    thread.start()
+    try:
+        yield queue
+    finally:
+        queue.put(None)
+        thread.join()
+        queue.close()
@@ -0,0 +1,204 @@
+"""
+Файлы удалённых конвертаций: загруженные по HTTP входные файлы и результаты для скачивания.
+
+Загрузка пишется на диск потоково, блоками, прямо в папку загрузки – без буферизации
+файла целиком в памяти. Каждая загрузка и каждый набор результатов лежат в своей
+папке с id (uuid), файл внутри сохраняет исходное имя: конвертеры строят имена
+результатов по именам входных файлов.
+
+Папки старше remote_retention_hours удаляются фоновым потоком раз в
+remote_cleanup_interval_s секунд.
+"""
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from utils import HASH_CHUNK_SIZE, get_app_folder, get_setting
+
+logger = logging.getLogger(__name__)
+
+REMOTE_FOLDER_NAME = "remote"
+UPLOADS = "uploads"
+RESULTS = "results"
+DEFAULT_RETENTION_HOURS = 24
+DEFAULT_CLEANUP_INTERVAL_S = 600
+DEFAULT_MAX_UPLOAD_MB = 4096
+
+# Ссылка на загруженный файл в параметрах маршрутов конвертации вместо локального пути
+UPLOAD_REF_PREFIX = "upload:"
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+# Символы, недопустимые в именах файлов Windows, и управляющие символы
+_UNSAFE_RE = re.compile(r'[\x00-\x1f<>:"/\\|?*]')
+
+
+def _safe_name(filename, default="upload.bin"):
+    """Имя файла без пути и недопустимых символов; кириллица и расширения сохраняются."""
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    name = _UNSAFE_RE.sub("_", name).strip(" .")
+    return name or default
+
+
+class RemoteStore:
+    def __init__(self, root=None):
+        self._root = root
+        self._cleanup_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        return self._root or os.path.join(get_app_folder(), REMOTE_FOLDER_NAME)
+
+    def _folder(self, kind, item_id):
+        if not item_id or not _ID_RE.match(item_id):
+            return None
+        return os.path.join(self.root, kind, item_id)
+
+    def _new_folder(self, kind):
+        item_id = uuid.uuid4().hex
+        folder = os.path.join(self.root, kind, item_id)
+        os.makedirs(folder)
+        self.start_cleanup()
+        return item_id, folder
+
+    @property
+    def max_upload_bytes(self):
+        return int(float(get_setting("remote_max_upload_mb", DEFAULT_MAX_UPLOAD_MB)) * 1024 * 1024)
+
+    # -------------------
+    # Загрузки
+    # -------------------
+    def new_upload(self, filename):
+        """(id загрузки, путь для записи файла)."""
+        upload_id, folder = self._new_folder(UPLOADS)
+        return upload_id, os.path.join(folder, _safe_name(filename))
+
+    def save_stream(self, stream, filename, limit=None):
+        """
+        Потоково сохраняет тело запроса как новую загрузку. Если данных больше limit,
+        загрузка удаляется и возникает ValueError. Возвращает описание загрузки.
+        """
+        upload_id, path = self.new_upload(filename)
+        written = 0
+        try:
+            with open(path, "wb") as f:
+                for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+                    written += len(chunk)
+                    if limit is not None and written > limit:
+                        raise ValueError(f"Файл больше допустимых {limit // (1024 * 1024)} МБ")
+                    f.write(chunk)
+        except Exception:
+            self.delete_upload(upload_id)
+            raise
+        return self.upload_info(upload_id)
+
+    def upload_path(self, upload_id):
+        folder = self._folder(UPLOADS, upload_id)
+        if folder is None or not os.path.isdir(folder):
+            return None
+        names = os.listdir(folder)
+        return os.path.join(folder, names[0]) if names else None
+
+    def upload_info(self, upload_id):
+        path = self.upload_path(upload_id)
+        if path is None:
+            return None
+        return {"id": upload_id, "name": os.path.basename(path), "size": os.path.getsize(path),
+                "ref": UPLOAD_REF_PREFIX + upload_id}
+
+    def delete_upload(self, upload_id):
+        folder = self._folder(UPLOADS, upload_id)
+        if folder is None or not os.path.isdir(folder):
+            return False
+        shutil.rmtree(folder, ignore_errors=True)
+        return True
+
+    def resolve(self, value, allow_paths=False):
+        """
+        Путь к файлу по значению параметра: 'upload:<id>' – загруженный файл.
+        Другое значение возвращается как есть только при allow_paths (локальное окно
+        приложения), иначе – ValueError. Для неизвестной загрузки – LookupError.
+        """
+        if not isinstance(value, str) or not value.startswith(UPLOAD_REF_PREFIX):
+            if allow_paths:
+                return value
+            raise ValueError(f"Ожидается ссылка {UPLOAD_REF_PREFIX}<id> на загруженный файл, получено: {value!r}")
+        path = self.upload_path(value[len(UPLOAD_REF_PREFIX):])
+        if path is None:
+            raise LookupError(f"Загрузка {value} не найдена или уже удалена")
+        return path
+
+    # -------------------
+    # Результаты
+    # -------------------
+    def new_result_folder(self):
+        """(id набора результатов, папка для записи результатов)."""
+        return self._new_folder(RESULTS)
+
+    def result_file(self, result_id, name):
+        folder = self._folder(RESULTS, result_id)
+        if folder is None or name != _safe_name(name, default=""):
+            return None
+        path = os.path.join(folder, name)
+        return path if os.path.isfile(path) else None
+
+    def result_files(self, result_id):
+        """[(имя, размер)] файлов результата; None для неизвестного id."""
+        folder = self._folder(RESULTS, result_id)
+        if folder is None or not os.path.isdir(folder):
+            return None
+        files = []
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            # Временные файлы ещё идущей записи (place_file, запись IFC) не показываются
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                files.append((name, os.path.getsize(path)))
+        return files
+
+    # -------------------
+    # Очистка
+    # -------------------
+    def cleanup(self, max_age_seconds=None):
+        """Удаляет загрузки и результаты старше max_age_seconds. Возвращает число удалённых папок."""
+        if max_age_seconds is None:
+            max_age_seconds = float(get_setting("remote_retention_hours", DEFAULT_RETENTION_HOURS)) * 3600
+        deadline = time.time() - max_age_seconds
+        removed = 0
+        for kind in (UPLOADS, RESULTS):
+            base = os.path.join(self.root, kind)
+            if not os.path.isdir(base):
+                continue
+            for item_id in os.listdir(base):
+                folder = os.path.join(base, item_id)
+                try:
+                    if os.path.getmtime(folder) < deadline:
+                        shutil.rmtree(folder)
+                        removed += 1
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить {folder}: {e}")
+        if removed:
+            logger.info(f"Удалено устаревших загрузок и результатов: {removed}")
+        return removed
+
+    def _cleanup_loop(self):
+        while True:
+            time.sleep(float(get_setting("remote_cleanup_interval_s", DEFAULT_CLEANUP_INTERVAL_S)))
+            try:
+                self.cleanup()
+            except Exception as e:
+                logger.error(f"Ошибка очистки файлов удалённых конвертаций: {e}")
+
+    def start_cleanup(self):
+        """Запускает фоновую очистку (один раз на процесс)."""
+        with self._lock:
+            if self._cleanup_thread is None:
+                self._cleanup_thread = threading.Thread(target=self._cleanup_loop, name="remote-cleanup",
+                                                        daemon=True)
+                self._cleanup_thread.start()
+
+
+remote_store = RemoteStore()
@@ -0,0 +1,269 @@
+"""
+Кэш результатов конвертаций, адресуемый по содержимому.
+
+Ключ – SHA-256 от вида конвертации, версии конвертера (RESULT_VERSION модуля),
+SHA-256 содержимого всех входных файлов и опций. Результат хранится копией в папке
+result_cache, а при повторном запуске с теми же входами появляется по запрошенному
+пути жёсткой ссылкой, reflink-копией (где ФС это поддерживает) или обычной копией.
+
+Жёсткая ссылка делит данные с файлом кэша, поэтому:
+  - перед конвертацией без попадания выходной файл с другими ссылками удаляется
+    (prepare_output), чтобы конвертер не переписал файл кэша на месте;
+  - перед выдачей содержимое файла кэша сверяется с SHA-256, записанным при сохранении,
+    и изменённый файл вытесняется.
+Общий размер ограничен настройкой result_cache_budget_mb; вытесняются записи,
+которые дольше всего не использовались.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from utils import file_content_key, get_app_folder, get_setting, place_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET_MB = 4096
+CACHE_FOLDER_NAME = "result_cache"
+INDEX_FILE_NAME = "index.sqlite"
+
+# Поля результата элемента пакета, которые не сохраняются в кэше
+_BATCH_RESULT_FIELDS = ("source", "output", "status", "error", "seconds", "cached")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+
+class ResultCache:
+    def __init__(self, folder=None, budget_bytes=None):
+        self._folder = folder
+        self._budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @property
+    def folder(self):
+        folder = self._folder or os.path.join(get_app_folder(), CACHE_FOLDER_NAME)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    @property
+    def budget_bytes(self):
+        if self._budget_bytes is not None:
+            return self._budget_bytes
+        return int(float(get_setting("result_cache_budget_mb", DEFAULT_BUDGET_MB)) * 1024 * 1024)
+
+    @property
+    def enabled(self):
+        return self.budget_bytes > 0
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.folder, INDEX_FILE_NAME), timeout=30)
+        if not self._initialized:
+            with self._lock:
+                conn.executescript(_SCHEMA)
+                self._initialized = True
+        return conn
+
+    @staticmethod
+    def key(kind, version, inputs, options=None):
+        """Ключ результата: вид конвертации, версия, содержимое входных файлов (по порядку) и опции."""
+        payload = {
+            "kind": kind,
+            "version": version,
+            "inputs": [file_content_key(path)[3] for path in inputs],
+            "options": options or {},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _remove(self, conn, key, file_name):
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        try:
+            os.remove(os.path.join(self.folder, file_name))
+        except OSError:
+            pass
+
+    def fetch(self, key, output_path):
+        """
+        Если результат для key есть, помещает его по пути output_path и возвращает
+        его метаданные с полем cache_method; иначе None.
+        """
+        if not self.enabled:
+            return None
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT file, sha256, meta FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                file_name, digest, meta = row
+                path = os.path.join(self.folder, file_name)
+                try:
+                    valid = file_content_key(path)[3] == digest
+                except OSError:
+                    valid = False
+                if not valid:
+                    logger.warning(f"Файл кэша результатов {file_name} изменён или удалён, запись вытеснена")
+                    self._remove(conn, key, file_name)
+                    return None
+                method = place_file(path, output_path)
+                conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        finally:
+            conn.close()
+        meta = json.loads(meta)
+        meta["cache_method"] = method
+        logger.info(f"Результат взят из кэша ({method}): {output_path}")
+        return meta
+
+    @staticmethod
+    def prepare_output(output_path):
+        """
+        Удаляет выходной файл, если у него есть другие жёсткие ссылки (например, он был
+        выдан из кэша), чтобы конвертер записал новый файл, а не переписал общий.
+        """
+        try:
+            if os.stat(output_path).st_nlink > 1:
+                os.remove(output_path)
+        except OSError:
+            pass
+
+    def store(self, key, output_path, meta=None):
+        """Сохраняет копию output_path как результат для key и вытесняет лишнее по бюджету."""
+        if not self.enabled:
+            return
+        size = os.path.getsize(output_path)
+        if size > self.budget_bytes:
+            return
+        file_name = key + os.path.splitext(output_path)[1]
+        path = os.path.join(self.folder, file_name)
+        # Копия, а не ссылка: пользователь может изменить свой результат на месте
+        place_file(output_path, path, allow_link=False)
+        digest = file_content_key(path)[3]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, file, size, sha256, meta, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, file_name, size, digest, json.dumps(meta or {}, ensure_ascii=False),
+                     datetime.now().isoformat(), time.time()))
+                self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        budget = self.budget_bytes
+        if total <= budget:
+            return
+        for key, file_name, size in conn.execute(
+                "SELECT key, file, size FROM entries ORDER BY last_used").fetchall():
+            self._remove(conn, key, file_name)
+            total -= size
+            logger.debug(f"Из кэша результатов вытеснен {file_name}")
+            if total <= budget:
+                break
+
+    def _safe_fetch(self, key, output_path):
+        if not key:
+            return None
+        try:
+            return self.fetch(key, output_path)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш результатов: {e}")
+            return None
+
+    def _safe_store(self, key, output_path, meta):
+        if not key or meta is None:
+            return
+        try:
+            self.store(key, output_path, meta)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить результат в кэш: {e}")
+
+    def run(self, key, output_path, convert):
+        """
+        Результат для key из кэша или convert() с сохранением результата в кэш.
+        convert() записывает output_path и возвращает словарь метаданных (сохраняется
+        вместе с результатом) или None – тогда результат не кэшируется. Возвращает
+        (метаданные, способ выдачи из кэша или None). Ошибки кэша не прерывают конвертацию.
+        """
+        meta = self._safe_fetch(key, output_path)
+        if meta is not None:
+            return meta, meta.pop("cache_method")
+        self.prepare_output(output_path)
+        meta = convert()
+        self._safe_store(key, output_path, meta)
+        return meta, None
+
+    def run_batch(self, items, keys, convert_items):
+        """
+        Пакетный вариант run. items – [(source, output)], keys – ключ (или None) для
+        каждого элемента; convert_items(items) конвертирует промахи и возвращает
+        результаты (source, output, status, error, seconds, ...) в том же порядке.
+        Результаты из кэша получают поле cached – способ выдачи; остальные поля,
+        кроме служебных, сохраняются в кэше вместе с файлом.
+        """
+        results = [None] * len(items)
+        pending = []
+        for index, ((source, output), key) in enumerate(zip(items, keys)):
+            start = time.perf_counter()
+            meta = self._safe_fetch(key, output)
+            if meta is None:
+                self.prepare_output(output)
+                pending.append(index)
+                continue
+            method = meta.pop("cache_method")
+            results[index] = dict(meta, source=source, output=output, status="success", error=None,
+                                  seconds=round(time.perf_counter() - start, 3), cached=method)
+        if pending:
+            converted = convert_items([items[index] for index in pending])
+            for index, result in zip(pending, converted):
+                results[index] = result
+                if result["status"] == "success":
+                    self._safe_store(keys[index], items[index][1],
+                                     {k: v for k, v in result.items() if k not in _BATCH_RESULT_FIELDS})
+        return results
+
+    def safe_key(self, kind, version, inputs, options=None):
+        """key или None, если кэш выключен или входной файл не читается."""
+        if not self.enabled:
+            return None
+        try:
+            return self.key(kind, version, inputs, options)
+        except OSError as e:
+            logger.warning(f"Ключ кэша результатов не вычислен: {e}")
+            return None
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        finally:
+            conn.close()
+        return {"entries": entries, "bytes": size, "budget_bytes": self.budget_bytes}
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            with conn:
+                for key, file_name in conn.execute("SELECT key, file FROM entries").fetchall():
+                    self._remove(conn, key, file_name)
+        finally:
+            conn.close()
+
+
+result_cache = ResultCache()
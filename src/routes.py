@@ -1,18 +1,31 @@
+import json
 import logging
 import os
+from urllib.parse import quote
 
-from flask import Blueprint, request, jsonify, render_template
+from flask import Blueprint, Response, current_app, request, jsonify, render_template, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
 
-from converter import convert_psim_to_asse
-from ifc_converter import convert_excel_to_ifc
+from converter import convert_psim_batch, convert_psim_cached
+from ifc_converter import convert_excel_to_ifc_batch
 from utils import HistoryManager
 
+from ifc_io import as_ifczip_path, ifc_base_name
 from ifc_to_ifc_converter import process_ifc_files
+from jobs import JOB_CANCELLED, job_manager
+from progress import ProgressReporter
+from remote_store import remote_store
 
 logger = logging.getLogger(__name__)
 
 bp = Blueprint('main', __name__)
 
+# Ключ конфигурации Flask: пути файлов сервера в запросах принимаются только от окна
+# приложения (app.py). HTTP API (cli.py serve) принимает лишь ссылки upload:<id>
+# и всегда сохраняет результаты в новую папку для скачивания.
+LOCAL_PATHS_CONFIG = "ALLOW_LOCAL_PATHS"
+
 
 @bp.route('/')
 def index():
@@ -20,29 +33,59 @@ def index():
     return render_template('main_window.html')
 
 
-@bp.route('/convert', methods=['POST'])
-def convert_route():
-    """Обрабатывает запрос на конвертацию PSIM -> ACCE."""
-    data = request.json
-    psim_file = data.get('inputFile')
-    second_file = data.get('secondFile')
-    output_file_path = data.get('outputFile')  # Путь, КУДА сохранить результат
+def _queued(job, message, result_id=None):
+    body = {"status": "queued", "message": message, "job_id": job.id, "cancellable": job.cancellable}
+    if result_id:
+        # Результаты удалённой конвертации: список файлов для скачивания после завершения задания
+        body["result_id"] = result_id
+        body["results_url"] = f"/results/{result_id}"
+    return jsonify(body), 202
 
-    if not all([psim_file, second_file, output_file_path]):
-        logger.error("Ошибка запроса /convert: Отсутствуют необходимые параметры.")
-        return jsonify({"status": "error", "message": "Отсутствуют входные или выходной пути."}), 400
 
-    if os.path.isdir(output_file_path):
-        output_filename = "export_spreadsheet.xlsx"  # Имя файла по умолчанию
-        output_file_path = os.path.join(output_file_path, output_filename)
-        logger.info(f"Путь вывода был папкой, сформирован полный путь: {output_file_path}")
+def _local_paths_allowed():
+    return bool(current_app.config.get(LOCAL_PATHS_CONFIG))
+
 
+def _resolve_uploads(data, *fields, allow_paths=False):
+    """
+    Копия data, в которой ссылки upload:<id> (и в списках) заменены путями
+    загруженных файлов. Для неизвестной загрузки – LookupError, для пути
+    без allow_paths – ValueError.
+    """
+    resolved = dict(data)
+    for field in fields:
+        value = data.get(field)
+        if isinstance(value, list):
+            resolved[field] = [remote_store.resolve(v, allow_paths) for v in value]
+        elif value:
+            resolved[field] = remote_store.resolve(value, allow_paths)
+    return resolved
+
+
+def _request_data(*fields):
+    """(данные запроса с путями вместо ссылок upload:<id>, ответ с ошибкой или None)."""
+    data = request.json or {}
+    allow_paths = _local_paths_allowed()
+    try:
+        if not allow_paths and data.get('outputFile'):
+            raise ValueError("Путь вывода на сервере не принимается: результаты сохраняются "
+                             "для скачивания через /results.")
+        return _resolve_uploads(data, *fields, allow_paths=allow_paths), None
+    except LookupError as e:
+        return None, (jsonify({"status": "error", "message": str(e)}), 404)
+    except ValueError as e:
+        logger.warning(f"Отклонён запрос {request.path}: {e}")
+        return None, (jsonify({"status": "error", "message": str(e)}), 400)
+
+
+def run_convert_job(job, psim_file, second_file, output_file_path):
+    """Задание конвертации PSIM -> ACCE; запись в историю делается по её окончании."""
     input_paths = [f for f in [psim_file, second_file] if f]
 
     try:
         logger.info(f"Начало конвертации PSIM: {input_paths} -> {output_file_path}")
 
-        convert_psim_to_asse(psim_file, second_file, output_file_path)
+        cached = convert_psim_cached(psim_file, second_file, output_file_path)
 
         logger.info(f"Конвертация PSIM успешно завершена.")
 
@@ -51,10 +94,13 @@ def convert_route():
             status="success",
             input_file_paths=input_paths,
             output_file_paths=[output_file_path],
-            metadata={"comment": "PSIM to ACCE conversion successful"},
+            metadata={"comment": "PSIM to ACCE conversion successful", "cached": cached},
             error_message=None
         )
-        return jsonify({"status": "success", "message": "Конвертирование PSIM -> ACCE завершено успешно!"})
+        message = "Конвертирование PSIM -> ACCE завершено успешно!"
+        if cached:
+            message += " Результат взят из кэша."
+        return {"status": "success", "message": message, "cached": cached}
 
     except Exception as e:
         error_msg = f"Ошибка во время конвертации PSIM: {e}"
@@ -68,53 +114,156 @@ def convert_route():
             metadata={},
             error_message=str(e)
         )
-        return jsonify({"status": "error", "message": error_msg}), 500
+        return {"status": "error", "message": error_msg}
 
 
-@bp.route('/convert_ifc', methods=['POST'])
-def convert_ifc_route():
-    """Обрабатывает запрос на обновление свойств IFC из Excel."""
-    data = request.json
-    ifc_file_paths = data.get('ifcFiles', [])
-    excel_file_path = data.get('attribFile')
-    output_file_path = data.get('outputFile')
+@bp.route('/convert', methods=['POST'])
+def convert_route():
+    """Ставит в очередь конвертацию PSIM -> ACCE."""
+    data, error = _request_data('inputFile', 'secondFile')
+    if error:
+        return error
+    psim_file = data.get('inputFile')
+    second_file = data.get('secondFile')
+    output_file_path = data.get('outputFile')  # Путь, КУДА сохранить результат
+    result_id = None
 
-    if not ifc_file_paths or not excel_file_path or not output_file_path:
-        logger.error("Ошибка запроса /convert_ifc: Отсутствуют необходимые параметры.")
-        return jsonify({"status": "error", "message": "Не указаны IFC файлы, файл атрибутов или путь вывода."}), 400
+    if not all([psim_file, second_file]):
+        logger.error("Ошибка запроса /convert: Отсутствуют необходимые параметры.")
+        return jsonify({"status": "error", "message": "Отсутствуют входные или выходной пути."}), 400
+
+    if not output_file_path:
+        # Удалённая конвертация: результат сохраняется для скачивания через /results
+        result_id, output_file_path = remote_store.new_result_folder()
+
+    if os.path.isdir(output_file_path):
+        output_filename = "export_spreadsheet.xlsx"  # Имя файла по умолчанию
+        output_file_path = os.path.join(output_file_path, output_filename)
+        logger.info(f"Путь вывода был папкой, сформирован полный путь: {output_file_path}")
+
+    job = job_manager.submit("PSIM_TO_ACCE", run_convert_job, psim_file, second_file, output_file_path,
+                             description=os.path.basename(second_file), cancellable=False)
+    return _queued(job, "Конвертация PSIM -> ACCE поставлена в очередь.", result_id)
+
+
+def summarize_batch(results, label):
+    """Списки успешных выходных файлов и ошибок, итоговый статус и сообщение пакета."""
+    processed_output_paths = [r["output"] for r in results if r["status"] == "success"]
+    errors_occurred = [f"{r['source']}: {r['error']}" for r in results if r["status"] == "error"]
+    skipped = sum(1 for r in results if r["status"] == "cancelled")
+    cached = sum(1 for r in results if r.get("cached"))
+    final_status = "error" if errors_occurred else "success"
+    final_message = f"{label} завершена. Успешно: {len(processed_output_paths)}, Ошибок: {len(errors_occurred)}."
+    if cached:
+        final_message += f" Из кэша: {cached}."
+    if skipped:
+        final_message += f" Отменено: {skipped}."
+    if errors_occurred:
+        final_message += f" Первая ошибка: {errors_occurred[0]}"
+    return processed_output_paths, errors_occurred, final_status, final_message
+
+
+def run_convert_batch_job(job, psim_file, second_files, output_folder_path, max_workers=None):
+    """Задание пакетной конвертации PSIM -> ACCE."""
+    input_paths = [psim_file] + second_files
+    logger.info(f"Начало пакетной конвертации PSIM: {len(second_files)} файлов -> папка {output_folder_path}")
+
+    try:
+        results = convert_psim_batch(psim_file, second_files, output_folder_path, max_workers=max_workers,
+                                     cancelled=job.is_cancelled)
+    except Exception as e:
+        error_msg = f"Ошибка во время пакетной конвертации PSIM: {e}"
+        logger.exception(error_msg)
+        HistoryManager.add_entry(
+            entry_type="PSIM_TO_ACCE_BATCH",
+            status="error",
+            input_file_paths=input_paths,
+            output_file_paths=[],
+            metadata={"files_in_batch": len(second_files)},
+            error_message=str(e)
+        )
+        return {"status": "error", "message": error_msg}
+
+    processed_output_paths, errors_occurred, final_status, final_message = summarize_batch(
+        results, "Пакетная конвертация")
+
+    HistoryManager.add_entry(
+        entry_type="PSIM_TO_ACCE_BATCH",
+        status=final_status,
+        input_file_paths=input_paths,
+        output_file_paths=processed_output_paths,
+        metadata={
+            "files_in_batch": len(second_files),
+            "successful_conversions": len(processed_output_paths),
+            "template": psim_file,
+            "output_destination_folder": output_folder_path,
+            "cancelled": job.is_cancelled(),
+            "cached_files": [r["source"] for r in results if r.get("cached")],
+            "timings": {r["source"]: r["seconds"] for r in results}
+        },
+        error_message="; ".join(errors_occurred) if errors_occurred else None
+    )
+
+    return {"status": final_status, "message": final_message, "results": results}
+
+
+@bp.route('/convert_batch', methods=['POST'])
+def convert_batch_route():
+    """Ставит в очередь пакетную конвертацию PSIM -> ACCE: один шаблон и несколько выгрузок Sheet2."""
+    data, error = _request_data('inputFile', 'secondFiles')
+    if error:
+        return error
+    psim_file = data.get('inputFile')
+    second_files = data.get('secondFiles', [])
+    output_folder_path = data.get('outputFile')
+    max_workers = data.get('maxWorkers')
+    result_id = None
+
+    if not psim_file or not second_files:
+        logger.error("Ошибка запроса /convert_batch: Отсутствуют необходимые параметры.")
+        return jsonify({"status": "error", "message": "Не указаны шаблон, исходные файлы или папка вывода."}), 400
+
+    if not output_folder_path:
+        result_id, output_folder_path = remote_store.new_result_folder()
 
-    output_folder_path = output_file_path
     if not os.path.isdir(output_folder_path):
-        logger.error(f"Ошибка запроса /convert_ifc: Путь вывода '{output_folder_path}' не является папкой.")
+        logger.error(f"Ошибка запроса /convert_batch: Путь вывода '{output_folder_path}' не является папкой.")
         return jsonify({"status": "error", "message": f"Путь вывода '{output_folder_path}' должен быть папкой."}), 400
 
+    job = job_manager.submit("PSIM_TO_ACCE_BATCH", run_convert_batch_job, psim_file, second_files,
+                             output_folder_path, max_workers, description=f"{len(second_files)} файлов")
+    return _queued(job, "Пакетная конвертация PSIM -> ACCE поставлена в очередь.", result_id)
+
+
+def run_convert_ifc_job(job, ifc_file_paths, excel_file_path, output_folder_path, max_workers=None,
+                        mode=None, compress=False):
+    """Задание обновления свойств IFC из Excel."""
     all_input_paths = ifc_file_paths + [excel_file_path]
-    processed_output_paths = []
-    errors_occurred = []
 
     logger.info(
         f"Начало обработки IFC: {len(ifc_file_paths)} файлов, атрибуты из {excel_file_path} -> папка {output_folder_path}")
 
-    for ifc_file in ifc_file_paths:
-        base_name = os.path.basename(ifc_file)
-        name, ext = os.path.splitext(base_name)
-        current_output_path = os.path.join(output_folder_path, f"{name}_updated{ext}")
-
-        try:
-            logger.info(f"Обработка {ifc_file} -> {current_output_path}")
-            convert_excel_to_ifc(ifc_file, excel_file_path, current_output_path)
-            processed_output_paths.append(current_output_path)
-            logger.info(f"Файл {ifc_file} успешно обработан.")
+    try:
+        results = convert_excel_to_ifc_batch(ifc_file_paths, excel_file_path, output_folder_path,
+                                             max_workers=max_workers,
+                                             patch=mode == 'patch',
+                                             compress=compress,
+                                             cancelled=job.is_cancelled,
+                                             progress=ProgressReporter(job.add_event))
+    except Exception as e:
+        error_msg = f"Ошибка при обработке IFC: {e}"
+        logger.exception(error_msg)
+        results = [{"source": f, "output": None, "status": "error", "error": str(e), "seconds": 0}
+                   for f in ifc_file_paths]
 
-        except Exception as e:
-            error_msg = f"Ошибка при обработке файла {ifc_file}: {e}"
-            logger.exception(error_msg)
-            errors_occurred.append(error_msg)
+    for result in results:
+        if result["status"] == "success":
+            logger.info(f"Файл {result['source']} успешно обработан за {result['seconds']} с.")
+        elif result["status"] == "error":
+            logger.error(f"Ошибка при обработке файла {result['source']}: {result['error']}")
 
-    final_status = "error" if errors_occurred else "success"
-    final_message = f"Обработка IFC завершена. Успешно: {len(processed_output_paths)}, Ошибок: {len(errors_occurred)}."
-    if errors_occurred:
-        final_message += f" Первая ошибка: {errors_occurred[0]}"
+    processed_output_paths, errors_occurred, final_status, final_message = summarize_batch(
+        results, "Обработка IFC")
 
     history_error_message = "; ".join(errors_occurred) if errors_occurred else None
 
@@ -127,43 +276,68 @@ def convert_ifc_route():
             "ifc_files_in_batch": len(ifc_file_paths),
             "successful_ifc_updates": len(processed_output_paths),
             "attribute_source": excel_file_path,
-            "output_destination_folder": output_folder_path
+            "output_destination_folder": output_folder_path,
+            "mode": mode or 'full',
+            "compressed": compress,
+            "cancelled": job.is_cancelled(),
+            "cached_files": [r["source"] for r in results if r.get("cached")],
+            "timings": {r["source"]: r["seconds"] for r in results},
+            "match_counts": {r["source"]: {k: v for k, v in r["match"].items() if not k.endswith("_sample")}
+                             for r in results if r.get("match")}
         },
         error_message=history_error_message
     )
 
-    if final_status == "success":
-        return jsonify({"status": "success", "message": final_message})
-    else:
-        return jsonify({"status": "error", "message": final_message}), 500
+    return {"status": final_status, "message": final_message, "results": results}
 
 
-@bp.route('/transfer_ifc', methods=['POST'])
-def transfer_ifc_route():
-    """
-    Копирует пользовательские свойства/атрибуты из old_ifc в new_ifc
-    и сохраняет результат в output_file.
-    """
-    data = request.json or {}
-    old_ifc = data.get('oldIfcFile')
-    new_ifc = data.get('newIfcFile')
-    output = data.get('outputFile')
+@bp.route('/convert_ifc', methods=['POST'])
+def convert_ifc_route():
+    """Ставит в очередь обновление свойств IFC из Excel."""
+    data, error = _request_data('ifcFiles', 'attribFile')
+    if error:
+        return error
+    ifc_file_paths = data.get('ifcFiles', [])
+    excel_file_path = data.get('attribFile')
+    output_file_path = data.get('outputFile')
+    result_id = None
+
+    if not ifc_file_paths or not excel_file_path:
+        logger.error("Ошибка запроса /convert_ifc: Отсутствуют необходимые параметры.")
+        return jsonify({"status": "error", "message": "Не указаны IFC файлы, файл атрибутов или путь вывода."}), 400
+
+    if not output_file_path:
+        result_id, output_file_path = remote_store.new_result_folder()
+
+    output_folder_path = output_file_path
+    if not os.path.isdir(output_folder_path):
+        logger.error(f"Ошибка запроса /convert_ifc: Путь вывода '{output_folder_path}' не является папкой.")
+        return jsonify({"status": "error", "message": f"Путь вывода '{output_folder_path}' должен быть папкой."}), 400
+
+    job = job_manager.submit("IFC_UPDATE", run_convert_ifc_job, ifc_file_paths, excel_file_path, output_folder_path,
+                             max_workers=data.get('maxWorkers'), mode=data.get('mode'),
+                             compress=bool(data.get('compress')),
+                             description=f"{len(ifc_file_paths)} IFC")
+    return _queued(job, "Обработка IFC поставлена в очередь.", result_id)
 
-    if not all([old_ifc, new_ifc, output]):
-        return jsonify({"status": "error", "message": "Не заполнены все поля."}), 400
 
+def run_transfer_ifc_job(job, old_ifc, new_ifc, output):
+    """Задание переноса GUID и свойств из old_ifc в new_ifc."""
     try:
-        process_ifc_files(old_ifc, new_ifc, output)
+        summary = process_ifc_files(old_ifc, new_ifc, output, progress=ProgressReporter(job.add_event, new_ifc))
 
         HistoryManager.add_entry(
             entry_type="IFC_TRANSFER",
             status="success",
             input_file_paths=[old_ifc, new_ifc],
             output_file_paths=[output],
-            metadata={},
+            metadata=summary,
             error_message=None
         )
-        return jsonify({"status": "success", "message": "Перенос данных завершён!"})
+        message = "Перенос данных завершён!"
+        if summary.get("cached"):
+            message += " Результат взят из кэша."
+        return {"status": "success", "message": message, "output": output, "cached": summary.get("cached")}
     except Exception as e:
         logger.exception("Ошибка transfer_ifc")
         HistoryManager.add_entry(
@@ -174,15 +348,221 @@ def transfer_ifc_route():
             metadata={},
             error_message=str(e)
         )
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return {"status": "error", "message": str(e)}
+
+
+@bp.route('/transfer_ifc', methods=['POST'])
+def transfer_ifc_route():
+    """
+    Ставит в очередь перенос пользовательских свойств/атрибутов из old_ifc в new_ifc
+    с сохранением результата в output_file.
+    """
+    data, error = _request_data('oldIfcFile', 'newIfcFile')
+    if error:
+        return error
+    old_ifc = data.get('oldIfcFile')
+    new_ifc = data.get('newIfcFile')
+    output = data.get('outputFile')
+    result_id = None
+
+    if not all([old_ifc, new_ifc]):
+        return jsonify({"status": "error", "message": "Не заполнены все поля."}), 400
+    if not output:
+        result_id, folder = remote_store.new_result_folder()
+        output = os.path.join(folder, f"{ifc_base_name(new_ifc)}_transfer.ifc")
+    if data.get('compress'):
+        output = as_ifczip_path(output)
+
+    job = job_manager.submit("IFC_TRANSFER", run_transfer_ifc_job, old_ifc, new_ifc, output,
+                             description=os.path.basename(new_ifc), cancellable=False)
+    return _queued(job, "Перенос данных поставлен в очередь.", result_id)
+
+
+@bp.route('/jobs', methods=['GET'])
+def list_jobs():
+    """Список заданий (без результатов), новые – первыми."""
+    jobs = [job.to_dict() for job in job_manager.list()]
+    jobs.reverse()
+    return jsonify(jobs)
+
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Статус задания."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Задание не найдено."}), 404
+    return jsonify(job.to_dict())
+
+
+@bp.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Результат завершённого задания – тот же ответ, что раньше возвращал обработчик конвертации."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Задание не найдено."}), 404
+    if not job.finished:
+        return jsonify({"status": "error", "message": "Задание ещё не завершено.", "job": job.to_dict()}), 409
+    if job.result is not None:
+        body = dict(job.result)
+        if job.status == JOB_CANCELLED:
+            body["status"] = JOB_CANCELLED
+        return jsonify(body)
+    if job.status == JOB_CANCELLED:
+        return jsonify({"status": JOB_CANCELLED, "message": "Задание отменено."})
+    return jsonify({"status": "error", "message": job.error or "Задание завершилось с ошибкой."}), 500
+
+
+# Интервал комментариев-пустышек в потоке событий, чтобы соединение не закрывалось по простою
+SSE_KEEPALIVE_SECONDS = 15
+
+
+@bp.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Поток Server-Sent Events с событиями задания: смена статуса и этапы конвертации
+    (stage, state, elapsed, processed, total, bytes_written). Поток начинается с первого
+    хранимого события, при переподключении – после Last-Event-ID, и закрывается событием
+    done после завершения задания.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Задание не найдено."}), 404
+    try:
+        position = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        position = 0
+
+    def stream():
+        nonlocal position
+        while True:
+            events, finished = job.wait_events(position, SSE_KEEPALIVE_SECONDS)
+            for event in events:
+                yield f"id: {event['seq']}\nevent: stage\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if events:
+                position = events[-1]['seq'] + 1
+            if finished and not events:
+                yield f"event: done\ndata: {json.dumps(job.to_dict(), ensure_ascii=False)}\n\n"
+                return
+            if not events:
+                yield ": keepalive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Отменяет задание в очереди или останавливает пакет после текущего файла.
+    Выполняющуюся одиночную конвертацию отменить нельзя – ответ 409.
+    """
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Задание не найдено."}), 404
+    if not job.finished and not job.is_cancelled():
+        return jsonify({"status": "error", "message": "Задание уже выполняется и не может быть отменено.",
+                        "job": job.to_dict()}), 409
+    return jsonify({"status": "success", "message": "Отмена запрошена.", "job": job.to_dict()})
+
+
+@bp.route('/uploads', methods=['POST'])
+def upload_files():
+    """
+    Загрузка входных файлов multipart/form-data (все файловые поля). Каждый файл
+    пишется на диск блоками по мере приёма, без буферизации в памяти. Возвращает
+    описания загрузок; их ref (upload:<id>) передаётся в маршруты конвертации вместо пути.
+    """
+    uploads = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        upload_id, path = remote_store.new_upload(filename)
+        uploads.append(upload_id)
+        return open(path, "wb+")
+
+    try:
+        _, form, files = parse_form_data(request.environ, stream_factory=stream_factory,
+                                         max_content_length=remote_store.max_upload_bytes)
+    except RequestEntityTooLarge:
+        for upload_id in uploads:
+            remote_store.delete_upload(upload_id)
+        return jsonify({"status": "error", "message": "Загружаемые данные больше допустимого размера."}), 413
+    except Exception as e:
+        logger.exception("Ошибка приёма загрузки.")
+        for upload_id in uploads:
+            remote_store.delete_upload(upload_id)
+        return jsonify({"status": "error", "message": f"Ошибка приёма загрузки: {e}"}), 400
+    for storage in files.values():
+        storage.close()
+
+    if not uploads:
+        return jsonify({"status": "error", "message": "В запросе нет файлов."}), 400
+    return jsonify({"status": "success", "uploads": [remote_store.upload_info(u) for u in uploads]}), 201
+
+
+@bp.route('/uploads/<filename>', methods=['PUT'])
+def upload_raw_file(filename):
+    """Загрузка одного файла телом запроса (например, curl -T); тело читается потоково."""
+    limit = remote_store.max_upload_bytes
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({"status": "error", "message": "Загружаемые данные больше допустимого размера."}), 413
+    try:
+        info = remote_store.save_stream(request.stream, filename, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+    return jsonify({"status": "success", "uploads": [info]}), 201
+
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    info = remote_store.upload_info(upload_id)
+    if info is None:
+        return jsonify({"status": "error", "message": "Загрузка не найдена."}), 404
+    return jsonify(info)
+
+
+@bp.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    if not remote_store.delete_upload(upload_id):
+        return jsonify({"status": "error", "message": "Загрузка не найдена."}), 404
+    return jsonify({"status": "success", "message": f"Загрузка {upload_id} удалена."})
+
+
+@bp.route('/results/<result_id>', methods=['GET'])
+def list_result_files(result_id):
+    """Файлы результата удалённой конвертации со ссылками для скачивания."""
+    files = remote_store.result_files(result_id)
+    if files is None:
+        return jsonify({"status": "error", "message": "Результат не найден."}), 404
+    files = [{"name": name, "size": size, "url": f"/results/{result_id}/{quote(name)}"} for name, size in files]
+    return jsonify({"status": "success", "result_id": result_id, "files": files})
+
+
+@bp.route('/results/<result_id>/<name>', methods=['GET'])
+def download_result_file(result_id, name):
+    """
+    Скачивание файла результата. Файл отдаётся потоком по блокам; поддерживаются
+    Range (докачка, ответ 206) и условные запросы по ETag/Last-Modified.
+    """
+    path = remote_store.result_file(result_id, name)
+    if path is None:
+        return jsonify({"status": "error", "message": "Файл результата не найден."}), 404
+    return send_file(path, as_attachment=True, download_name=name, conditional=True)
 
 
 @bp.route('/get_history', methods=['GET'])
 def get_history():
-    """Возвращает всю историю конвертаций."""
+    """
+    Возвращает историю конвертаций, новые записи – первыми. Необязательные параметры
+    запроса: type, status, since, until (ISO), limit, offset.
+    """
     try:
-        history = HistoryManager.get_all_entries()
-        history.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        history = HistoryManager.query(entry_type=request.args.get('type'),
+                                       status=request.args.get('status'),
+                                       since=request.args.get('since'),
+                                       until=request.args.get('until'),
+                                       limit=request.args.get('limit', type=int),
+                                       offset=request.args.get('offset', 0, type=int))
         return jsonify(history)
     except Exception as e:
         logger.exception("Ошибка при получении истории.")
@@ -197,6 +577,8 @@ def get_history_entry(entry_id):
     try:
         entry = HistoryManager.get_entry_by_id(entry_id)
         if entry:
+            # Запись открывают для восстановления файлов – она не вытесняется первой
+            HistoryManager.touch_entry(entry_id)
             return jsonify(entry)
         else:
             logger.warning(f"Запись истории с ID {entry_id} не найдена.")
@@ -206,6 +588,16 @@ def get_history_entry(entry_id):
         return jsonify({"status": "error", "message": "Ошибка на сервере при получении записи."}), 500
 
 
+@bp.route('/history_stats', methods=['GET'])
+def history_stats():
+    """Число записей истории, занятое файлами место и ограничения хранения."""
+    try:
+        return jsonify(HistoryManager.stats())
+    except Exception as e:
+        logger.exception("Ошибка при получении статистики истории.")
+        return jsonify({"status": "error", "message": "Не удалось получить статистику истории."}), 500
+
+
 @bp.route('/delete_history_item/<entry_id>', methods=['DELETE'])
 def delete_history_item(entry_id):
     """Удаляет одну запись из истории по ID."""
@@ -0,0 +1,158 @@
+"""
+Второй этап переноса GUID: сопоставление элементов двух ревизий IFC по положению.
+
+Положение элемента – начало его IfcLocalPlacement в мировых координатах (в метрах).
+Кандидаты раскладываются по сетке с шагом, равным допуску, поэтому для каждого
+элемента проверяются только 27 соседних ячеек, а не все элементы модели.
+"""
+import math
+from itertools import product
+
+import ifcopenshell.util.placement
+import ifcopenshell.util.unit
+
+DEFAULT_MATCH_TOLERANCE_M = 0.01
+
+# Ячейка, в которой больше кандидатов одного типа, считается неразличимой по положению
+# (например, когда все элементы размещены в начале координат) и пропускается
+MAX_CELL_CANDIDATES = 32
+
+_NEIGHBOURS = tuple(product((-1, 0, 1), repeat=3))
+
+
+_IDENTITY = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0))
+
+
+def _normalize(v):
+    length = math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+    return (v[0] / length, v[1] / length, v[2] / length)
+
+
+def _pad3(values):
+    values = tuple(float(v) for v in values)
+    return values + (0.0,) * (3 - len(values))
+
+
+def _axis2placement(placement):
+    """
+    IfcAxis2Placement2D/3D -> (матрица поворота по строкам, перенос).
+    Без numpy: для сотен тысяч размещений ifcopenshell.util.placement заметно медленнее.
+    """
+    location = _pad3(placement.Location.Coordinates)
+    axis = getattr(placement, "Axis", None)
+    ref = placement.RefDirection
+    if axis is None and ref is None:
+        return _IDENTITY, location
+    z = _normalize(_pad3(axis.DirectionRatios)) if axis is not None else (0.0, 0.0, 1.0)
+    x = _pad3(ref.DirectionRatios) if ref is not None else (1.0, 0.0, 0.0)
+    dot = x[0] * z[0] + x[1] * z[1] + x[2] * z[2]
+    x = _normalize((x[0] - dot * z[0], x[1] - dot * z[1], x[2] - dot * z[2]))
+    y = (z[1] * x[2] - z[2] * x[1], z[2] * x[0] - z[0] * x[2], z[0] * x[1] - z[1] * x[0])
+    rotation = ((x[0], y[0], z[0]), (x[1], y[1], z[1]), (x[2], y[2], z[2]))
+    return rotation, location
+
+
+def _compose(parent, child):
+    (pr, pt), (cr, ct) = parent, child
+    translation = tuple(pr[i][0] * ct[0] + pr[i][1] * ct[1] + pr[i][2] * ct[2] + pt[i] for i in range(3))
+    if cr is _IDENTITY:
+        return pr, translation
+    if pr is _IDENTITY:
+        return cr, translation
+    rotation = tuple(tuple(pr[i][0] * cr[0][j] + pr[i][1] * cr[1][j] + pr[i][2] * cr[2][j] for j in range(3))
+                     for i in range(3))
+    return rotation, translation
+
+
+class PlacementResolver:
+    """Мировые координаты элементов модели; преобразования IfcLocalPlacement запоминаются по id."""
+
+    def __init__(self, ifc_file):
+        self.unit_scale = ifcopenshell.util.unit.calculate_unit_scale(ifc_file)
+        self._transforms = {}
+
+    def _transform(self, placement):
+        placement_id = placement.id()
+        transform = self._transforms.get(placement_id)
+        if transform is None:
+            relative = placement.RelativePlacement
+            if relative.is_a("IfcAxis2Placement2D") or relative.is_a("IfcAxis2Placement3D"):
+                transform = _axis2placement(relative)
+            else:
+                matrix = ifcopenshell.util.placement.get_axis2placement(relative)
+                transform = (tuple(tuple(float(v) for v in matrix[i, :3]) for i in range(3)),
+                             tuple(float(matrix[i, 3]) for i in range(3)))
+            parent = placement.PlacementRelTo
+            if parent is not None and parent.is_a("IfcLocalPlacement"):
+                transform = _compose(self._transform(parent), transform)
+            self._transforms[placement_id] = transform
+        return transform
+
+    def position(self, element):
+        """(x, y, z) в метрах или None, если у элемента нет IfcLocalPlacement."""
+        placement = getattr(element, "ObjectPlacement", None)
+        if placement is None or not placement.is_a("IfcLocalPlacement"):
+            return None
+        try:
+            x, y, z = self._transform(placement)[1]
+        except Exception:
+            return None
+        scale = self.unit_scale
+        return (x * scale, y * scale, z * scale)
+
+
+def collect_positions(ifc_file, resolver=None):
+    """[(тип, GlobalId, (x, y, z))] для всех размещённых IfcProduct модели."""
+    resolver = resolver or PlacementResolver(ifc_file)
+    positions = []
+    for element in ifc_file.by_type("IfcProduct"):
+        position = resolver.position(element)
+        if position is not None:
+            positions.append((element.is_a(), element.GlobalId, position))
+    return positions
+
+
+def _cell(position, size):
+    return (math.floor(position[0] / size), math.floor(position[1] / size), math.floor(position[2] / size))
+
+
+def match_by_position(new_items, old_items, tolerance=DEFAULT_MATCH_TOLERANCE_M):
+    """
+    Сопоставляет new_items и old_items – списки (тип, значение, (x, y, z)) – внутри
+    каждого типа по расстоянию не больше tolerance. Пары выбираются жадно, начиная
+    с ближайших, каждый элемент участвует не более чем в одной паре.
+    Возвращает список (значение из new_items, значение из old_items).
+    """
+    if not new_items or not old_items:
+        return []
+
+    size = max(tolerance, 1e-6)
+    grid = {}
+    for index, (ifc_type, _, position) in enumerate(old_items):
+        grid.setdefault((ifc_type,) + _cell(position, size), []).append(index)
+
+    pairs = []
+    for new_index, (ifc_type, _, position) in enumerate(new_items):
+        x, y, z = position
+        cx, cy, cz = _cell(position, size)
+        for dx, dy, dz in _NEIGHBOURS:
+            candidates = grid.get((ifc_type, cx + dx, cy + dy, cz + dz))
+            if not candidates or len(candidates) > MAX_CELL_CANDIDATES:
+                continue
+            for old_index in candidates:
+                ox, oy, oz = old_items[old_index][2]
+                distance = math.sqrt((x - ox) ** 2 + (y - oy) ** 2 + (z - oz) ** 2)
+                if distance <= tolerance:
+                    pairs.append((distance, new_index, old_index))
+
+    pairs.sort()
+    used_new = set()
+    used_old = set()
+    matches = []
+    for _, new_index, old_index in pairs:
+        if new_index in used_new or old_index in used_old:
+            continue
+        used_new.add(new_index)
+        used_old.add(old_index)
+        matches.append((new_items[new_index][1], old_items[old_index][1]))
+    return matches
@@ -0,0 +1,484 @@
+"""
+Потоковая запись изменений свойств в IFC (STEP, ISO-10303-21) без разбора модели целиком.
+
+Исходный файл читается дважды: первый проход собирает только то, что нужно
+для сопоставления компонентов и PropertySet, второй копирует файл
+побайтно, переписывая изменённые строки и дописывая новые сущности
+в конец секции DATA с номерами выше максимального номера файла.
+"""
+import os
+import re
+
+import ifcopenshell.guid
+
+from component_matcher import ComponentIndex
+from ifc_io import open_ifc_output, open_ifc_stream
+
+PIPE_PSET_NAME = "Pset_PipeProperties"
+PIPE_PROPERTY_NAMES = ("PipeLength", "PipeDiameter")
+
+_HEAD_RE = re.compile(rb"(?:\s|/\*.*?\*/)*#(\d+)\s*=\s*([A-Za-z0-9_]+)\s*\(", re.S)
+# Лексемы, меняющие разбор инструкций: начало/конец строкового литерала, конец инструкции, комментарий
+_TOKEN_RE = re.compile(rb"[';]|/\*")
+_X2_RE = re.compile(r"\\X2\\((?:[0-9A-Fa-f]{4})*)\\X0\\")
+_X4_RE = re.compile(r"\\X4\\((?:[0-9A-Fa-f]{8})*)\\X0\\")
+_X_RE = re.compile(r"\\X\\([0-9A-Fa-f]{2})")
+_S_RE = re.compile(r"\\S\\(.)")
+
+
+def iter_statements(f, chunk_size=1 << 20):
+    """
+    Выдаёт исходные байты STEP-файла по инструкциям: каждая заканчивается ';' вне
+    строковых литералов и комментариев /* */, независимо от переводов строк, поэтому
+    несколько инструкций в одной строке разделяются. Пробелы и переводы строк перед
+    инструкцией относятся к ней, так что склейка выданных частей даёт исходный файл.
+    """
+    data = b""
+    start = pos = 0
+    in_string = in_comment = False
+    eof = False
+    while not eof:
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        data = data[start:] + chunk
+        pos -= start
+        start = 0
+        # Последний байт порции может оказаться началом '/*' или '*/' – он разбирается со следующей
+        limit = len(data) if eof else len(data) - 1
+        while pos < limit:
+            if in_string:
+                end = data.find(b"'", pos, limit)
+                if end < 0:
+                    pos = limit
+                    break
+                pos = end + 1
+                in_string = False
+            elif in_comment:
+                end = data.find(b"*/", pos)
+                if end < 0:
+                    pos = limit
+                    break
+                pos = end + 2
+                in_comment = False
+            else:
+                m = _TOKEN_RE.search(data, pos)
+                if m is None or m.start() >= limit:
+                    pos = limit
+                    break
+                pos = m.end()
+                token = m.group()
+                if token == b"'":
+                    in_string = True
+                elif token == b"/*":
+                    in_comment = True
+                else:
+                    yield data[start:pos]
+                    start = pos
+    if start < len(data):
+        yield data[start:]
+
+
+def parse_head(stmt):
+    """Возвращает (номер, ТИП, позиция после '(') для инструкции '#n=TYPE(...);' или None."""
+    m = _HEAD_RE.match(stmt)
+    if not m:
+        return None
+    return int(m.group(1)), m.group(2).decode("ascii").upper(), m.end()
+
+
+def split_args(body):
+    """Делит аргументы STEP-инструкции верхнего уровня, сохраняя исходный текст каждого."""
+    args = []
+    depth = 0
+    in_string = False
+    start = 0
+    i = 0
+    n = len(body)
+    while i < n:
+        ch = body[i]
+        if in_string:
+            if ch == "'":
+                if i + 1 < n and body[i + 1] == "'":
+                    i += 1
+                else:
+                    in_string = False
+        elif ch == "'":
+            in_string = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            args.append(body[start:i].strip())
+            start = i + 1
+        i += 1
+    tail = body[start:].strip()
+    if tail or args:
+        args.append(tail)
+    return args
+
+
+def statement_args(stmt, body_start):
+    """Аргументы инструкции в виде строк (байты декодируются latin-1 один к одному)."""
+    text = stmt.decode("latin-1")
+    return split_args(text[body_start:text.rindex(")")])
+
+
+def decode_step_string(raw):
+    """Декодирует строковый литерал STEP ('...') в str; для '$' и '*' возвращает None."""
+    if len(raw) < 2 or raw[0] != "'":
+        return None
+    s = raw[1:-1].replace("''", "'")
+    s = _X2_RE.sub(lambda m: bytes.fromhex(m.group(1)).decode("utf-16-be"), s)
+    s = _X4_RE.sub(lambda m: bytes.fromhex(m.group(1)).decode("utf-32-be"), s)
+    s = _X_RE.sub(lambda m: chr(int(m.group(1), 16)), s)
+    s = _S_RE.sub(lambda m: chr(ord(m.group(1)) + 128), s)
+    return s.replace("\\\\", "\\")
+
+
+def encode_step_string(value):
+    """Кодирует str в строковый литерал STEP; не-ASCII символы – через \\X2\\ / \\X4\\."""
+    out = []
+    for ch in value:
+        code = ord(ch)
+        if ch == "'":
+            out.append("''")
+        elif ch == "\\":
+            out.append("\\\\")
+        elif 32 <= code < 127:
+            out.append(ch)
+        elif code <= 0xFFFF:
+            out.append("\\X2\\%04X\\X0\\" % code)
+        else:
+            out.append("\\X4\\%08X\\X0\\" % code)
+    return "'" + "".join(out).replace("\\X0\\\\X2\\", "") + "'"
+
+
+def parse_refs(raw):
+    """'(#1,#2)' -> [1, 2]; '$' и '()' -> []."""
+    return [int(item.strip()[1:]) for item in raw.strip()[1:-1].split(",") if item.strip().startswith("#")]
+
+
+def format_step_real(value):
+    value = float(value)
+    if value != value or value in (float("inf"), float("-inf")):
+        return None
+    s = repr(value).upper()
+    if "E" in s:
+        mantissa, exponent = s.split("E")
+        if "." not in mantissa:
+            mantissa += "."
+        return f"{mantissa}E{exponent}"
+    if s.endswith(".0"):
+        return s[:-1]
+    return s if "." in s else s + "."
+
+
+def format_nominal_value(value):
+    """Аналог wrap_ifc_value для записи в STEP: числа – IFCREAL, строки – IFCLABEL."""
+    if isinstance(value, (int, float)):
+        real = format_step_real(value)
+        return f"IFCREAL({real})" if real is not None else "$"
+    if isinstance(value, str):
+        return f"IFCLABEL({encode_step_string(value)})"
+    return "$"
+
+
+class StepComponent:
+    """Лёгкое представление компонента из STEP-файла для ComponentIndex."""
+
+    __slots__ = ("id", "GlobalId", "Name")
+
+    def __init__(self, entity_id, global_id, name):
+        self.id = entity_id
+        self.GlobalId = global_id
+        self.Name = name
+
+
+class StepScan:
+    """
+    Результат первого прохода по STEP-файлу: максимальный номер сущности, схема,
+    PIPE-элементы и их компоненты, существующие Pset_PipeProperties и их свойства,
+    первая единица длины. assembly_count – число всех IfcElementAssembly файла, по нему
+    результат сверяется с моделью, разобранной ifcopenshell.
+    """
+
+    def __init__(self):
+        self.max_id = 0
+        self.assembly_count = 0
+        self.schema = None
+        self.assemblies = {}  # id -> (GlobalId, Name)
+        self.decompositions = []  # (id родителя, [id дочерних])
+        self.pipe_psets = {}  # id Pset_PipeProperties -> [id свойств]
+        self.element_psets = {}  # id элемента -> id его Pset_PipeProperties
+        self.properties = {}  # id IfcPropertySingleValue -> имя (только PIPE_PROPERTY_NAMES)
+        self.length_unit = None
+
+    @classmethod
+    def scan(cls, path, keep_all_rels=False):
+        """
+        Связи IfcRelDefinesByProperties с уже встреченными посторонними наборами свойств
+        не сохраняются, чтобы не держать в памяти все связи большой модели. Это верно,
+        пока номера сущностей в файле возрастают; иначе файл сканируется повторно
+        с сохранением всех связей.
+        """
+        result = cls()
+        rels = []  # (id набора свойств, [id элементов])
+        ordered = True
+        decomposition_types = {"IFCRELAGGREGATES"}
+        property_markers = tuple(f"'{name}'".encode("ascii") for name in PIPE_PROPERTY_NAMES)
+        pset_marker = f"'{PIPE_PSET_NAME}'".encode("ascii")
+
+        with open_ifc_stream(path) as f:
+            for stmt in iter_statements(f):
+                head = parse_head(stmt)
+                if head is None:
+                    if result.schema is None and b"FILE_SCHEMA" in stmt:
+                        result.schema = stmt.decode("latin-1").split("'")[1].upper()
+                        if result.schema.startswith("IFC2X"):
+                            decomposition_types.add("IFCRELNESTS")
+                    continue
+                entity_id, entity_type, body_start = head
+                if entity_id > result.max_id:
+                    result.max_id = entity_id
+                else:
+                    ordered = False
+
+                if entity_type == "IFCELEMENTASSEMBLY":
+                    args = statement_args(stmt, body_start)
+                    result.assemblies[entity_id] = (decode_step_string(args[0]), decode_step_string(args[2]))
+                elif entity_type in decomposition_types:
+                    args = statement_args(stmt, body_start)
+                    if args[4].startswith("#"):
+                        result.decompositions.append((int(args[4][1:]), parse_refs(args[5])))
+                elif entity_type == "IFCRELDEFINESBYPROPERTIES":
+                    args = statement_args(stmt, body_start)
+                    if args[5].startswith("#"):
+                        pset_id = int(args[5][1:])
+                        if keep_all_rels or pset_id in result.pipe_psets or pset_id > entity_id or not ordered:
+                            rels.append((pset_id, parse_refs(args[4])))
+                elif entity_type == "IFCPROPERTYSET":
+                    if pset_marker in stmt:
+                        args = statement_args(stmt, body_start)
+                        if decode_step_string(args[2]) == PIPE_PSET_NAME:
+                            result.pipe_psets[entity_id] = parse_refs(args[4])
+                elif entity_type == "IFCPROPERTYSINGLEVALUE":
+                    if any(marker in stmt for marker in property_markers):
+                        args = statement_args(stmt, body_start)
+                        result.properties[entity_id] = decode_step_string(args[0])
+                elif entity_type == "IFCSIUNIT" and result.length_unit is None:
+                    args = statement_args(stmt, body_start)
+                    if args[1].upper() == ".LENGTHUNIT.":
+                        result.length_unit = entity_id
+
+        if not ordered and not keep_all_rels:
+            return cls.scan(path, keep_all_rels=True)
+        result.assembly_count = len(result.assemblies)
+
+        # Оставляем только связи с Pset_PipeProperties: для каждого элемента – первый набор
+        for pset_id, related in rels:
+            if pset_id in result.pipe_psets:
+                for element_id in related:
+                    result.element_psets.setdefault(element_id, pset_id)
+        return result
+
+    def component_index(self):
+        """
+        ComponentIndex по компонентам PIPE-элементов (IfcElementAssembly,
+        в имени которых есть "PIPE"), как ComponentIndex.from_pipes(find_pipe_elements(...)).
+        """
+        index = ComponentIndex()
+        assemblies = self.assemblies
+        for parent_id, children in self.decompositions:
+            parent = assemblies.get(parent_id)
+            if not parent or not parent[1] or "PIPE" not in parent[1].upper():
+                continue
+            for child_id in children:
+                child = assemblies.get(child_id)
+                if child:
+                    index.add(StepComponent(child_id, child[0], child[1]), parent[0])
+        return index
+
+    def to_dict(self):
+        """
+        Компактное представление для сохранения на диск: только PIPE-элементы,
+        их компоненты и наборы Pset_PipeProperties этих компонентов.
+        """
+        index = self.component_index()
+        components = [[c.id, c.GlobalId, c.Name, index.pipe_of[c.GlobalId]] for c in index.by_guid.values()]
+        component_ids = {c[0] for c in components}
+        element_psets = {str(element_id): pset_id for element_id, pset_id in self.element_psets.items()
+                         if element_id in component_ids}
+        used_psets = set(element_psets.values())
+        pipe_psets = {str(pset_id): props for pset_id, props in self.pipe_psets.items() if pset_id in used_psets}
+        used_props = {prop_id for props in pipe_psets.values() for prop_id in props}
+        return {
+            "max_id": self.max_id,
+            "assembly_count": self.assembly_count,
+            "schema": self.schema,
+            "length_unit": self.length_unit,
+            "components": components,
+            "element_psets": element_psets,
+            "pipe_psets": pipe_psets,
+            "properties": {str(prop_id): name for prop_id, name in self.properties.items() if prop_id in used_props},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Восстанавливает результат сканирования из to_dict. Каждый PIPE-элемент
+        представлен своим GlobalId (номер сущности ему не нужен), поэтому
+        component_index() даёт тот же индекс, что и после полного сканирования.
+        """
+        result = cls()
+        result.max_id = data["max_id"]
+        result.assembly_count = data["assembly_count"]
+        result.schema = data["schema"]
+        result.length_unit = data["length_unit"]
+        children = {}
+        for entity_id, global_id, name, pipe_guid in data["components"]:
+            result.assemblies[entity_id] = (global_id, name)
+            children.setdefault(pipe_guid, []).append(entity_id)
+        # Родители получают отрицательные номера, чтобы не пересекаться с компонентами
+        for number, (pipe_guid, child_ids) in enumerate(children.items(), 1):
+            result.assemblies[-number] = (pipe_guid, "PIPE")
+            result.decompositions.append((-number, child_ids))
+        result.element_psets = {int(k): v for k, v in data["element_psets"].items()}
+        result.pipe_psets = {int(k): v for k, v in data["pipe_psets"].items()}
+        result.properties = {int(k): v for k, v in data["properties"].items()}
+        return result
+
+
+class StepPatch:
+    """
+    Набор изменений STEP-файла: новые инструкции и правки аргументов
+    существующих инструкций. Новые номера сущностей выделяются выше max_id.
+    Повторяет логику PropertyWriterSession: существующее свойство получает новое
+    NominalValue, отсутствующее создаётся и добавляется в HasProperties набора.
+    """
+
+    def __init__(self, scan):
+        self.scan = scan
+        self.next_id = scan.max_id + 1
+        self.appended = {}  # id -> (ТИП, [аргументы])
+        self.edits = {}  # id существующей инструкции -> {индекс аргумента: новый текст}
+        self.pset_additions = {}  # id существующего набора свойств -> [id новых свойств]
+        self._length_unit = scan.length_unit
+        self._element_psets = {}  # id элемента -> id созданного набора свойств
+        self._pset_props = {}  # id набора свойств -> {имя свойства: id свойства}
+
+    def _append(self, entity_type, args):
+        entity_id = self.next_id
+        self.next_id += 1
+        self.appended[entity_id] = (entity_type, args)
+        return entity_id
+
+    @property
+    def length_unit(self):
+        if self._length_unit is None:
+            self._length_unit = self._append("IFCSIUNIT", ["*", ".LENGTHUNIT.", "$", ".METRE."])
+        return self._length_unit
+
+    def _props_of(self, pset_id):
+        props = self._pset_props.get(pset_id)
+        if props is None:
+            props = {}
+            for prop_id in self.scan.pipe_psets.get(pset_id, ()):
+                name = self.scan.properties.get(prop_id)
+                if name is not None:
+                    props.setdefault(name, prop_id)
+            self._pset_props[pset_id] = props
+        return props
+
+    def _set_value(self, prop_id, value):
+        if prop_id in self.appended:
+            self.appended[prop_id][1][2] = value
+        else:
+            self.edits.setdefault(prop_id, {})[2] = value
+
+    def _add_to_pset(self, pset_id, prop_ids):
+        if pset_id in self.appended:
+            args = self.appended[pset_id][1]
+            refs = parse_refs(args[4]) + prop_ids
+            args[4] = "(" + ",".join(f"#{p}" for p in refs) + ")"
+        else:
+            self.pset_additions.setdefault(pset_id, []).extend(prop_ids)
+
+    def set_properties(self, element_id, props):
+        """Записывает свойства {имя: значение} в Pset_PipeProperties элемента."""
+        pset_id = self._element_psets.get(element_id, self.scan.element_psets.get(element_id))
+        if pset_id is None:
+            pset_id = self._append("IFCPROPERTYSET", [
+                encode_step_string(ifcopenshell.guid.new()), "$", encode_step_string(PIPE_PSET_NAME), "$", "()"])
+            self._append("IFCRELDEFINESBYPROPERTIES", [
+                encode_step_string(ifcopenshell.guid.new()), "$", "$", "$", f"(#{element_id})", f"#{pset_id}"])
+            self._element_psets[element_id] = pset_id
+
+        existing = self._props_of(pset_id)
+        new_props = []
+        for prop_name, prop_value in props.items():
+            value = format_nominal_value(prop_value)
+            if prop_name in existing:
+                self._set_value(existing[prop_name], value)
+                continue
+            prop_id = self._append("IFCPROPERTYSINGLEVALUE", [
+                encode_step_string(prop_name), "$", value, f"#{self.length_unit}"])
+            existing[prop_name] = prop_id
+            new_props.append(prop_id)
+        if new_props:
+            self._add_to_pset(pset_id, new_props)
+
+    def render_appended(self):
+        return "".join(f"\n#{entity_id}={entity_type}({','.join(args)});"
+                       for entity_id, (entity_type, args) in self.appended.items()).encode("latin-1")
+
+    def _rewrite(self, stmt, body_start, edits, additions):
+        text = stmt.decode("latin-1")
+        close = text.rindex(")")
+        args = split_args(text[body_start:close])
+        for index, value in edits.items():
+            args[index] = value
+        if additions:
+            refs = [f"#{p}" for p in parse_refs(args[4])] + [f"#{p}" for p in additions]
+            args[4] = f"({','.join(refs)})"
+        head = text[:body_start]
+        tail = text[close:]
+        return (head + ",".join(args) + tail).encode("latin-1")
+
+    def write(self, source_path, output_path):
+        """
+        Второй проход: побайтовая копия source_path в output_path с применением правок.
+        Оба файла могут быть сжаты (ifcZIP, gzip) – см. ifc_io.
+        Секция HEADER копируется без изменений, как и при полной записи модели.
+        Возвращает число записанных байт (несжатого текста).
+        """
+        edited_ids = set(self.edits) | set(self.pset_additions)
+        written = 0
+        section = None
+        appended_done = False
+        in_place = os.path.abspath(source_path) == os.path.abspath(output_path)
+        target_path = output_path + ".tmp" if in_place else output_path
+        with open_ifc_stream(source_path) as src, open_ifc_output(target_path, like=output_path) as dst:
+            for stmt in iter_statements(src):
+                stripped = stmt.strip()
+                if section is None and stripped == b"HEADER;":
+                    section = "HEADER"
+                elif stripped == b"DATA;":
+                    section = "DATA"
+                elif stripped == b"ENDSEC;":
+                    if section == "DATA" and not appended_done:
+                        data = self.render_appended()
+                        dst.write(data)
+                        written += len(data)
+                        appended_done = True
+                    section = None
+                elif section == "DATA" and edited_ids:
+                    head = parse_head(stmt)
+                    if head is not None and head[0] in edited_ids:
+                        stmt = self._rewrite(stmt, head[2], self.edits.get(head[0], {}),
+                                             self.pset_additions.get(head[0]))
+                dst.write(stmt)
+                written += len(stmt)
+        if in_place:
+            os.replace(target_path, output_path)
+        return written
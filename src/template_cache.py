@@ -0,0 +1,86 @@
+import logging
+import pickle
+import threading
+from collections import OrderedDict
+
+from openpyxl import load_workbook
+
+from utils import file_content_key
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateCache:
+    """
+    LRU-кэш разобранных шаблонов ACCE.
+
+    Ключ – (путь, mtime, размер, SHA-256 содержимого). Для каждого шаблона хранится
+    сериализованный снимок уже разобранной книги openpyxl: восстановление снимка
+    заметно быстрее повторного load_workbook, а каждая выдача – независимая копия,
+    которую можно заполнять и сохранять, не затрагивая кэш.
+    """
+
+    def __init__(self, max_entries=4, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> bytes
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_workbook(self, path):
+        """Возвращает свежую, готовую к заполнению копию книги-шаблона."""
+        snapshot, workbook = self._lookup(path)
+        return workbook if workbook is not None else pickle.loads(snapshot)
+
+    def get_snapshot(self, path):
+        """
+        Возвращает сериализованный снимок книги-шаблона. Снимок можно передать
+        в другой процесс и восстановить там через pickle.loads без повторного разбора.
+        """
+        snapshot, _ = self._lookup(path)
+        return snapshot
+
+    def _lookup(self, path):
+        key = file_content_key(path)
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if snapshot is not None:
+            return snapshot, None
+
+        workbook = load_workbook(filename=path)
+        snapshot = pickle.dumps(workbook, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self.misses += 1
+            if key not in self._entries and len(snapshot) <= self.max_bytes:
+                self._entries[key] = snapshot
+                self._size += len(snapshot)
+                self._evict()
+        return snapshot, workbook
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            key, snapshot = self._entries.popitem(last=False)
+            self._size -= len(snapshot)
+            logger.debug(f"Шаблон вытеснен из кэша: {key[0]}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+template_cache = TemplateCache()
@@ -1,10 +1,19 @@
 # utils.py
 import os
+import sys
 import uuid
+import gzip
 import json
+import queue
+import atexit
 import shutil
+import hashlib
 import logging
-from datetime import datetime
+import sqlite3
+import threading
+import time
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
 
 # Настроим логирование для utils, если оно еще не настроено глобально
 logger = logging.getLogger(__name__)
@@ -24,169 +33,772 @@ def get_app_folder():
             raise OSError(f"Не могу создать папку приложения: {folder}") from e
     return folder
 
+def get_base_path():
+    """Корень ресурсов приложения (assets, static): папка сборки PyInstaller или корень репозитория."""
+    if hasattr(sys, '_MEIPASS'):
+        return sys._MEIPASS
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def get_settings_path():
+    return os.path.join(get_app_folder(), "settings.json")
+
+def load_settings():
+    """Читает настройки приложения (settings.json в папке приложения); при ошибке – пустой словарь."""
+    path = get_settings_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            return data if isinstance(data, dict) else {}
+    except (IOError, json.JSONDecodeError) as e:
+        logger.error(f"Не удалось прочитать настройки {path}: {e}")
+        return {}
+
+def get_setting(name, default=None):
+    return load_settings().get(name, default)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path):
+    """Считает SHA-256 содержимого файла блоками, не читая его целиком в память."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+_hash_memo = {}  # (путь, mtime, размер) -> sha256
+_hash_memo_lock = threading.Lock()
+
+def file_content_key(path):
+    """
+    Ключ содержимого файла для кэшей: (абсолютный путь, mtime, размер, SHA-256).
+    Хэш запоминается для (путь, mtime, размер), поэтому неизменённый файл повторно не читается.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = (path, st.st_mtime_ns, st.st_size)
+    with _hash_memo_lock:
+        digest = _hash_memo.get(stat_key)
+    if digest is None:
+        digest = file_sha256(path)
+        _remember_hash(stat_key, digest)
+    return stat_key + (digest,)
+
+def _remember_hash(stat_key, digest):
+    with _hash_memo_lock:
+        for key in [k for k in _hash_memo if k[0] == stat_key[0]]:
+            del _hash_memo[key]
+        _hash_memo[stat_key] = digest
+
+def known_content_hash(path):
+    """SHA-256 файла, если он уже посчитан для текущих mtime и размера, иначе None; файл не читается."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with _hash_memo_lock:
+        return _hash_memo.get((path, st.st_mtime_ns, st.st_size))
+
+CANCEL_POLL_INTERVAL = 0.5
+
+def skipped_result(source, output):
+    """Результат элемента пакета, который не обрабатывался из-за отмены задания."""
+    return {"source": source, "output": output, "status": "cancelled", "error": "Отменено", "seconds": 0}
+
+def collect_results(futures, items, cancelled=None):
+    """
+    Результаты futures пула в порядке items – списка (source, output).
+    Если cancelled() вернул True, ещё не начатые задачи пула снимаются,
+    а вместо их результатов подставляется skipped_result.
+    """
+    results = []
+    for future, (source, output) in zip(futures, items):
+        while True:
+            try:
+                results.append(future.result(timeout=CANCEL_POLL_INTERVAL if cancelled else None))
+                break
+            except FutureTimeoutError:
+                if cancelled():
+                    for pending in futures:
+                        pending.cancel()
+                    cancelled = None
+            except CancelledError:
+                results.append(skipped_result(source, output))
+                break
+    return results
+
+# ioctl FICLONE (Linux): reflink-копия на Btrfs, XFS и других ФС с общими экстентами
+_FICLONE = 0x40049409
+
+def _reflink(source, destination):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+def place_file(source, destination, allow_link=True):
+    """
+    Помещает копию source по пути destination (с заменой) и возвращает способ:
+    'hardlink', 'reflink' или 'copy'.
+    """
+    tmp_path = f"{destination}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        method = None
+        if allow_link:
+            try:
+                os.link(source, tmp_path)
+                method = "hardlink"
+            except OSError:
+                pass
+        if method is None:
+            method = "reflink" if _reflink(source, tmp_path) else "copy"
+            if method == "copy":
+                shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+        return method
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Несжатые IFC сохраняются в историю в gzip: они большие и хорошо сжимаются,
+# а конвертеры читают .ifc.gz напрямую (см. ifc_io)
+HISTORY_COMPRESSED_SUFFIXES = (".ifc",)
+
+def write_history_blob(source_path, tmp_path, compress):
+    """
+    Записывает данные файла истории во временный файл tmp_path, сжимая несжатые IFC
+    потоково, и возвращает SHA-256 исходного файла, посчитанный за тот же проход чтения.
+    Копия, а не ссылка: пользователь может изменить свой файл на месте.
+    """
+    path = os.path.abspath(source_path)
+    st = os.stat(path)
+    if not compress and _reflink(path, tmp_path):
+        # reflink не читает данные – хэш считается единственным чтением
+        digest = file_sha256(path)
+    else:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as src, (gzip.open(tmp_path, 'wb', compresslevel=6) if compress
+                                       else open(tmp_path, 'wb')) as dst:
+            for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+                dst.write(chunk)
+        digest = sha.hexdigest()
+    after = os.stat(path)
+    if (after.st_mtime_ns, after.st_size) == (st.st_mtime_ns, st.st_size):
+        _remember_hash((path, st.st_mtime_ns, st.st_size), digest)
+    return digest
+
 def get_history_folder():
     app_folder = get_app_folder()
     folder = os.path.join(app_folder, "history")
     os.makedirs(folder, exist_ok=True) # Убедимся, что папка существует
     return folder
 
+# История хранится в SQLite: индексы по id, типу, статусу и времени, запись в транзакции.
+# Прежний history.json один раз переносится в базу при первом обращении.
+HISTORY_DB_NAME = "history.sqlite"
+HISTORY_JSON_NAME = "history.json"
+
+# Копии файлов истории хранятся один раз по содержимому: history/blobs/<sha256>[.gz].
+# В папке записи лежат жёсткие ссылки (или reflink-копии) на них, а таблица blobs
+# считает ссылки записей – данные удаляются, когда на них не ссылается ни одна запись.
+HISTORY_BLOBS_FOLDER = "blobs"
+
+# Файлы записи сохраняются в историю фоновым потоком (HistoryArchiver); состояние
+# записи archive_state: archiving – ждёт в очереди, archived – файлы сохранены.
+# У записей, созданных до фоновой архивации, archive_state пуст.
+ARCHIVE_PENDING = "archiving"
+ARCHIVE_DONE = "archived"
+DEFAULT_ARCHIVE_QUEUE_SIZE = 64
+
+# Ограничение места истории: у записей старше history_max_age_days (от последнего
+# использования) и у давно не использованных записей сверх history_budget_mb
+# удаляются копии файлов, сама запись остаётся с archive_state = evicted.
+# Занятое место (размер всех blob) ведётся счётчиком в таблице history_usage.
+ARCHIVE_EVICTED = "evicted"
+DEFAULT_HISTORY_BUDGET_MB = 10240
+DEFAULT_HISTORY_MAX_AGE_DAYS = 180
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    entry_type TEXT,
+    status TEXT,
+    error_message TEXT,
+    input_files TEXT NOT NULL,
+    output_files TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    archive_state TEXT
+);
+CREATE INDEX IF NOT EXISTS history_by_timestamp ON history (timestamp);
+CREATE INDEX IF NOT EXISTS history_by_type ON history (entry_type, timestamp);
+CREATE INDEX IF NOT EXISTS history_by_status ON history (status, timestamp);
+CREATE TABLE IF NOT EXISTS blobs (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history_usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL,
+    blobs INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO history_usage (id, bytes, blobs) SELECT 0, COALESCE(SUM(size), 0), COUNT(*) FROM blobs;
+"""
+
+_HISTORY_COLUMNS = ("id, timestamp, entry_type, status, error_message, input_files, output_files, metadata, "
+                    "archive_state")
+_HISTORY_INSERT = f"INSERT INTO history ({_HISTORY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
 class HistoryManager:
+    _init_lock = threading.Lock()
+    _ready_path = None
+    # Переименование данных blob, счётчики ссылок и удаление blob – под одной блокировкой
+    _blob_lock = threading.Lock()
+
     @staticmethod
     def _get_history_path():
-        app_folder = get_app_folder()
-        return os.path.join(app_folder, "history.json")
+        """Путь прежнего JSON-файла истории (только для миграции)."""
+        return os.path.join(get_app_folder(), HISTORY_JSON_NAME)
+
+    @staticmethod
+    def _get_db_path():
+        return os.path.join(get_app_folder(), HISTORY_DB_NAME)
+
+    @staticmethod
+    def _connect():
+        path = HistoryManager._get_db_path()
+        conn = sqlite3.connect(path, timeout=30)
+        if HistoryManager._ready_path != path:
+            with HistoryManager._init_lock:
+                if HistoryManager._ready_path != path:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(_HISTORY_SCHEMA)
+                    HistoryManager._upgrade_schema(conn)
+                    HistoryManager._migrate_json(conn)
+                    HistoryManager._ready_path = path
+                    # Дописывает архивацию, прерванную при прошлом запуске
+                    history_archiver.start()
+        return conn
+
+    @staticmethod
+    def _upgrade_schema(conn):
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+        with conn:
+            if "archive_state" not in columns:
+                conn.execute("ALTER TABLE history ADD COLUMN archive_state TEXT")
+            if "last_used" not in columns:
+                # Время последнего восстановления записи (ISO); пусто – не восстанавливалась
+                conn.execute("ALTER TABLE history ADD COLUMN last_used TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS history_by_last_used "
+                         "ON history (COALESCE(last_used, timestamp))")
+
+    @staticmethod
+    def _entry_row(entry):
+        return (
+            entry["id"],
+            entry.get("timestamp") or "",
+            entry.get("entry_type"),
+            entry.get("status"),
+            entry.get("error_message"),
+            json.dumps(entry.get("input_files") or [], ensure_ascii=False),
+            json.dumps(entry.get("output_files") or [], ensure_ascii=False),
+            json.dumps(entry.get("metadata") or {}, ensure_ascii=False),
+            entry.get("archive_state"),
+        )
+
+    @staticmethod
+    def _row_entry(row):
+        entry_id, timestamp, entry_type, status, error_message, input_files, output_files, metadata, archive_state = row
+        return {
+            "id": entry_id,
+            "timestamp": timestamp,
+            "entry_type": entry_type,
+            "status": status,
+            "error_message": error_message,
+            "input_files": json.loads(input_files),
+            "output_files": json.loads(output_files),
+            "metadata": json.loads(metadata),
+            "archive_state": archive_state,
+        }
 
     @staticmethod
-    def _save_history(history):
+    def _migrate_json(conn):
+        """Переносит записи из history.json в базу; файл переименовывается в history.json.migrated."""
         history_path = HistoryManager._get_history_path()
+        if not os.path.exists(history_path):
+            return
         try:
-            with open(history_path, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-        except IOError as e:
-            logger.error(f"Не удалось сохранить историю в {history_path}: {e}")
-        except TypeError as e:
-            logger.error(f"Ошибка сериализации истории в JSON: {e}")
+            with open(history_path, 'r', encoding='utf-8') as f:
+                history = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            logger.error(f"Не удалось прочитать {history_path} для переноса в базу истории: {e}")
+            return
+        if not isinstance(history, list):
+            logger.warning(f"Файл истории {history_path} не содержит JSON-массив, перенос пропущен.")
+            history = []
+        rows = [HistoryManager._entry_row(entry) for entry in history if isinstance(entry, dict) and entry.get("id")]
+        with conn:
+            conn.executemany(_HISTORY_INSERT.replace("INSERT", "INSERT OR IGNORE", 1), rows)
+        os.replace(history_path, history_path + ".migrated")
+        logger.info(f"В базу истории перенесено записей из {history_path}: {len(rows)}")
 
+    @staticmethod
+    def _blob_path(key):
+        return os.path.join(get_history_folder(), HISTORY_BLOBS_FOLDER, key[:2], key)
 
     @staticmethod
-    def add_entry(entry_type, status, input_file_paths, output_file_paths, metadata=None, error_message=None):
-        entry_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
-        history_base_folder = get_history_folder()
-        entry_folder = os.path.join(history_base_folder, entry_id)
-        input_folder = os.path.join(entry_folder, "input")
-        output_folder = os.path.join(entry_folder, "output")
+    def _add_blob_ref(key, tmp_path=None):
+        """
+        Увеличивает счётчик ссылок blob key. Если данных blob ещё нет, они берутся
+        из tmp_path (переименованием); без tmp_path возвращается False.
+        """
+        blob_path = HistoryManager._blob_path(key)
+        with HistoryManager._blob_lock:
+            created = not os.path.isfile(blob_path)
+            if created:
+                if tmp_path is None:
+                    return False
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            conn = HistoryManager._connect()
+            try:
+                with conn:
+                    if conn.execute("SELECT 1 FROM blobs WHERE key = ?", (key,)).fetchone():
+                        conn.execute("UPDATE blobs SET refs = refs + 1 WHERE key = ?", (key,))
+                    else:
+                        size = os.path.getsize(blob_path)
+                        conn.execute("INSERT INTO blobs (key, size, refs, created_at) VALUES (?, ?, 1, ?)",
+                                     (key, size, datetime.now().isoformat()))
+                        conn.execute("UPDATE history_usage SET bytes = bytes + ?, blobs = blobs + 1", (size,))
+            except Exception:
+                if created:
+                    os.remove(blob_path)
+                raise
+            finally:
+                conn.close()
+        return True
+
+    @staticmethod
+    def _release_keys(keys):
+        """Уменьшает счётчики ссылок blob и удаляет данные blob, на которые больше нет ссылок."""
+        if not keys:
+            return
+        with HistoryManager._blob_lock:
+            conn = HistoryManager._connect()
+            try:
+                with conn:
+                    unreferenced = HistoryManager._release_blobs(conn, keys)
+            finally:
+                conn.close()
+            HistoryManager._remove_blob_files(unreferenced)
+
+    @staticmethod
+    def _store_file(file_path, destination_path):
+        """
+        Сохраняет файл в историю: данные записываются в blob один раз на содержимое,
+        по пути destination_path появляется ссылка на blob, его счётчик ссылок
+        увеличивается. Возвращает (итоговый путь, ключ blob).
 
+        Данные пишутся во временный файл без блокировки, с подсчётом хэша за тот же
+        проход; блокировка берётся только на переименование и счётчик ссылок, поэтому
+        удаление и очистка истории не ждут копирования больших моделей.
+        """
+        compress = file_path.lower().endswith(HISTORY_COMPRESSED_SUFFIXES)
+        suffix = ".gz" if compress else ""
+        if compress:
+            destination_path += ".gz"
+        # Хэш уже посчитан (например, кэшем результатов) – если такие данные есть, файл не читается
+        digest = known_content_hash(file_path)
+        key = digest + suffix if digest else None
+        created = False
+        if key is None or not HistoryManager._add_blob_ref(key):
+            blobs_folder = os.path.join(get_history_folder(), HISTORY_BLOBS_FOLDER)
+            os.makedirs(blobs_folder, exist_ok=True)
+            tmp_path = os.path.join(blobs_folder, f"{uuid.uuid4().hex}.tmp")
+            try:
+                key = write_history_blob(file_path, tmp_path, compress) + suffix
+                HistoryManager._add_blob_ref(key, tmp_path)
+                created = not os.path.exists(tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        # Ссылка создаётся без блокировки: blob защищён от удаления счётчиком ссылок
         try:
-            os.makedirs(input_folder, exist_ok=True)
-            os.makedirs(output_folder, exist_ok=True)
-        except OSError as e:
-            logger.error(f"Не удалось создать папки для записи истории {entry_id}: {e}")
-            return None 
-
-        processed_input_files = []
-        for file_path in input_file_paths:
-            if not file_path or not os.path.exists(file_path) or not os.path.isfile(file_path):
-                logger.warning(f"Входной файл не найден или не является файлом: {file_path}")
-                processed_input_files.append({
-                     "original_name": os.path.basename(file_path) if file_path else "N/A",
-                     "saved_path": None,
-                     "error": "File not found or invalid"
-                })
-                continue
+            method = place_file(HistoryManager._blob_path(key), destination_path)
+        except Exception:
+            HistoryManager._release_keys([key])
+            raise
+        logger.debug(f"Файл истории {destination_path}: blob {key} ({'новый' if created else 'уже был'}, {method})")
+        return destination_path, key
+
+    @staticmethod
+    def _entry_blob_keys(entry):
+        return [f["blob"] for f in entry.get("input_files", []) + entry.get("output_files", []) if f.get("blob")]
+
+    @staticmethod
+    def _release_blobs(conn, keys):
+        """Уменьшает счётчики ссылок blob (внутри транзакции conn); возвращает пути blob без ссылок."""
+        unreferenced = []
+        for key in keys:
+            conn.execute("UPDATE blobs SET refs = refs - 1 WHERE key = ?", (key,))
+            row = conn.execute("SELECT refs, size FROM blobs WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] <= 0:
+                conn.execute("DELETE FROM blobs WHERE key = ?", (key,))
+                conn.execute("UPDATE history_usage SET bytes = bytes - ?, blobs = blobs - 1", (row[1],))
+                unreferenced.append(HistoryManager._blob_path(key))
+        return unreferenced
 
-            original_name = os.path.basename(file_path)
-            destination_path = os.path.join(input_folder, original_name)
+    @staticmethod
+    def _remove_blob_files(paths):
+        for path in paths:
             try:
-                shutil.copy2(file_path, destination_path)
-                processed_input_files.append({
-                    "original_name": original_name,
-                    "saved_path": destination_path
-                })
-            except Exception as e:
-                logger.error(f"Не удалось скопировать входной файл {file_path} в {destination_path}: {e}")
-                processed_input_files.append({
-                    "original_name": original_name,
-                    "saved_path": None,
-                    "error": f"Failed to copy: {e}"
-                })
-
-
-        processed_output_files = []
-        if status == "success":
-            for file_path in output_file_paths:
-                if not file_path or not os.path.exists(file_path) or not os.path.isfile(file_path):
-                    logger.warning(f"Выходной файл не найден или не является файлом: {file_path}")
-                    processed_output_files.append({
-                        "original_name": os.path.basename(file_path) if file_path else "N/A",
-                        "saved_path": None,
-                        "error": "File not found or invalid after conversion"
-                    })
-                    continue
-
-                original_name = os.path.basename(file_path)
-                destination_path = os.path.join(output_folder, original_name)
-                try:
-                    shutil.copy2(file_path, destination_path)
-                    processed_output_files.append({
-                        "original_name": original_name,
-                        "saved_path": destination_path
-                    })
-                except Exception as e:
-                    logger.error(f"Не удалось скопировать выходной файл {file_path} в {destination_path}: {e}")
-                    processed_output_files.append({
-                        "original_name": original_name,
-                        "saved_path": None,
-                        "error": f"Failed to copy: {e}"
-                    })
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Не удалось удалить данные истории {path}: {e}")
+                continue
+            try:
+                os.rmdir(os.path.dirname(path))  # только если папка blob опустела
+            except OSError:
+                pass
+
+    @staticmethod
+    def _pending_file(file_path):
+        """Файл записи, ожидающий архивации: путь и (mtime, размер) на момент записи."""
+        info = {
+            "original_name": os.path.basename(file_path) if file_path else "N/A",
+            "source_path": file_path,
+            "saved_path": None,
+        }
+        try:
+            st = os.stat(file_path)
+            info["source_stat"] = [st.st_mtime_ns, st.st_size]
+        except (OSError, TypeError, ValueError):
+            pass
+        return info
 
+    @staticmethod
+    def add_entry(entry_type, status, input_file_paths, output_file_paths, metadata=None, error_message=None):
+        """
+        Сохраняет запись истории и ставит её файлы в очередь фоновой архивации;
+        не ждёт копирования файлов. Возвращает id записи или None.
+        """
+        entry_id = str(uuid.uuid4())
         entry = {
             "id": entry_id,
-            "timestamp": timestamp,
+            "timestamp": datetime.now().isoformat(),
             "entry_type": entry_type,
             "status": status,
             "error_message": error_message if status == "error" else None,
-            "input_files": processed_input_files,
-            "output_files": processed_output_files,
-            "metadata": metadata or {}
+            "input_files": [HistoryManager._pending_file(p) for p in input_file_paths],
+            "output_files": [HistoryManager._pending_file(p) for p in output_file_paths] if status == "success" else [],
+            "metadata": metadata or {},
+            "archive_state": ARCHIVE_PENDING,
         }
 
-        history = HistoryManager.get_all_entries()
-        history.append(entry)
-        HistoryManager._save_history(history)
+        conn = HistoryManager._connect()
+        try:
+            with conn:
+                conn.execute(_HISTORY_INSERT, HistoryManager._entry_row(entry))
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сохранить запись истории {entry_id}: {e}")
+            return None
+        finally:
+            conn.close()
 
+        history_archiver.submit(entry_id)
         logger.info(f"Добавлена запись в историю: ID={entry_id}, Type={entry_type}, Status={status}")
         return entry_id
 
     @staticmethod
-    def get_all_entries():
-        """Возвращает всю историю из JSON файла."""
-        history_path = HistoryManager._get_history_path()
-        if not os.path.exists(history_path):
-            return []
+    def _archive_file(file_info, folder, kind):
+        """Сохраняет один файл записи в папку folder; kind – 'Входной' или 'Выходной'."""
+        file_path = file_info.get("source_path")
+        original_name = file_info.get("original_name") or "N/A"
+        if not file_path or not os.path.exists(file_path) or not os.path.isfile(file_path):
+            logger.warning(f"{kind} файл не найден или не является файлом: {file_path}")
+            return {"original_name": original_name, "saved_path": None, "error": "File not found or invalid"}
 
+        st = os.stat(file_path)
+        if file_info.get("source_stat") not in (None, [st.st_mtime_ns, st.st_size]):
+            # Файл перезаписан (например, следующей конвертацией) до того, как дошла очередь архивации
+            logger.warning(f"{kind} файл {file_path} изменился до сохранения в историю")
+            return {"original_name": original_name, "saved_path": None, "error": "File changed before archiving"}
+
+        destination_path = os.path.join(folder, original_name)
         try:
-            with open(history_path, 'r', encoding='utf-8') as f:
-                history_data = json.load(f)
-                if isinstance(history_data, list):
-                    return history_data
-                else:
-                    logger.warning(f"Файл истории {history_path} не содержит JSON-массив. Возвращен пустой список.")
-                    return []
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка декодирования JSON из файла истории {history_path}: {e}. Возвращен пустой список.")
-            return []
-        except IOError as e:
-            logger.error(f"Ошибка чтения файла истории {history_path}: {e}. Возвращен пустой список.")
+            destination_path, blob = HistoryManager._store_file(file_path, destination_path)
+            return {"original_name": original_name, "saved_path": destination_path, "blob": blob}
+        except Exception as e:
+            logger.error(f"Не удалось скопировать {kind.lower()} файл {file_path} в {destination_path}: {e}")
+            return {"original_name": original_name, "saved_path": None, "error": f"Failed to copy: {e}"}
+
+    @staticmethod
+    def _archive_entry(entry_id):
+        """Сохраняет файлы записи в историю (в потоке архивации) и отмечает запись archived."""
+        entry = HistoryManager.get_entry_by_id(entry_id)
+        if entry is None or entry.get("archive_state") != ARCHIVE_PENDING:
+            return
+        entry_folder = os.path.join(get_history_folder(), entry_id)
+        input_folder = os.path.join(entry_folder, "input")
+        output_folder = os.path.join(entry_folder, "output")
+        os.makedirs(input_folder, exist_ok=True)
+        os.makedirs(output_folder, exist_ok=True)
+
+        archived = {"input_files": [], "output_files": []}
+        for field, folder, kind in (("input_files", input_folder, "Входной"),
+                                    ("output_files", output_folder, "Выходной")):
+            for file_info in entry[field]:
+                # Удаление записи не ждёт архивации: оставшиеся файлы удалённой записи не копируются
+                if not HistoryManager._entry_exists(entry_id):
+                    logger.info(f"Запись истории {entry_id} удалена до окончания архивации")
+                    HistoryManager._discard_entry_files(dict(entry, **archived))
+                    return
+                archived[field].append(HistoryManager._archive_file(file_info, folder, kind))
+        entry.update(archived, archive_state=ARCHIVE_DONE)
+
+        conn = HistoryManager._connect()
+        try:
+            with conn:
+                updated = conn.execute(
+                    "UPDATE history SET input_files = ?, output_files = ?, archive_state = ? WHERE id = ?",
+                    HistoryManager._entry_row(entry)[5:7] + (ARCHIVE_DONE, entry_id)).rowcount
+        finally:
+            conn.close()
+        if not updated:
+            # Запись удалили, пока её файлы сохранялись
+            HistoryManager._discard_entry_files(entry)
+            return
+        logger.info(f"Файлы записи истории {entry_id} сохранены")
+
+    @staticmethod
+    def _entry_exists(entry_id):
+        conn = HistoryManager._connect()
+        try:
+            return conn.execute("SELECT 1 FROM history WHERE id = ?", (entry_id,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _pending_archive_ids():
+        conn = HistoryManager._connect()
+        try:
+            rows = conn.execute("SELECT id FROM history WHERE archive_state = ? ORDER BY timestamp",
+                                (ARCHIVE_PENDING,)).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def touch_entry(entry_id):
+        """Отмечает использование записи (восстановление файлов) для вытеснения по давности."""
+        conn = HistoryManager._connect()
+        try:
+            with conn:
+                conn.execute("UPDATE history SET last_used = ? WHERE id = ?", (datetime.now().isoformat(), entry_id))
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _retention_limits():
+        def number(name, default):
+            try:
+                return float(get_setting(name, default))
+            except (TypeError, ValueError):
+                return float(default)
+        budget_bytes = int(number("history_budget_mb", DEFAULT_HISTORY_BUDGET_MB) * 1024 * 1024)
+        return budget_bytes, number("history_max_age_days", DEFAULT_HISTORY_MAX_AGE_DAYS)
+
+    @staticmethod
+    def _evict_entry(entry_id):
+        """Удаляет копии файлов записи, оставляя саму запись. Возвращает True, если файлы удалены."""
+        with HistoryManager._blob_lock:
+            conn = HistoryManager._connect()
+            try:
+                with conn:
+                    row = conn.execute(f"SELECT {_HISTORY_COLUMNS} FROM history WHERE id = ?",
+                                       (entry_id,)).fetchone()
+                    if row is None:
+                        return False
+                    entry = HistoryManager._row_entry(row)
+                    if entry["archive_state"] not in (None, ARCHIVE_DONE):
+                        return False
+                    unreferenced = HistoryManager._release_blobs(conn, HistoryManager._entry_blob_keys(entry))
+                    files = {}
+                    for field in ("input_files", "output_files"):
+                        files[field] = [
+                            dict({k: v for k, v in f.items() if k != "blob"}, saved_path=None, evicted=True)
+                            for f in entry[field]]
+                    conn.execute(
+                        "UPDATE history SET input_files = ?, output_files = ?, archive_state = ? WHERE id = ?",
+                        (json.dumps(files["input_files"], ensure_ascii=False),
+                         json.dumps(files["output_files"], ensure_ascii=False), ARCHIVE_EVICTED, entry_id))
+            finally:
+                conn.close()
+            HistoryManager._remove_blob_files(unreferenced)
+        shutil.rmtree(os.path.join(get_history_folder(), entry_id), ignore_errors=True)
+        return True
+
+    @staticmethod
+    def _usage_bytes(conn):
+        return conn.execute("SELECT bytes FROM history_usage").fetchone()[0]
+
+    @staticmethod
+    def enforce_retention():
+        """
+        Удаляет копии файлов записей старше history_max_age_days, затем, пока данные
+        истории больше history_budget_mb, – записей, которые дольше всего не использовались.
+        Записи и их метаданные остаются. 0 в настройке отключает ограничение.
+        Возвращает число записей, у которых удалены файлы.
+        """
+        budget_bytes, max_age_days = HistoryManager._retention_limits()
+        candidates = (f"SELECT id FROM history WHERE (archive_state IS NULL OR archive_state = '{ARCHIVE_DONE}') "
+                      "{condition} ORDER BY COALESCE(last_used, timestamp) LIMIT 1")
+        evicted = 0
+        conn = HistoryManager._connect()
+        try:
+            if max_age_days > 0:
+                cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+                query = candidates.format(condition="AND COALESCE(last_used, timestamp) < ?")
+                while True:
+                    row = conn.execute(query, (cutoff,)).fetchone()
+                    if row is None or not HistoryManager._evict_entry(row[0]):
+                        break
+                    evicted += 1
+            if budget_bytes > 0:
+                query = candidates.format(condition="")
+                while HistoryManager._usage_bytes(conn) > budget_bytes:
+                    row = conn.execute(query).fetchone()
+                    if row is None or not HistoryManager._evict_entry(row[0]):
+                        break
+                    evicted += 1
+        finally:
+            conn.close()
+        if evicted:
+            logger.info(f"Удалены файлы записей истории по ограничению места или давности: {evicted}")
+        return evicted
+
+    @staticmethod
+    def stats():
+        """Число записей по состояниям архивации и место, занятое файлами истории."""
+        budget_bytes, max_age_days = HistoryManager._retention_limits()
+        conn = HistoryManager._connect()
+        try:
+            used_bytes, blobs = conn.execute("SELECT bytes, blobs FROM history_usage").fetchone()
+            referenced_bytes = conn.execute("SELECT COALESCE(SUM(size * refs), 0) FROM blobs").fetchone()[0]
+            states = dict(conn.execute(
+                "SELECT COALESCE(archive_state, ''), COUNT(*) FROM history GROUP BY archive_state").fetchall())
+        finally:
+            conn.close()
+        return {
+            "entries": sum(states.values()),
+            "archiving": states.get(ARCHIVE_PENDING, 0),
+            "archived": states.get(ARCHIVE_DONE, 0) + states.get("", 0),
+            "evicted": states.get(ARCHIVE_EVICTED, 0),
+            "blobs": blobs,
+            "bytes": used_bytes,
+            # Сколько занимали бы копии без дедупликации
+            "referenced_bytes": referenced_bytes,
+            "budget_bytes": budget_bytes,
+            "max_age_days": max_age_days,
+        }
+
+    @staticmethod
+    def flush_archive(timeout=None):
+        """Ждёт сохранения файлов всех записей в очереди архивации."""
+        return history_archiver.flush(timeout)
+
+    @staticmethod
+    def _discard_entry_files(entry):
+        """Освобождает blob записи, которой нет в базе, и удаляет её папку."""
+        HistoryManager._release_keys(HistoryManager._entry_blob_keys(entry))
+        shutil.rmtree(os.path.join(get_history_folder(), entry["id"]), ignore_errors=True)
+
+    @staticmethod
+    def query(entry_type=None, status=None, since=None, until=None, limit=None, offset=0):
+        """
+        Записи истории, новые – первыми. Фильтры по типу, статусу и интервалу времени
+        (since/until – строки ISO, как timestamp записи) используют индексы базы.
+        """
+        conditions, params = [], []
+        if entry_type:
+            conditions.append("entry_type = ?")
+            params.append(entry_type)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            conditions.append("timestamp < ?")
+            params.append(until)
+        sql = f"SELECT {_HISTORY_COLUMNS} FROM history"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp DESC"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [int(limit), int(offset or 0)]
+        conn = HistoryManager._connect()
+        try:
+            return [HistoryManager._row_entry(row) for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def get_all_entries():
+        """Возвращает всю историю, новые записи – первыми."""
+        try:
+            return HistoryManager.query()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения базы истории: {e}. Возвращен пустой список.")
             return []
 
     @staticmethod
     def get_entry_by_id(entry_id):
         """Возвращает одну запись истории по ее ID."""
-        history = HistoryManager.get_all_entries()
-        for entry in history:
-            if entry.get("id") == entry_id:
-                return entry
-        return None 
-    
+        conn = HistoryManager._connect()
+        try:
+            row = conn.execute(f"SELECT {_HISTORY_COLUMNS} FROM history WHERE id = ?", (entry_id,)).fetchone()
+        finally:
+            conn.close()
+        return HistoryManager._row_entry(row) if row else None
+
     @staticmethod
     def delete_entry(entry_id):
-        """Удаляет запись из истории и связанные с ней скопированные файлы."""
-        history = HistoryManager.get_all_entries()
-        entry_to_delete = None
-        new_history = []
-        for entry in history:
-             if entry.get("id") == entry_id:
-                 entry_to_delete = entry
-             else:
-                 new_history.append(entry)
-
-        if entry_to_delete is None:
+        """Удаляет запись из истории, её папку и данные файлов, на которые больше нет ссылок."""
+        with HistoryManager._blob_lock:
+            conn = HistoryManager._connect()
+            try:
+                with conn:
+                    row = conn.execute(f"SELECT {_HISTORY_COLUMNS} FROM history WHERE id = ?",
+                                       (entry_id,)).fetchone()
+                    deleted = row is not None
+                    if deleted:
+                        conn.execute("DELETE FROM history WHERE id = ?", (entry_id,))
+                        unreferenced = HistoryManager._release_blobs(
+                            conn, HistoryManager._entry_blob_keys(HistoryManager._row_entry(row)))
+            finally:
+                conn.close()
+            if deleted:
+                HistoryManager._remove_blob_files(unreferenced)
+
+        if not deleted:
              logger.warning(f"Попытка удалить несуществующую запись истории: {entry_id}")
              return False
 
-        HistoryManager._save_history(new_history)
-
         # Удаляем папку с файлами этой записи
         entry_folder = os.path.join(get_history_folder(), entry_id)
         if os.path.exists(entry_folder) and os.path.isdir(entry_folder):
@@ -195,7 +807,7 @@ class HistoryManager:
                 logger.info(f"Удалена папка с файлами истории: {entry_folder}")
             except Exception as e:
                 logger.error(f"Не удалось удалить папку истории {entry_folder}: {e}")
-        else:
+        elif HistoryManager._row_entry(row).get("archive_state") not in (ARCHIVE_PENDING, ARCHIVE_EVICTED):
             logger.warning(f"Папка для удаляемой записи истории не найдена: {entry_folder}")
 
         logger.info(f"Удалена запись истории: ID={entry_id}")
@@ -203,26 +815,104 @@ class HistoryManager:
 
     @staticmethod
     def clear_all_history():
-        """Полностью очищает историю: удаляет JSON файл и все папки с копиями файлов."""
-        history_path = HistoryManager._get_history_path()
+        """Полностью очищает историю: удаляет записи базы и все папки с копиями файлов."""
         history_folder = get_history_folder()
 
-        # Удаляем JSON файл
-        if os.path.exists(history_path):
+        with HistoryManager._blob_lock:
+            conn = HistoryManager._connect()
             try:
-                os.remove(history_path)
-                logger.info(f"Файл истории удален: {history_path}")
-            except OSError as e:
-                logger.error(f"Не удалось удалить файл истории {history_path}: {e}")
+                with conn:
+                    conn.execute("DELETE FROM history")
+                    conn.execute("DELETE FROM blobs")
+                    conn.execute("UPDATE history_usage SET bytes = 0, blobs = 0")
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось очистить базу истории: {e}")
+            finally:
+                conn.close()
 
-        # Удаляем папку history со всем содержимым
-        if os.path.exists(history_folder) and os.path.isdir(history_folder):
+            # Удаляем папку history со всем содержимым, включая blobs
+            if os.path.exists(history_folder) and os.path.isdir(history_folder):
+                try:
+                    shutil.rmtree(history_folder)
+                    logger.info(f"Папка истории удалена: {history_folder}")
+                    os.makedirs(history_folder, exist_ok=True)
+                except Exception as e:
+                    logger.error(f"Не удалось удалить папку истории {history_folder}: {e}")
+
+        logger.info("Вся история очищена.")
+
+
+class HistoryArchiver:
+    """
+    Фоновая архивация файлов истории: один поток и ограниченная очередь id записей
+    (настройка history_archive_queue_size). Если очередь заполнена, add_entry ждёт
+    места в ней. При выходе из программы очередь дописывается (atexit); записи,
+    оставшиеся в состоянии archiving после аварийного завершения, дописываются
+    при следующем запуске.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
             try:
-                shutil.rmtree(history_folder)
-                logger.info(f"Папка истории удалена: {history_folder}")
-                os.makedirs(history_folder, exist_ok=True)
-            except Exception as e:
-                logger.error(f"Не удалось удалить папку истории {history_folder}: {e}")
+                size = max(1, int(get_setting("history_archive_queue_size", DEFAULT_ARCHIVE_QUEUE_SIZE)))
+            except (TypeError, ValueError):
+                size = DEFAULT_ARCHIVE_QUEUE_SIZE
+            self._queue = queue.Queue(maxsize=size)
+            self._thread = threading.Thread(target=self._run, name="history-archiver", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def submit(self, entry_id):
+        self.start()
+        self._queue.put(entry_id)
+
+    def _archive(self, entry_id):
+        try:
+            HistoryManager._archive_entry(entry_id)
+        except Exception:
+            logger.exception(f"Ошибка сохранения файлов записи истории {entry_id}")
+        self._enforce_retention()
+
+    @staticmethod
+    def _enforce_retention():
+        try:
+            HistoryManager.enforce_retention()
+        except Exception as e:
+            logger.error(f"Ошибка ограничения места истории: {e}")
+
+    def _run(self):
+        try:
+            for entry_id in HistoryManager._pending_archive_ids():
+                self._archive(entry_id)
+        except Exception as e:
+            logger.error(f"Не удалось возобновить архивацию истории: {e}")
+        self._enforce_retention()
+        while True:
+            entry_id = self._queue.get()
+            try:
+                self._archive(entry_id)
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=None):
+        """Ждёт, пока очередь архивации опустеет. Возвращает False, если timeout истёк раньше."""
+        if self._queue is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
 
-        HistoryManager._save_history([])
-        logger.info("Вся история очищена.")
\ No newline at end of file
+history_archiver = HistoryArchiver()
@@ -0,0 +1,67 @@
+import logging
+from collections import namedtuple
+
+from openpyxl import load_workbook
+
+# Запись строки файла атрибутов для Excel -> IFC (колонки C, D, O, P):
+#   item_desc – название компонента, user_tag – ожидаемый GUID компонента,
+#   length – длина трубы в метрах, diameter – диаметр трубы
+AttributeRecord = namedtuple("AttributeRecord", ["item_desc", "user_tag", "length", "diameter"])
+ATTRIBUTE_COLUMNS = (2, 3, 14, 15)
+ATTRIBUTE_FIRST_ROW = 11
+
+logger = logging.getLogger(__name__)
+
+
+def iter_sheet_rows(file_path, sheet_name=None, min_row=1, max_col=None):
+    """
+    Лениво читает строки листа в режиме read_only, не загружая книгу целиком.
+    Возвращает кортежи значений; книга закрывается по завершении обхода.
+    """
+    wb = load_workbook(filename=file_path, read_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name else wb.active
+        for row in ws.iter_rows(min_row=min_row, max_col=max_col, values_only=True):
+            yield row
+    finally:
+        wb.close()
+
+
+def iter_records(file_path, columns, key=0, record_type=None, sheet_name=None, min_row=1, blank_limit=None):
+    """
+    Лениво читает записи из листа Excel.
+
+    columns     – индексы колонок (с нуля), попадающие в запись, в порядке полей;
+    key         – позиция ключевого поля в записи; строки с пустым ключом пропускаются;
+    record_type – namedtuple для записей (по умолчанию обычный кортеж);
+    blank_limit – None: читать до последней строки листа (граница данных в режиме
+                  read_only); число – остановиться после стольких подряд строк с пустым
+                  ключом (0 – на первой пустой, как выгрузка PSIM).
+    """
+    max_col = max(columns) + 1
+    blank = 0
+    for number, row in enumerate(iter_sheet_rows(file_path, sheet_name=sheet_name, min_row=min_row,
+                                                 max_col=max_col), min_row):
+        width = len(row)
+        values = tuple(row[c] if c < width else None for c in columns)
+        if not values[key]:
+            blank += 1
+            if blank_limit is not None and blank > blank_limit:
+                if blank_limit:
+                    logger.warning(f"{file_path}: чтение остановлено на строке {number} после {blank} пустых "
+                                   f"строк подряд; следующие строки листа не читаются")
+                break
+            continue
+        blank = 0
+        yield record_type._make(values) if record_type else values
+
+
+def iter_attribute_records(file_path):
+    """Лениво читает файл атрибутов Excel -> IFC в виде AttributeRecord."""
+    return iter_records(
+        file_path,
+        ATTRIBUTE_COLUMNS,
+        key=0,
+        record_type=AttributeRecord,
+        min_row=ATTRIBUTE_FIRST_ROW,
+    )
@@ -37,6 +37,8 @@ const attribPath = document.getElementById("attribPath");
 const btnSelectOldIFC = document.getElementById("btnSelectOldIFC");
 const btnSelectNewIFC = document.getElementById("btnSelectNewIFC");
 const btnConvertIFCTrans = document.getElementById("btnConvertIFCTransfer");
+const compressIFC = document.getElementById("compressIFC");
+const compressIFCTransfer = document.getElementById("compressIFCTransfer");
 const transferOldPath = document.getElementById("transferOldPath");
 const transferNewPath = document.getElementById("transferNewPath");
 
@@ -49,6 +51,8 @@ const btnClearAll = document.getElementById("btnClearAll");
 
 const progressContainer = document.getElementById("progressContainer");
 const progressBar = document.getElementById("progressBar");
+const btnCancelJob = document.getElementById("btnCancelJob");
+const progressStage = document.getElementById("progressStage");
 
 /********************************************************************
  * Состояние приложения
@@ -59,6 +63,14 @@ let selectedIFCs = [];
 let selectedAttrib = "";
 let selectedOldIFC = "";
 let selectedNewIFC = "";
+let currentJobId = null;
+
+const STAGE_LABELS = {
+  job: "Задание", file: "Файл", read_attributes: "Чтение атрибутов", load: "Загрузка модели",
+  scan: "Индекс модели", match: "Сопоставление", apply: "Запись свойств", write: "Сохранение",
+  old_mapping: "Соответствие старой модели", match_guids: "Перенос GUID", modify: "Изоляция и PropertySet",
+  save_revision: "Сохранение ревизии"
+};
 
 async function fetchJson(url, options = {}) {
   try {
@@ -74,6 +86,66 @@ async function fetchJson(url, options = {}) {
   } catch (error) { console.error("Network or fetch error:", error); throw error; }
 }
 
+/********************************************************************
+ * Фоновые задания: запрос ставит конвертацию в очередь, ход этапов приходит
+ * потоком SSE (/jobs/<id>/events), по событию done забираем результат
+ *******************************************************************/
+function followJob(jobId, onEvent) {
+  return new Promise(resolve => {
+    const source = new EventSource(`/jobs/${jobId}/events`);
+    source.addEventListener("stage", e => {
+      try { onEvent(JSON.parse(e.data)); } catch (err) { console.warn("Некорректное событие задания:", err); }
+    });
+    source.addEventListener("done", () => { source.close(); resolve(); });
+    source.onerror = () => { if (source.readyState === EventSource.CLOSED) resolve(); };
+  });
+}
+
+function formatBytes(n) {
+  if (n == null) return "";
+  const units = ["Б", "КБ", "МБ", "ГБ"];
+  let i = 0;
+  while (n >= 1024 && i < units.length - 1) { n /= 1024; i++; }
+  return `${n.toFixed(i ? 1 : 0)} ${units[i]}`;
+}
+
+function showStageEvent(ev) {
+  if (ev.stage === "job") return;
+  const parts = [STAGE_LABELS[ev.stage] || ev.stage];
+  if (ev.source) parts.unshift(ev.source.split(/[\\/]/).pop() + ":");
+  if (ev.processed != null) parts.push(ev.total != null ? `${ev.processed}/${ev.total}` : String(ev.processed));
+  if (ev.bytes_written != null) parts.push(formatBytes(ev.bytes_written));
+  parts.push(`${ev.elapsed.toFixed(1)} с`);
+  progressStage.textContent = parts.join(" ");
+  if (ev.state === "progress" && ev.total) setProgress(Math.min(95, Math.round(100 * ev.processed / ev.total)));
+}
+
+async function runJob(url, payload) {
+  const queued = await fetchJson(url, {
+    method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify(payload)
+  });
+  currentJobId = queued.job_id;
+  try {
+    await followJob(queued.job_id, ev => {
+      // Одиночную конвертацию можно снять только из очереди
+      if (ev.stage === "job" && ev.state === "running" && !queued.cancellable) btnCancelJob.disabled = true;
+      showStageEvent(ev);
+    });
+    return await fetchJson(`/jobs/${queued.job_id}/result`);
+  } finally { currentJobId = null; btnCancelJob.disabled = false; progressStage.textContent = ""; }
+}
+
+function showJobResult(res) {
+  const title = res.status === "success" ? "Успех" : (res.status === "cancelled" ? "Отменено" : "Ошибка");
+  showToast(title, res.message, res.status === "success");
+}
+
+btnCancelJob.addEventListener("click", async () => {
+  if (!currentJobId) return;
+  try { await fetchJson(`/jobs/${currentJobId}/cancel`, { method: "POST" }); }
+  catch (e) { console.error("Ошибка отмены задания:", e); }
+});
+
 /********************************************************************
  * Навигация и тема
  *******************************************************************/
@@ -263,11 +335,8 @@ async function convertPSIM() {
   if (!out) { showToast("Отмена", "Путь для сохранения не выбран.", false); return; }
   progressContainer.style.display = "block"; setProgress(20);
   try {
-    const res = await fetchJson("/convert", {
-      method: "POST", headers: {"Content-Type": "application/json"},
-      body: JSON.stringify({inputFile: selectedFile1, secondFile: selectedFile2, outputFile: out})
-    });
-    setProgress(100); showToast(res.status === "success" ? "Успех" : "Ошибка", res.message, res.status === "success");
+    const res = await runJob("/convert", {inputFile: selectedFile1, secondFile: selectedFile2, outputFile: out});
+    setProgress(100); showJobResult(res);
   } catch (e) { console.error(e); showToast("Ошибка", String(e), false);
   } finally { setTimeout(() => { progressContainer.style.display = "none"; setProgress(0); }, 600); }
 }
@@ -289,6 +358,7 @@ function addIFCItemToUI(p) {
   const li = document.createElement("li"); li.className = "list-group-item text-break p-1"; li.textContent = p; ifcList.appendChild(li);
 }
 function clearIFCListUI() { ifcList.innerHTML = ''; }
+function isIfcFileName(name) { return /\.(ifc|ifczip|ifc\.gz)$/i.test(name); }
 async function selectAttribFile() { // Renamed
   try {
       const p = await pywebview.api.select_source_file();
@@ -304,11 +374,8 @@ async function convertIFC() {
   if (!outDir) { showToast("Отмена", "Папка для сохранения не выбрана.", false); return; }
   progressContainer.style.display = "block"; setProgress(20);
   try {
-    const res = await fetchJson("/convert_ifc", {
-      method: "POST", headers: {"Content-Type": "application/json"},
-      body: JSON.stringify({ifcFiles: selectedIFCs, attribFile: selectedAttrib, outputFile: outDir})
-    });
-    setProgress(100); showToast(res.status === "success" ? "Успех" : "Ошибка", res.message, res.status === "success");
+    const res = await runJob("/convert_ifc", {ifcFiles: selectedIFCs, attribFile: selectedAttrib, outputFile: outDir, compress: compressIFC.checked});
+    setProgress(100); showJobResult(res);
   } catch (e) { console.error(e); showToast("Ошибка", String(e), false);
   } finally { setTimeout(() => { progressContainer.style.display = "none"; setProgress(0); }, 600); }
 }
@@ -332,11 +399,8 @@ async function transferIFC() {
   if (!out) { showToast("Отмена", "Путь для сохранения не выбран.", false); return; }
   progressContainer.style.display = "block"; setProgress(15);
   try {
-    const res = await fetchJson("/transfer_ifc", {
-      method: "POST", headers: {"Content-Type": "application/json"},
-      body: JSON.stringify({oldIfcFile: selectedOldIFC, newIfcFile: selectedNewIFC, outputFile: out})
-    });
-    setProgress(100); showToast(res.status === "success" ? "Успех" : "Ошибка", res.message, res.status === "success");
+    const res = await runJob("/transfer_ifc", {oldIfcFile: selectedOldIFC, newIfcFile: selectedNewIFC, outputFile: out, compress: compressIFCTransfer.checked});
+    setProgress(100); showJobResult(res);
   } catch (e) { console.error(e); showToast("Ошибка", String(e), false);
   } finally { setTimeout(() => { progressContainer.style.display = "none"; setProgress(0); }, 600); }
 }
@@ -361,6 +425,7 @@ btnClearAll.addEventListener("click", async () => {
 function getHistoryEntryTypeDetails(entryType) {
     switch (entryType) {
         case "PSIM_TO_ACCE": return { icon: "bi-file-earmark-spreadsheet", label: "PSIM → ACCE" };
+        case "PSIM_TO_ACCE_BATCH": return { icon: "bi-files", label: "PSIM → ACCE (пакет)" };
         case "IFC_UPDATE": return { icon: "bi-file-earmark-plus", label: "Excel → IFC" };
         case "IFC_TRANSFER": return { icon: "bi-file-earmark-arrow-up", label: "IFC → IFC" };
         default: return { icon: "bi-question-circle", label: entryType || "Неизвестно" };
@@ -409,17 +474,21 @@ async function renderHistory(filterText = "") {
       const { icon: typeIcon, label: typeLabel } = getHistoryEntryTypeDetails(entry.entry_type);
       const dateHtml = highlightText(formatDateTime(entry.timestamp), filterText);
       const statusIcon = entry.status === 'success' ? '<i class="bi bi-check-circle-fill text-success ms-2" title="Успешно"></i>' : '<i class="bi bi-x-octagon-fill text-danger ms-2" title="Ошибка"></i>';
+      const meta = entry.metadata || {};
+      const cachedIcon = meta.cached || (meta.cached_files && meta.cached_files.length) ? '<i class="bi bi-lightning-charge-fill text-warning ms-2" title="Результат взят из кэша"></i>' : '';
+      const archiving = entry.archive_state === 'archiving';
+      const archivingIcon = archiving ? '<i class="bi bi-hourglass-split text-secondary ms-2" title="Файлы сохраняются в историю"></i>' : '';
       const inputFilesHtml = renderFileList(entry.input_files, 'Входные файлы', filterText);
       const outputFilesHtml = renderFileList(entry.output_files, 'Выходные файлы', filterText);
       const errorHtml = entry.status === 'error' && entry.error_message ? `<div class="mt-1"><small class="text-danger"><strong>Ошибка:</strong> ${highlightText(entry.error_message, filterText)}</small></div>` : '';
       li.innerHTML = `
         <div class="d-flex justify-content-between align-items-start mb-1">
-          <div><i class="bi ${typeIcon} me-2"></i><strong class="me-2">${escapeHTML(typeLabel)}</strong>${statusIcon}</div>
+          <div><i class="bi ${typeIcon} me-2"></i><strong class="me-2">${escapeHTML(typeLabel)}</strong>${statusIcon}${cachedIcon}${archivingIcon}</div>
           <button class="btn btn-danger btn-sm history-delete-btn" data-entry-id="${entry.id}" title="Удалить запись"><i class="bi bi-trash"></i></button>
         </div>
         <small class="text-muted d-block mb-2">${dateHtml}</small>
         <div class="mb-1">${inputFilesHtml}</div><div class="mb-1">${outputFilesHtml}</div>${errorHtml}
-        ${entry.input_files && entry.input_files.some(f => f.saved_path && !f.error) ? '<span class="text-secondary" style="font-size: 0.8rem;">(Нажмите, чтобы восстановить)</span>' : '<span class="text-warning" style="font-size: 0.8rem;">(Нет файлов для восстановления)</span>'}`;
+        ${archiving ? '<span class="text-secondary" style="font-size: 0.8rem;">(Файлы сохраняются в историю...)</span>' : entry.archive_state === 'evicted' ? '<span class="text-muted" style="font-size: 0.8rem;">(Файлы удалены по ограничению размера истории)</span>' : entry.input_files && entry.input_files.some(f => f.saved_path && !f.error) ? '<span class="text-secondary" style="font-size: 0.8rem;">(Нажмите, чтобы восстановить)</span>' : '<span class="text-warning" style="font-size: 0.8rem;">(Нет файлов для восстановления)</span>'}`;
       historyList.appendChild(li);
     });
     historyList.removeEventListener('click', handleDeleteClick); historyList.removeEventListener('click', handleRestoreClick);
@@ -452,7 +521,7 @@ async function handleRestoreClick(event) {
       const hasRestorableFiles = entryDetails.input_files.some(file => file.saved_path && !file.error);
       if (!hasRestorableFiles) { showToast("Информация", "Для этой записи нет файлов, доступных для восстановления.", false); return; }
 
-      if (entryDetails.entry_type === "PSIM_TO_ACCE") {
+      if (entryDetails.entry_type === "PSIM_TO_ACCE" || entryDetails.entry_type === "PSIM_TO_ACCE_BATCH") {
           const psimFiles = entryDetails.input_files.filter(file => file.saved_path && !file.error);
           if (psimFiles.length >= 2) {
               selectedFile1 = psimFiles[0].saved_path; selectedFile2 = psimFiles[1].saved_path;
@@ -462,7 +531,7 @@ async function handleRestoreClick(event) {
               showToast("Успех", "Файлы из истории загружены в PSIM конвертер.", true);
           } else { showToast("Информация", "Недостаточно входных файлов для PSIM → ACCE.", false); }
       } else if (entryDetails.entry_type === "IFC_UPDATE") {
-          const restoredIFCs = entryDetails.input_files.filter(f => f.saved_path && !f.error && f.original_name.toLowerCase().endsWith('.ifc'));
+          const restoredIFCs = entryDetails.input_files.filter(f => f.saved_path && !f.error && isIfcFileName(f.original_name));
           const restoredAttrib = entryDetails.input_files.find(f => f.saved_path && !f.error && f.original_name.toLowerCase().endsWith('.xlsx'));
           if (restoredIFCs.length > 0 && restoredAttrib) {
               selectedIFCs = restoredIFCs.map(f => f.saved_path); selectedAttrib = restoredAttrib.saved_path;
@@ -472,8 +541,8 @@ async function handleRestoreClick(event) {
               showToast("Успех", "Файлы из истории загружены в Excel → IFC.", true);
           } else { showToast("Информация", "Не найдены IFC или XLSX для Excel → IFC.", false); }
       } else if (entryDetails.entry_type === "IFC_TRANSFER") {
-           const oldIFC = entryDetails.input_files.find(f => f.saved_path && !f.error && f.original_name.includes("старая") && f.original_name.toLowerCase().endsWith('.ifc'));
-           const newIFC = entryDetails.input_files.find(f => f.saved_path && !f.error && f.original_name.includes("новая") && f.original_name.toLowerCase().endsWith('.ifc'));
+           const oldIFC = entryDetails.input_files.find(f => f.saved_path && !f.error && f.original_name.includes("старая") && isIfcFileName(f.original_name));
+           const newIFC = entryDetails.input_files.find(f => f.saved_path && !f.error && f.original_name.includes("новая") && isIfcFileName(f.original_name));
            if (oldIFC && newIFC) {
                selectedOldIFC = oldIFC.saved_path; selectedNewIFC = newIFC.saved_path;
                transferOldPath.textContent = oldIFC.original_name; transferNewPath.textContent = newIFC.original_name;
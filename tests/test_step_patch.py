@@ -0,0 +1,55 @@
+"""Разбор STEP-инструкций step_patch на файлах с несколькими сущностями в одной строке."""
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from step_patch import StepPatch, StepScan, iter_statements, parse_head  # noqa: E402
+
+HEADER = (b"ISO-10303-21;\nHEADER;\nFILE_DESCRIPTION(('ViewDefinition [CoordinationView]'),'2;1');\n"
+          b"FILE_NAME('','',(''),(''),'','','');\nFILE_SCHEMA(('IFC4'));\nENDSEC;\n")
+
+# Все сущности DATA в одной строке, комментарий с ';' и апострофом, ';' внутри строки
+DATA = (b"DATA;\n"
+        b"/* single line; don't split */#1=IFCSIUNIT(*,.LENGTHUNIT.,$,.METRE.);"
+        b"#2=IFCELEMENTASSEMBLY('2O2Fr$t4X7Zf8NOew3FLOH',$,'PIPE A;1',$,$,$,$,$,$,$);"
+        b"#3=IFCELEMENTASSEMBLY('2O2Fr$t4X7Zf8NOew3FLOI',$,'COMP ''X''',$,$,$,$,$,$,$);"
+        b"#40=IFCELEMENTASSEMBLY('2O2Fr$t4X7Zf8NOew3FLOJ',$,'COMP Y',$,$,$,$,$,$,$);"
+        b"#41=IFCRELAGGREGATES('2O2Fr$t4X7Zf8NOew3FLOK',$,$,$,#2,(#3,#40));\n"
+        b"ENDSEC;\nEND-ISO-10303-21;\n")
+
+SOURCE = HEADER + DATA
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1 << 20])
+def test_statements_split_on_semicolons_outside_strings_and_comments(chunk_size):
+    statements = list(iter_statements(io.BytesIO(SOURCE), chunk_size=chunk_size))
+    assert b"".join(statements) == SOURCE
+    ids = [head[0] for head in map(parse_head, statements) if head is not None]
+    assert ids == [1, 2, 3, 40, 41]
+
+
+def test_scan_sees_every_instance_on_a_line(tmp_path):
+    path = tmp_path / "one_line.ifc"
+    path.write_bytes(SOURCE)
+    scan = StepScan.scan(str(path))
+    assert scan.max_id == 41
+    assert scan.length_unit == 1
+    assert sorted(c.Name for c in scan.component_index().by_guid.values()) == ["COMP 'X'", "COMP Y"]
+
+
+def test_patch_appends_ids_above_hidden_instances(tmp_path):
+    source = tmp_path / "one_line.ifc"
+    output = tmp_path / "patched.ifc"
+    source.write_bytes(SOURCE)
+    patch = StepPatch(StepScan.scan(str(source)))
+    patch.set_properties(40, {"PipeLength": 1500.0, "PipeDiameter": 0.1})
+    patch.write(str(source), str(output))
+
+    statements = list(iter_statements(io.BytesIO(output.read_bytes())))
+    ids = [head[0] for head in map(parse_head, statements) if head is not None]
+    assert len(ids) == len(set(ids))
+    assert min(ids[5:]) == 42